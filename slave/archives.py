@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+'''
+Source archives kept on the host across builds, so that each is only ever
+downloaded once
+'''
+import os
+import os.path
+import shutil
+import threading
+
+from solusos.download import file_checksum
+from pspec import read_pspec
+from shared import SharedStore
+
+def source_archives (pspec):
+    ''' (filename, sha1sum) of every source archive in a pspec.xml '''
+    # pisi stores archives under the last part of their URL
+    return [(os.path.basename (url), sha1sum) for url, sha1sum in read_pspec (pspec).archives if url and sha1sum]
+
+class ArchiveCache (SharedStore):
+    '''
+    Content-addressed store of source archives, named by their sha1sum.
+
+    A build gets a staging directory of hardlinks to the archives its pspec
+    needs, to be bind-mounted as pisi's archives_dir. Anything pisi had to
+    download lands there too and is collected into the store afterwards.
+    Least recently used archives are evicted once over budget bytes.
+    '''
+
+    STAGING = ".staging"
+
+    def __init__(self, cache_dir, budget):
+        self.cache_dir = cache_dir
+        self.staging_dir = os.path.join (cache_dir, self.STAGING)
+        self.budget = budget
+        self.lock = threading.Lock ()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_fetched = 0
+        self.evicted = 0
+        if not os.path.exists (self.staging_dir):
+            os.makedirs (self.staging_dir)
+
+    def _object (self, sha1sum):
+        return os.path.join (self.cache_dir, sha1sum)
+
+    def stage (self, name, pspec):
+        '''
+        Fresh staging directory for building pspec, holding every archive
+        of it that we have. Returns its path
+        '''
+        staging = os.path.join (self.staging_dir, name)
+        if os.path.exists (staging):
+            shutil.rmtree (staging)
+        os.makedirs (staging)
+        for filename, sha1sum in source_archives (pspec):
+            cached = self._object (sha1sum)
+            try:
+                os.link (cached, os.path.join (staging, filename))
+            except OSError:
+                with self.lock:
+                    self.misses += 1
+                continue
+            # mtime is the last use, for eviction
+            os.utime (cached, None)
+            with self.lock:
+                self.hits += 1
+                self.bytes_saved += os.path.getsize (cached)
+        return staging
+
+    def collect (self, name, pspec):
+        ''' Store the archives downloaded into a staging directory, and remove it '''
+        staging = os.path.join (self.staging_dir, name)
+        if not os.path.exists (staging):
+            return
+        for filename, sha1sum in source_archives (pspec):
+            cached = self._object (sha1sum)
+            fpath = os.path.join (staging, filename)
+            if os.path.exists (cached) or not os.path.isfile (fpath):
+                continue
+            # Never store a partial or corrupted download
+            if file_checksum (fpath) != sha1sum:
+                continue
+            try:
+                os.link (fpath, cached)
+            except OSError:
+                # Another build got there first
+                continue
+            with self.lock:
+                self.bytes_fetched += os.path.getsize (cached)
+        shutil.rmtree (staging, ignore_errors=True)
+        self.evict ()
+
+    def evict (self):
+        ''' Remove the least recently used archives until under budget '''
+        with self.lock:
+            entries = list ()
+            total = 0
+            for sha1sum in os.listdir (self.cache_dir):
+                if sha1sum == self.STAGING:
+                    continue
+                st = os.stat (self._object (sha1sum))
+                entries.append ((st.st_mtime, st.st_size, sha1sum))
+                total += st.st_size
+            entries.sort ()
+            for mtime, size, sha1sum in entries:
+                if total <= self.budget:
+                    break
+                try:
+                    os.unlink (self._object (sha1sum))
+                except OSError:
+                    continue
+                total -= size
+                self.evicted += 1
+            return total
+
+    def get_stats (self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': (float (self.hits) / lookups) if lookups else 0.0,
+                # XML-RPC integers are only 32 bit
+                'bytes_saved': float (self.bytes_saved),
+                'bytes_fetched': float (self.bytes_fetched),
+                'evicted': self.evicted,
+            }
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+'''
+Throughput benchmark for BuildLogger.
+
+Replays recorded `pisi build` output through a real subprocess pipe pair and
+reports how quickly BuildLogger consumes it. Raw output (i.e. captured with
+`pisi build ... 2>&1 | tee`) exercises phase detection, files from log_dir
+have already had their colour codes stripped.
+
+    ./bench_buildlog.py recorded-build.txt [more.txt ...]
+    ./bench_buildlog.py --generate 300
+'''
+import os
+import sys
+import time
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+from solusos.console import *
+from solusos.system import sizeof_fmt
+# buildlog and worker import each other, worker has to come first
+from worker import BuildState
+from buildlog import BuildLogger
+
+ESC = chr(27)
+
+def generate_log (path, size_mb):
+    ''' Write a synthetic, pisi-like build log of roughly size_mb megabytes '''
+    header = [
+        "%s[01;33mBuilding source package: bench%s[0m\n" % (ESC, ESC),
+        "Fetching source from: http://example.com/bench-1.0.tar.xz\n",
+        "bench-1.0.tar.xz (1.0 MB) 100%%      1.00 MB/s [00:00:00] [complete]\n",
+        "%s[01;32mUnpacking archive(s)...%s[0m\n" % (ESC, ESC),
+        "%s[01;32mApplying patch: fix-build.patch%s[0m\n" % (ESC, ESC),
+        "%s[01;32mSetting up source...%s[0m\n" % (ESC, ESC),
+        "%s[01;32mBuilding source...%s[0m\n" % (ESC, ESC),
+    ]
+    body = "i686-pc-linux-gnu-gcc -DHAVE_CONFIG_H -I. -O2 -pipe -c src/file%05d.c -o src/file%05d.o\n"
+    target = size_mb * 1024 * 1024
+    written = 0
+    with open (path, "w") as log:
+        for line in header:
+            log.write (line)
+        count = 0
+        while written < target:
+            line = body % (count, count)
+            log.write (line)
+            written += len (line)
+            count += 1
+            if count % 5000 == 0:
+                log.write ("%s[01;33mwarning:%s[0m unused variable 'x'\n" % (ESC, ESC))
+        log.write ("%s[01;32mTesting package...%s[0m\n" % (ESC, ESC))
+
+def replay (path, with_stderr):
+    ''' Run one log through BuildLogger, returning (seconds, bytes, callbacks) '''
+    if with_stderr:
+        cmd = "cat \"%s\" & cat \"%s\" 1>&2; wait" % (path, path)
+    else:
+        cmd = "cat \"%s\"" % path
+    size = os.path.getsize (path) * (2 if with_stderr else 1)
+
+    callbacks = list ()
+    def callback (state, extra=None):
+        callbacks.append (state)
+
+    with open (os.devnull, "w") as sink:
+        # Keep the phase chatter out of our numbers
+        stdout = sys.stdout
+        sys.stdout = sink
+        try:
+            start = time.time ()
+            p = subprocess.Popen (cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            BuildLogger (p, sink, callback)
+            p.wait ()
+            elapsed = time.time () - start
+        finally:
+            sys.stdout = stdout
+    return (elapsed, size, len (callbacks))
+
+def main ():
+    parser = OptionParser (usage="%prog [options] [recorded-log ...]")
+    parser.add_option ("--generate", type="int", metavar="MB", help="benchmark a synthetic log of MB megabytes")
+    parser.add_option ("--stderr", action="store_true", default=False, help="replay on stderr at the same time")
+    parser.add_option ("--runs", type="int", default=3, help="runs per log (best is reported)")
+    options, logs = parser.parse_args ()
+
+    generated = None
+    if options.generate:
+        fd, generated = tempfile.mkstemp (prefix="bench-buildlog-", suffix=".txt")
+        os.close (fd)
+        print_info ("Generating %dMB synthetic log" % options.generate)
+        generate_log (generated, options.generate)
+        logs.append (generated)
+    if not logs:
+        parser.error ("nothing to replay")
+
+    try:
+        for log in logs:
+            best = None
+            for run in range (options.runs):
+                result = replay (log, options.stderr)
+                if best is None or result[0] < best[0]:
+                    best = result
+            elapsed, size, callbacks = best
+            rate = (size / (1024.0 * 1024.0)) / elapsed if elapsed > 0 else 0
+            print "%s: %s in %.2fs, %.1f MB/s, %d phase callbacks" % (os.path.basename (log), sizeof_fmt (size), elapsed, rate, callbacks)
+    finally:
+        if generated is not None:
+            os.unlink (generated)
+
+if __name__ == "__main__":
+    main ()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+'''
+Stand-in for `chroot ROOT pisi ...`, used by bench_pipeline.py.
+
+`pisi build` replays a recorded build log (from BENCH_LOGS, by package name,
+or any of them) and leaves a package of BENCH_PACKAGE_SIZE bytes in the -O
+directory. Each phase of the log takes as long as the last build of the
+package recorded in BENCH_HISTORY took (times BENCH_SPEED), or the whole
+log BENCH_DURATION seconds without history. Anything else succeeds at once.
+
+    bench_fakepisi.py ROOT pisi build -y spec/pspec.xml -O /work_dir/name
+'''
+import os
+import re
+import sys
+import json
+import time
+import zlib
+
+from pspec import read_pspec
+
+ESC = chr(27)
+# Kept in step with BuildLogger.PHASES
+PHASES = re.compile (r'(Setting up source)|(Unpacking archive\()|(Applying patch)|(Building source\.)|(Testing package)|(Building source package:)')
+PHASE_NAMES = [None, "CONFIGURING", "UNPACKING", "PATCHING", "BUILDING", "TESTING", "STARTED"]
+FETCHING = "Fetching source from:"
+
+CHUNK_SIZE = 64 * 1024
+
+def pspec_info (pspec):
+    ''' (name, version) of the package a pspec.xml builds '''
+    info = read_pspec (pspec)
+    return (info.name or os.path.basename (os.path.dirname (pspec)), info.version or "1")
+
+def find_log (name):
+    log_dir = os.environ.get ("BENCH_LOGS")
+    if not log_dir or not os.path.isdir (log_dir):
+        return None
+    logs = sorted (log for log in os.listdir (log_dir) if log.endswith (".txt"))
+    if not logs:
+        return None
+    for log in logs:
+        if log[:-4] == name or log[:-4].rsplit ("-", 1)[0] == name:
+            return os.path.join (log_dir, log)
+    # Any recording will do, the same one every time
+    return os.path.join (log_dir, logs[zlib.crc32 (name) % len (logs)])
+
+def phase_times (name):
+    ''' Seconds per phase of the last recorded build of name, or None '''
+    history = os.environ.get ("BENCH_HISTORY")
+    if not history or not os.path.exists (history):
+        return None
+    latest = None
+    with open (history, "r") as records:
+        for line in records:
+            try:
+                record = json.loads (line)
+            except ValueError:
+                continue
+            if record.get ('name') == name and (latest is None or record['started'] > latest['started']):
+                latest = record
+    return latest['phases'] if latest is not None else None
+
+def segments (log):
+    ''' Split a log into [phase, data] at its phase markers '''
+    found = [["STARTED", []]]
+    with open (log, "r") as source:
+        for line in source:
+            phase = None
+            if ESC in line:
+                match = PHASES.search (line)
+                if match is not None:
+                    phase = PHASE_NAMES[match.lastindex]
+            elif FETCHING in line:
+                phase = "FETCHING"
+            if phase is not None and phase != found[-1][0]:
+                found.append ([phase, []])
+            found[-1][1].append (line)
+    return [(phase, "".join (lines)) for phase, lines in found]
+
+def replay (log, name):
+    parts = segments (log)
+    times = phase_times (name)
+    speed = float (os.environ.get ("BENCH_SPEED", "1"))
+    if times is None:
+        total = sum (len (data) for phase, data in parts) or 1
+        duration = float (os.environ.get ("BENCH_DURATION", "0"))
+    for phase, data in parts:
+        if times is not None:
+            # Shared out between every part of the same phase
+            share = len ([p for p, d in parts if p == phase])
+            seconds = times.get (phase, 0.0) * speed / share
+        else:
+            seconds = duration * len (data) / total
+        chunks = max (1, len (data) / CHUNK_SIZE)
+        for i in range (0, len (data), CHUNK_SIZE):
+            sys.stdout.write (data[i:i + CHUNK_SIZE])
+            sys.stdout.flush ()
+            if seconds > 0:
+                time.sleep (seconds / chunks)
+
+def build (root, args):
+    spec = None
+    output = "."
+    i = 0
+    while i < len (args):
+        if args[i] == "-O":
+            output = args[i + 1]
+            i += 1
+        elif not args[i].startswith ("-"):
+            spec = args[i]
+        i += 1
+    if spec is None:
+        return 1
+    name, version = pspec_info (os.path.join (root, spec.lstrip ("/")))
+    log = find_log (name)
+    if log is not None:
+        replay (log, name)
+
+    output = os.path.join (root, output.lstrip ("/"))
+    if not os.path.exists (output):
+        os.makedirs (output)
+    size = int (os.environ.get ("BENCH_PACKAGE_SIZE", "1048576"))
+    with open (os.path.join (output, "%s-%s-1-1.pisi" % (name, version)), "wb") as package:
+        # Incompressible, like a real package
+        package.write (os.urandom (size))
+    return 0
+
+def main (argv):
+    if len (argv) < 2:
+        return 1
+    root = argv[0]
+    command = argv[1:]
+    if os.path.basename (command[0]) == "dbus" and command[1:] == ["start"]:
+        # Health checks look for a live pid, ours is gone too soon
+        pid_dir = os.path.join (root, "var/run/dbus")
+        if not os.path.exists (pid_dir):
+            os.makedirs (pid_dir)
+        with open (os.path.join (pid_dir, "pid"), "w") as pid:
+            pid.write ("1\n")
+        return 0
+    if command[0] == "pisi" and len (command) > 1 and command[1] == "build":
+        return build (root, command[2:])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit (main (sys.argv[1:]))
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+'''
+End to end benchmark of the build pipeline.
+
+Runs begin_build on a real Worker, in a system image on tmpfs, against a
+local stand-in for the frontend's queue API, with bench_fakepisi.py in place
+of chroot + pisi replaying recorded build logs. Reports the time spent per
+stage (entering and leaving the system, building, log handling, status
+reporting, syncing) and queue throughput at each size, as JSON that can be
+compared with the results of another release.
+
+Needs root (for loop, overlay and tmpfs mounts) and has to be run from the
+slave directory, like slave.py.
+
+    ./bench_pipeline.py --sizes 1,8,32 --logs recorded/ -o results.json
+    ./bench_pipeline.py --history /mnt/builder/solusos/slave/history/builds --speed 0.01
+    ./bench_pipeline.py --compare old.json new.json
+'''
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import socket
+import platform
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from solusos.console import *
+from solusos.system import UnderlayManager
+from solusos.mounts import MountManager
+# buildlog and worker import each other, worker has to come first
+import worker
+from worker import Worker
+# The original, before instrument () puts TimedStatusReporter in its place
+from reporter import StatusReporter as _BaseReporter
+from bench_buildlog import generate_log
+
+FAKE_PISI = os.path.abspath ("bench_fakepisi.py")
+
+class Timings:
+    ''' Durations of each stage, from any thread '''
+
+    def __init__(self):
+        self.lock = threading.Lock ()
+        self.stages = dict ()
+
+    def add (self, stage, seconds):
+        with self.lock:
+            self.stages.setdefault (stage, list ()).append (seconds)
+
+    def timed (self, stage, func):
+        def timed_call (*args, **kwargs):
+            start = time.time ()
+            try:
+                return func (*args, **kwargs)
+            finally:
+                self.add (stage, time.time () - start)
+        return timed_call
+
+    def summary (self):
+        with self.lock:
+            return dict ((stage, {
+                'count': len (times),
+                'total': sum (times),
+                'mean': sum (times) / len (times),
+                'min': min (times),
+                'max': max (times),
+            }) for stage, times in self.stages.iteritems ())
+
+class ThreadedHTTPServer (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class QueueAPIHandler (BaseHTTPRequestHandler):
+    ''' Just enough of the frontend's piston API for QueueAPI '''
+
+    protocol_version = "HTTP/1.1"
+    QUEUE = re.compile (r'^/api/queue/(\d+)/?$')
+    STATUS = re.compile (r'^/api/queuestatus/(\d+)/?$')
+
+    def _reply (self, code, body):
+        self.send_response (code)
+        self.send_header ("Content-Type", "application/json")
+        self.send_header ("Content-Length", str (len (body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def do_GET (self):
+        match = self.QUEUE.match (self.path)
+        queue = self.server.queues.get (int (match.group (1))) if match else None
+        if queue is None:
+            self._reply (404, "{}")
+            return
+        self._reply (200, json.dumps (queue))
+
+    def do_PUT (self):
+        start = time.time ()
+        length = int (self.headers.getheader ("Content-Length", "0"))
+        self.rfile.read (length)
+        if not self.QUEUE.match (self.path) and not self.STATUS.match (self.path):
+            self._reply (404, "{}")
+            return
+        if self.server.latency > 0:
+            time.sleep (self.server.latency)
+        self._reply (200, "{}")
+        self.server.timings.add ("frontend_request", time.time () - start)
+
+    def log_message (self, format, *args):
+        pass
+
+class QueueAPIStub:
+    ''' The frontend, serving queues from memory on an ephemeral port '''
+
+    def __init__(self, timings, latency=0.0):
+        self.server = ThreadedHTTPServer (("127.0.0.1", 0), QueueAPIHandler)
+        self.server.queues = dict ()
+        self.server.timings = timings
+        self.server.latency = latency
+        self.address = "127.0.0.1:%d" % self.server.server_address[1]
+        thread = threading.Thread (target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start ()
+
+    def add_queue (self, queue_id, items):
+        self.server.queues[queue_id] = items
+
+    def shutdown (self):
+        self.server.shutdown ()
+
+def package_name (index):
+    return "bench%03d" % index
+
+def pspec_for (index, depends):
+    deps = "".join ("<Dependency>%s</Dependency>" % dep for dep in depends)
+    return ("<PISI><Source><Name>%s</Name><BuildDependencies>%s</BuildDependencies></Source>"
+            "<Package><Name>%s</Name></Package>"
+            "<History><Update><Version>1.0</Version></Update></History></PISI>\n") % (package_name (index), deps, package_name (index))
+
+class BenchEnvironment:
+    '''
+    Storage on tmpfs, holding a small system image with a repository of
+    count packages. Every fourth package build-depends on the one before
+    '''
+
+    REPO = "bench"
+
+    def __init__(self, count, image_size, tmpfs_size):
+        self.count = count
+        self.base = tempfile.mkdtemp (prefix="bench-pipeline-")
+        if not MountManager.mount ("tmpfs", self.base, filesystem="tmpfs", options="size=%dm" % tmpfs_size):
+            raise Exception ("Unable to mount tmpfs on %s" % self.base)
+        self.storage = os.path.join (self.base, "storage")
+        # The worker mounts its system here, slave.py creates it when imaging media
+        os.makedirs (os.path.join (self.storage, "mountpoint"))
+        self.fs_image = os.path.join (self.storage, "storage.image")
+        UnderlayManager.AllocateImage (self.fs_image, image_size * 1024 * 1024)
+        if subprocess.call (["mkfs.ext4", "-F", "-q", self.fs_image]) != 0:
+            raise Exception ("Unable to create %s" % self.fs_image)
+        self._populate ()
+
+    def _populate (self):
+        seed = os.path.join (self.base, "seed")
+        os.makedirs (seed)
+        MountManager.mount (self.fs_image, seed, options="loop")
+        try:
+            for item in ["etc/pisi", "var/lib/pisi/package", "var/run/dbus", "proc", "dev/shm", "work_dir", "log_dir"]:
+                os.makedirs (os.path.join (seed, item))
+            for index in range (self.count):
+                spec_dir = os.path.join (seed, "repositories", self.REPO, package_name (index))
+                os.makedirs (spec_dir)
+                depends = [package_name (index - 1)] if index % 4 == 3 else []
+                with open (os.path.join (spec_dir, "pspec.xml"), "w") as pspec:
+                    pspec.write (pspec_for (index, depends))
+        finally:
+            MountManager.umount (seed)
+            os.rmdir (seed)
+
+    def queue (self, size):
+        return [{
+            'name': package_name (index),
+            'version': "1.0",
+            'spec_uri': "%s/pspec.xml" % package_name (index),
+            'build_status': "pending",
+        } for index in range (size)]
+
+    def config (self, frontend, parallel):
+        return {
+            'Frontend': { 'Username': "bench", 'Password': "bench", 'URL': frontend },
+            'Builder': { 'Architecture': "i686", 'Name': "Bench", 'Storage': self.storage },
+            'Settings': {
+                'Autoclean': "True",
+                'ParallelBuilds': parallel,
+                'MaxJobs': "auto",
+                # Every call enters and leaves the system, so both get measured
+                'EnvironmentIdleTimeout': "0",
+                'RepoProxyPort': "0",
+            },
+        }
+
+    def cleanup (self):
+        MountManager.umount (self.base, lazy=True, recursive=True)
+        os.rmdir (self.base)
+
+class RsyncDaemon:
+    ''' rsync daemon on the standard port, the only one sync_packages can use '''
+
+    def __init__(self, base):
+        self.target = os.path.join (base, "incoming")
+        os.makedirs (self.target)
+        self.conf = os.path.join (base, "rsyncd.conf")
+        with open (self.conf, "w") as conf:
+            conf.write ("use chroot = no\n[bench]\npath = %s\nread only = no\nuid = root\ngid = root\n" % self.target)
+        self.process = subprocess.Popen (["rsync", "--daemon", "--no-detach", "--config=%s" % self.conf])
+        for attempt in range (50):
+            try:
+                socket.create_connection (("127.0.0.1", 873), 0.1).close ()
+                return
+            except socket.error:
+                time.sleep (0.1)
+        self.stop ()
+        raise Exception ("rsync daemon did not start")
+
+    def stop (self):
+        if self.process.poll () is None:
+            self.process.terminate ()
+            self.process.wait ()
+
+class TimedStatusReporter (_BaseReporter):
+    timings = None
+
+    def close (self, timeout=60):
+        start = time.time ()
+        try:
+            return _BaseReporter.close (self, timeout)
+        finally:
+            self.timings.add ("report_drain", time.time () - start)
+
+def instrument (bench_worker, timings):
+    ''' Time each stage of bench_worker '''
+    for stage, method in [("enter", "_enter_system"), ("exit", "_exit_system"), ("build", "_build_item"),
+                          ("log", "_run_logged_chroot_command_in_system"), ("sync", "sync_packages"),
+                          ("queue", "begin_build")]:
+        setattr (bench_worker, method, timings.timed (stage, getattr (bench_worker, method)))
+    TimedStatusReporter.timings = timings
+    worker.StatusReporter = TimedStatusReporter
+
+def version ():
+    try:
+        p = subprocess.Popen (["git", "describe", "--always", "--dirty"], stdout=subprocess.PIPE, stderr=open (os.devnull, "w"))
+        output = p.communicate ()[0].strip ()
+        if p.returncode == 0:
+            return output
+    except OSError:
+        pass
+    return "unknown"
+
+def run (options, sizes):
+    timings = Timings ()
+    frontend = QueueAPIStub (timings, latency=options.latency)
+    env = BenchEnvironment (max (sizes), options.image_size, options.tmpfs_size)
+    daemon = None
+    bench_worker = None
+    throughput = list ()
+    try:
+        if options.logs:
+            os.environ["BENCH_LOGS"] = os.path.abspath (options.logs)
+        else:
+            log_dir = os.path.join (env.base, "logs")
+            os.makedirs (log_dir)
+            generate_log (os.path.join (log_dir, "synthetic.txt"), options.log_size)
+            os.environ["BENCH_LOGS"] = log_dir
+        if options.history:
+            os.environ["BENCH_HISTORY"] = os.path.abspath (options.history)
+        os.environ["BENCH_SPEED"] = str (options.speed)
+        os.environ["BENCH_DURATION"] = str (options.duration)
+        os.environ["BENCH_PACKAGE_SIZE"] = str (options.package_size * 1024)
+
+        Worker.CHROOT = "%s \"%s\"" % (sys.executable, FAKE_PISI)
+        bench_worker = Worker (env.config (frontend.address, options.parallel))
+        bench_worker.repo_subdir = env.REPO
+        instrument (bench_worker, timings)
+        if options.sync:
+            daemon = RsyncDaemon (env.base)
+
+        for queue_id, size in enumerate (sizes, 1):
+            frontend.add_queue (queue_id, env.queue (size))
+            # Every run builds for real, never from the build cache
+            bench_worker.build_cache.salt = uuid.uuid4 ().hex
+            print_info ("Building a queue of %d" % size)
+            start = time.time ()
+            ok = bench_worker.begin_build (queue_id, False)
+            elapsed = time.time () - start
+            throughput.append ({
+                'size': size,
+                'ok': ok,
+                'seconds': elapsed,
+                'packages_per_minute': 60.0 * size / elapsed if elapsed > 0 else 0.0,
+            })
+            if daemon is not None:
+                bench_worker.sync_packages ("127.0.0.1", "bench", "bench", "")
+    finally:
+        if daemon is not None:
+            daemon.stop ()
+        frontend.shutdown ()
+        if bench_worker is not None:
+            bench_worker.release_environment ()
+        env.cleanup ()
+
+    return {
+        'version': version (),
+        'time': time.time (),
+        'host': {
+            'hostname': socket.gethostname (),
+            'kernel': platform.uname ()[2],
+            'cpus': multiprocessing.cpu_count (),
+        },
+        'options': dict (vars (options)),
+        'stages': timings.summary (),
+        'throughput': throughput,
+    }
+
+def report (results):
+    print "Pipeline benchmark of %s" % results['version']
+    for stage, summary in sorted (results['stages'].iteritems ()):
+        print "  %-18s %5d x %8.3fs mean, %8.3fs total" % (stage, summary['count'], summary['mean'], summary['total'])
+    for run in results['throughput']:
+        print "  queue of %-4d %8.2fs, %6.1f packages/minute%s" % (run['size'], run['seconds'], run['packages_per_minute'], "" if run['ok'] else " (FAILED)")
+
+def compare (old, new):
+    print "%s -> %s" % (old['version'], new['version'])
+    for stage in sorted (set (old['stages']) | set (new['stages'])):
+        if stage not in old['stages'] or stage not in new['stages']:
+            continue
+        before = old['stages'][stage]['mean']
+        after = new['stages'][stage]['mean']
+        change = (after - before) / before * 100 if before > 0 else 0.0
+        print "  %-18s %8.3fs -> %8.3fs mean (%+.1f%%)" % (stage, before, after, change)
+    sizes = dict ((run['size'], run) for run in old['throughput'])
+    for run in new['throughput']:
+        if run['size'] in sizes:
+            before = sizes[run['size']]['packages_per_minute']
+            after = run['packages_per_minute']
+            change = (after - before) / before * 100 if before > 0 else 0.0
+            print "  queue of %-4d %6.1f -> %6.1f packages/minute (%+.1f%%)" % (run['size'], before, after, change)
+
+def main ():
+    parser = OptionParser (usage="%prog [options] | --compare old.json new.json")
+    parser.add_option ("--sizes", default="1,8,32", help="queue sizes to build, comma separated")
+    parser.add_option ("--parallel", default="auto", help="ParallelBuilds for the worker")
+    parser.add_option ("--logs", metavar="DIR", help="recorded build logs to replay (name-version.txt)")
+    parser.add_option ("--log-size", type="int", default=4, metavar="MB", help="size of the synthetic log without --logs")
+    parser.add_option ("--history", metavar="FILE", help="build history to take phase timings from")
+    parser.add_option ("--speed", type="float", default=1.0, help="scale for the timings from --history")
+    parser.add_option ("--duration", type="float", default=0.0, help="seconds per build without history")
+    parser.add_option ("--package-size", type="int", default=1024, metavar="KB", help="size of each built package")
+    parser.add_option ("--latency", type="float", default=0.0, help="seconds the frontend takes per status update")
+    parser.add_option ("--sync", action="store_true", default=False, help="also sync packages to a local rsync daemon")
+    parser.add_option ("--image-size", type="int", default=256, metavar="MB", help="size of the system image")
+    parser.add_option ("--tmpfs-size", type="int", default=1024, metavar="MB", help="size of the tmpfs holding everything")
+    parser.add_option ("-o", "--output", metavar="FILE", help="write the results here as JSON")
+    parser.add_option ("--compare", action="store_true", default=False, help="compare two results files")
+    options, args = parser.parse_args ()
+
+    if options.compare:
+        if len (args) != 2:
+            parser.error ("--compare takes two results files")
+        with open (args[0], "r") as old:
+            with open (args[1], "r") as new:
+                compare (json.load (old), json.load (new))
+        return
+    if os.geteuid () != 0:
+        print_error ("Must be run as root")
+        sys.exit (1)
+
+    sizes = [int (size) for size in options.sizes.split (",")]
+    results = run (options, sizes)
+    report (results)
+    if options.output:
+        with open (options.output, "w") as output:
+            json.dump (results, output, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main ()
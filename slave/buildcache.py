@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+'''
+Content-addressed cache of build results.
+
+An entry is keyed on everything that goes into a build: the contents of the
+spec directory, the checksums of the source archives and the exact versions
+of the installed build dependencies. Least recently used entries are
+evicted once the cache is over its budget.
+'''
+import os
+import os.path
+import shutil
+import hashlib
+import threading
+import time
+
+from pspec import read_pspec
+from shared import SharedStore
+
+# Where pisi keeps track of installed packages, relative to the root
+PISI_PACKAGE_DIR = "var/lib/pisi/package"
+
+def installed_packages (root):
+    '''
+    Map of installed package name to version-release for the given root
+    '''
+    packages = dict ()
+    package_dir = os.path.join (root, PISI_PACKAGE_DIR)
+    if not os.path.exists (package_dir):
+        return packages
+    for entry in os.listdir (package_dir):
+        parts = entry.rsplit ("-", 2)
+        if len (parts) == 3:
+            packages[parts[0]] = "%s-%s" % (parts[1], parts[2])
+    return packages
+
+def missing_dependencies (pspec, root):
+    '''
+    Build dependencies of pspec not installed in root, which pisi build
+    would install from the repositories before building
+    '''
+    installed = installed_packages (root)
+    return sorted (dep for dep in read_pspec (pspec).depends if dep not in installed)
+
+def _place (source, target):
+    ''' Hardlink source to target, or copy it across filesystems '''
+    try:
+        os.link (source, target)
+    except OSError:
+        shutil.copy2 (source, target)
+
+class BuildCache (SharedStore):
+    '''
+    Shared by every worker slot, so open it with BuildCache.open (cache_dir, ...)
+    '''
+
+    LOG_NAME = "build.log"
+    INDEX_NAME = "build.log.index"
+
+    def __init__(self, cache_dir, salt="", budget=None):
+        self.cache_dir = cache_dir
+        self.salt = salt
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evicted = 0
+        self.lock = threading.Lock ()
+        if not os.path.exists (self.cache_dir):
+            os.makedirs (self.cache_dir)
+
+    def key_for (self, pspec, root):
+        '''
+        Compute the cache key for building pspec inside root. Must be called
+        once the build dependencies have been installed (see
+        missing_dependencies), or a dependency upgraded in the repositories
+        would go unnoticed.
+        '''
+        digest = hashlib.sha1 ()
+        digest.update (self.salt)
+
+        spec_dir = os.path.dirname (pspec)
+        for dirpath, dirnames, filenames in os.walk (spec_dir):
+            dirnames.sort ()
+            for filename in sorted (filenames):
+                fpath = os.path.join (dirpath, filename)
+                digest.update ("file:%s\0" % os.path.relpath (fpath, spec_dir))
+                with open (fpath, "rb") as spec_file:
+                    for block in iter (lambda: spec_file.read (65536), ""):
+                        digest.update (block)
+
+        info = read_pspec (pspec)
+        for checksum in sorted (sha1sum for url, sha1sum in info.archives):
+            digest.update ("archive:%s\0" % checksum)
+
+        installed = installed_packages (root)
+        for dep in sorted (info.depends):
+            digest.update ("dep:%s=%s\0" % (dep, installed.get (dep, "")))
+        return digest.hexdigest ()
+
+    def _entry (self, key):
+        return os.path.join (self.cache_dir, key[:2], key)
+
+    def restore (self, key, package_dir, log_file, index_file):
+        '''
+        Copy the cached packages, log and log index for key into place,
+        returns whether there was a usable entry. An entry evicted while
+        being restored counts as a miss, leaving nothing of it behind
+        '''
+        entry = self._entry (key)
+        hit = os.path.exists (entry)
+        if hit:
+            placed = list ()
+            try:
+                if not os.path.exists (package_dir):
+                    os.makedirs (package_dir)
+                for name in os.listdir (entry):
+                    if name.endswith (".pisi"):
+                        target = os.path.join (package_dir, name)
+                        if os.path.lexists (target):
+                            os.unlink (target)
+                        placed.append (target)
+                        _place (os.path.join (entry, name), target)
+                placed.append (log_file)
+                shutil.copy2 (os.path.join (entry, self.LOG_NAME), log_file)
+                # Never leave the index of an older log next to this one
+                placed.append (index_file)
+                if os.path.exists (os.path.join (entry, self.INDEX_NAME)):
+                    shutil.copy2 (os.path.join (entry, self.INDEX_NAME), index_file)
+                elif os.path.exists (index_file):
+                    os.unlink (index_file)
+                # Mark as recently used for anyone pruning the cache
+                os.utime (entry, None)
+            except (IOError, OSError), e:
+                print "Unable to restore cached build: %s" % e
+                for target in placed:
+                    if os.path.lexists (target):
+                        os.unlink (target)
+                hit = False
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return hit
+
+    def store (self, key, package_dir, log_file, index_file):
+        ''' Store the result of a successful build '''
+        entry = self._entry (key)
+        if os.path.exists (entry):
+            return
+        staging = "%s.%d.%f" % (entry, os.getpid (), time.time ())
+        try:
+            os.makedirs (staging)
+            for name in os.listdir (package_dir):
+                if name.endswith (".pisi"):
+                    _place (os.path.join (package_dir, name), os.path.join (staging, name))
+            shutil.copy2 (log_file, os.path.join (staging, self.LOG_NAME))
+            if os.path.exists (index_file):
+                shutil.copy2 (index_file, os.path.join (staging, self.INDEX_NAME))
+            # Only complete entries ever become visible
+            os.rename (staging, entry)
+        except (IOError, OSError), e:
+            print "Unable to cache build: %s" % e
+            shutil.rmtree (staging, ignore_errors=True)
+            return
+        with self.lock:
+            self.stores += 1
+        if self.budget is not None:
+            self.evict ()
+
+    def _entries (self):
+        ''' (last use, size, path) of every complete entry '''
+        entries = list ()
+        for prefix in os.listdir (self.cache_dir):
+            prefix_dir = os.path.join (self.cache_dir, prefix)
+            if not os.path.isdir (prefix_dir):
+                continue
+            for key in os.listdir (prefix_dir):
+                if "." in key:
+                    # Still being stored
+                    continue
+                entry = os.path.join (prefix_dir, key)
+                try:
+                    size = sum (os.path.getsize (os.path.join (entry, name)) for name in os.listdir (entry))
+                    entries.append ((os.stat (entry).st_mtime, size, entry))
+                except OSError:
+                    continue
+        return entries
+
+    def evict (self):
+        ''' Remove the least recently used entries until under budget '''
+        with self.lock:
+            entries = sorted (self._entries ())
+            total = sum (size for mtime, size, entry in entries)
+            for mtime, size, entry in entries:
+                if total <= self.budget:
+                    break
+                shutil.rmtree (entry, ignore_errors=True)
+                total -= size
+                self.evicted += 1
+            return total
+
+    def get_stats (self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stores': self.stores,
+                'evicted': self.evicted,
+                'hit_rate': (float (self.hits) / lookups) if lookups else 0.0,
+            }
@@ -1,82 +1,271 @@
-import sys
-import re
-
-import fcntl
 import os
+import re
+import json
+import select
+import time
 
 from worker import BuildState
 
-def non_blocking_read (output):
-    fd = output.fileno()
-    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-    try:
-        return output.read()
-    except:
-        return ''
-        
 class BuildLogger:
-    
+    '''
+    Multiplex the stdout and stderr of a running build into its log file,
+    reporting phase changes to the callback along the way.
+
+    Both pipes are read in large chunks as soon as they're readable, so a
+    chatty stderr can never fill its pipe and stall the build. Log writes
+    are buffered and flushed every FLUSH_INTERVAL seconds or FLUSH_SIZE bytes.
+
+    Along the way it notes where in the log each phase starts, which patches
+    were applied and the first MAX_ERRORS lines that look like errors, for
+    write_index to save next to the log.
+
+    Given a fatal pattern, the first logged line matching it aborts the
+    build by calling abort (killing the process by default), as there's no
+    point waiting for a build that is certain to fail.
+    '''
+
     ESCAPE = '%s[' % chr(27)
     FORMAT = '1;%dm'
-    
+
+    CHUNK_SIZE = 65536
+    FLUSH_SIZE = 256 * 1024
+    FLUSH_INTERVAL = 1.0
+
+    ANSI_CODES = re.compile (r'\x1b\[([0-9,A-Z]{1,2}(;[0-9]{1,2})?(;[0-9]{3})?)?[m|K]?')
+    # Only ever matched on lines carrying colour codes, order matters
+    PHASES = re.compile (r'(Setting up source)|(Unpacking archive\()|(Applying patch)|(Building source\.)|(Testing package)|(Building source package:)')
+    FETCHING = "Fetching source from:"
+    ERRORS = re.compile (r'(error:|Error \d+|undefined reference to|command not found|Traceback \(most recent call last\)|^ERROR|fatal:)', re.MULTILINE)
+    # Literal parts of ERRORS, a chunk without any of them can't match it
+    ERROR_TOKENS = ("error:", "Error ", "undefined reference to", "command not found", "Traceback (", "ERROR", "fatal:")
+    MAX_ERRORS = 20
+    MAX_ERROR_LINE = 512
+
+    INDEX_SUFFIX = ".index"
+
+    @staticmethod
+    def index_file (log_file):
+        ''' Path of the index for the log at log_file '''
+        return log_file + BuildLogger.INDEX_SUFFIX
+
+    @staticmethod
+    def load_index (log_file):
+        ''' The index written for the log at log_file, or None '''
+        try:
+            with open (BuildLogger.index_file (log_file), "r") as index:
+                return json.load (index)
+        except (IOError, ValueError):
+            return None
+
     def strip_ansi_codes(self, s):
-        return re.sub(r'\x1b\[([0-9,A-Z]{1,2}(;[0-9]{1,2})?(;[0-9]{3})?)?[m|K]?', '', s)
-        
-    def __init__(self,process, logfile, callback):
-        started = False
-        canWrite = True
-        while True:
-            stdout = process.stdout.readline()
-            if process.poll() != None:
+        if self.ESCAPE not in s:
+            return s
+        return self.ANSI_CODES.sub ('', s)
+
+    def __init__(self, process, logfile, callback, fatal=None, abort=None):
+        self.logfile = logfile
+        self.callback = callback
+        self.fatal = fatal
+        self.abort = abort if abort is not None else process.kill
+        # The line that aborted the build
+        self.aborted = None
+        self.started = False
+        self.canWrite = True
+
+        self.pending = list ()
+        self.pending_size = 0
+        self.last_flush = time.time ()
+
+        # Bytes written to the log so far, so where the next write lands
+        self.written = 0
+        self.phases = list ()
+        self.patches = list ()
+        self.errors = list ()
+
+        self._run (process)
+
+    def _write (self, data):
+        if not data:
+            return
+        if len (self.errors) < self.MAX_ERRORS:
+            # Substring tests are far cheaper than running ERRORS over everything
+            for token in self.ERROR_TOKENS:
+                if token in data:
+                    self._scan_errors (data)
+                    break
+        if self.fatal is not None and self.aborted is None:
+            self._check_fatal (data)
+        self.written += len (data)
+        self.pending.append (data)
+        self.pending_size += len (data)
+        if self.pending_size >= self.FLUSH_SIZE:
+            self._flush ()
+
+    def _flush (self):
+        if self.pending:
+            self.logfile.write ("".join (self.pending))
+            self.pending = list ()
+            self.pending_size = 0
+        self.logfile.flush ()
+        self.last_flush = time.time ()
+
+    def _scan_errors (self, data):
+        ''' Note the lines of data (about to be written) that look like errors '''
+        last = -1
+        for match in self.ERRORS.finditer (data):
+            start = data.rfind ("\n", 0, match.start ()) + 1
+            if start == last:
+                continue
+            last = start
+            end = data.find ("\n", match.end ())
+            line = data[start:end if end >= 0 else len (data)][:self.MAX_ERROR_LINE]
+            self.errors.append ({
+                'offset': self.written + start,
+                'phase': self.phases[-1]['phase'] if self.phases else "",
+                'line': line.decode ("utf-8", "replace"),
+            })
+            if len (self.errors) >= self.MAX_ERRORS:
                 break
 
-            stderr = non_blocking_read (process.stderr)
-                        
-            if self.ESCAPE in stdout:
-                if "Setting up source" in stdout:
+    def _check_fatal (self, data):
+        match = self.fatal.search (data)
+        if match is None:
+            return
+        start = data.rfind ("\n", 0, match.start ()) + 1
+        end = data.find ("\n", match.end ())
+        self.aborted = data[start:end if end >= 0 else len (data)][:self.MAX_ERROR_LINE]
+        print "ABORTING: %s" % self.aborted
+        try:
+            self.abort ()
+        except OSError:
+            # Already gone
+            pass
+
+    def _enter_phase (self, state):
+        ''' Phases start where the line announcing them will be written '''
+        phase = BuildState.reverse_mapping[state]
+        if self.phases and self.phases[-1]['phase'] == phase:
+            return
+        self.phases.append ({ 'phase': phase, 'offset': self.written })
+
+    def write_index (self, index_file, returncode):
+        '''
+        Save what was noted about the (finished) log to index_file: the
+        byte range of each phase, the patches and the first error lines
+        '''
+        phases = list ()
+        for i, phase in enumerate (self.phases):
+            end = self.phases[i + 1]['offset'] if i + 1 < len (self.phases) else self.written
+            phases.append ({ 'phase': phase['phase'], 'offset': phase['offset'], 'end': end })
+        index = {
+            'size': self.written,
+            'returncode': returncode,
+            'phases': phases,
+            'patches': self.patches,
+            'errors': self.errors,
+            'aborted': self.aborted.decode ("utf-8", "replace") if self.aborted is not None else "",
+        }
+        staging = "%s.new" % index_file
+        with open (staging, "w") as output:
+            json.dump (index, output)
+        os.rename (staging, index_file)
+
+    def _handle_line (self, line):
+        ''' Phase detection for a single (complete) line of stdout '''
+        if self.ESCAPE in line:
+            match = self.PHASES.search (line)
+            if match is not None:
+                phase = match.lastindex
+                if phase == 1:
                     print "CONFIGURING"
-                    callback (BuildState.CONFIGURING)
-                    
-                elif "Unpacking archive(" in stdout:
+                    self._enter_phase (BuildState.CONFIGURING)
+                    self.callback (BuildState.CONFIGURING)
+                elif phase == 2:
                     print "UNPACKING"
-                    started = True
-                    canWrite = True
-                    callback (BuildState.UNPACKING)
-                    
-                elif "Applying patch" in stdout:
-                    patch = stdout.split (":")[1].strip()
+                    self.started = True
+                    self.canWrite = True
+                    self._enter_phase (BuildState.UNPACKING)
+                    self.callback (BuildState.UNPACKING)
+                elif phase == 3:
+                    patch = self.strip_ansi_codes (line).split (":")[1].strip()
                     print "PATCHING: %s" % patch
-                    callback (BuildState.PATCHING, patch)
-                    
-                elif "Building source." in stdout:
+                    self._enter_phase (BuildState.PATCHING)
+                    self.patches.append ({ 'patch': patch.decode ("utf-8", "replace"), 'offset': self.written })
+                    self.callback (BuildState.PATCHING, patch)
+                elif phase == 4:
                     print "BUILDING"
-                    callback (BuildState.BUILDING)
-                    
-                elif "Testing package" in stdout:
+                    self._enter_phase (BuildState.BUILDING)
+                    self.callback (BuildState.BUILDING)
+                elif phase == 5:
                     print "TESTING"
-                    callback (BuildState.TESTING)
-                    
-                elif "Building source package:" in stdout:
+                    self._enter_phase (BuildState.TESTING)
+                    self.callback (BuildState.TESTING)
+                elif phase == 6:
                     print "STARTING"
-                    callback (BuildState.STARTED)
-                    
-            else:
-                if "Fetching source from:" in stdout and not started:
-                    archive = ":".join (stdout.split (":")[1:]).strip()
-                    stripped = self.strip_ansi_codes (stdout)
-                    logfile.write (stripped)
-                    print "DOWNLOADING: %s" % archive
-                    canWrite = False
-                    callback (BuildState.FETCHING, archive)
-                    
-            stdout = self.strip_ansi_codes (stdout)
-            stderr = self.strip_ansi_codes (stderr)
-            
-            if canWrite:
-                logfile.write (stdout)
-            
-            if stderr != '':
-                logfile.write (stderr)
-            
-            logfile.flush ()
+                    self._enter_phase (BuildState.STARTED)
+                    self.callback (BuildState.STARTED)
+        elif self.FETCHING in line and not self.started:
+            archive = ":".join (line.split (":")[1:]).strip()
+            self._enter_phase (BuildState.FETCHING)
+            self._write (line)
+            print "DOWNLOADING: %s" % archive
+            # Skip the download progress until unpacking starts
+            self.canWrite = False
+            self.callback (BuildState.FETCHING, archive)
+            return
+
+        if self.canWrite:
+            self._write (self.strip_ansi_codes (line))
+
+    def _handle_stdout (self, data):
+        # Fast path: nothing in here could change phase
+        if self.ESCAPE not in data and self.FETCHING not in data:
+            if self.canWrite:
+                self._write (data)
+            return
+        for line in data.splitlines (True):
+            self._handle_line (line)
+
+    def _handle_stderr (self, data):
+        self._write (self.strip_ansi_codes (data))
+
+    def _run (self, process):
+        handlers = {
+            process.stdout.fileno (): self._handle_stdout,
+            process.stderr.fileno (): self._handle_stderr,
+        }
+        # Incomplete trailing lines, held back until the rest arrives
+        partial = dict ((fd, "") for fd in handlers)
+
+        poller = select.poll ()
+        for fd in handlers:
+            poller.register (fd, select.POLLIN | select.POLLPRI)
+
+        open_fds = len (handlers)
+        while open_fds > 0:
+            try:
+                events = poller.poll (self.FLUSH_INTERVAL * 1000)
+            except select.error:
+                # EINTR
+                continue
+            for fd, event in events:
+                data = os.read (fd, self.CHUNK_SIZE)
+                if not data:
+                    poller.unregister (fd)
+                    open_fds -= 1
+                    handlers[fd] (partial[fd])
+                    partial[fd] = ""
+                    continue
+                data = partial[fd] + data
+                split = data.rfind ("\n") + 1
+                if split == 0 and len (data) < self.CHUNK_SIZE:
+                    partial[fd] = data
+                    continue
+                if split == 0:
+                    # Absurdly long line, don't let it grow forever
+                    split = len (data)
+                partial[fd] = data[split:]
+                handlers[fd] (data[:split])
+            if time.time () - self.last_flush >= self.FLUSH_INTERVAL:
+                self._flush ()
+        self._flush ()
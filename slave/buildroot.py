@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+'''
+Isolated, throwaway build roots layered over the worker system
+'''
+import os
+import os.path
+import shutil
+import threading
+import time
+
+from solusos.system import SystemManager
+from solusos.mounts import MountManager
+
+def _reap (path):
+    shutil.rmtree (path, ignore_errors=True)
+
+class BuildRoot:
+    '''
+    An overlay of the (mounted) worker system, in which a single package
+    is built. Changes never reach the worker system itself.
+    '''
+
+    def __init__(self, base, roots_dir, name):
+        self.base = base
+        self.name = name
+        self.roots_dir = roots_dir
+        self.root_dir = os.path.join (roots_dir, name)
+        self.upper_dir = os.path.join (self.root_dir, "upper")
+        self.overlay_work = os.path.join (self.root_dir, "work")
+        self.path = os.path.join (self.root_dir, "root")
+        self.mounts = list ()
+
+    def _mount (self, device, target, filesystem=None, options=None):
+        if not os.path.exists (target):
+            os.makedirs (target)
+        if not SystemManager.mount (device, target, filesystem=filesystem, options=options):
+            print "Unable to mount %s" % target
+            return False
+        self.mounts.append (target)
+        return True
+
+    def _discard (self):
+        # Never delete while something is mounted, binds lead back into the base
+        SystemManager.umount (self.path, recursive=True)
+        if MountManager.mounts_below (self.root_dir, include_self=False):
+            print "Not discarding busy build root: %s" % self.root_dir
+            return False
+        if not os.path.exists (self.root_dir):
+            return True
+        # Renaming is instant, the actual deletion happens in the background
+        trash_dir = os.path.join (self.roots_dir, SnapshotManager.TRASH)
+        if not os.path.exists (trash_dir):
+            os.makedirs (trash_dir)
+        trash = os.path.join (trash_dir, "%s.%f" % (self.name, time.time ()))
+        os.rename (self.root_dir, trash)
+        reaper = threading.Thread (target=_reap, args=(trash,))
+        reaper.daemon = True
+        reaper.start ()
+        return True
+
+    def create (self, binds=(), host_binds=()):
+        '''
+        Mount the overlay along with its virtual filesystems. binds is a list
+        of paths (relative to the base) shared read-write with the base,
+        host_binds a list of (host path, path in the root) to share. Returns
+        whether it all got mounted, leaving nothing behind if not
+        '''
+        if not self._discard ():
+            return False
+        for item in [self.upper_dir, self.overlay_work, self.path]:
+            os.makedirs (item)
+
+        options = "lowerdir=%s,upperdir=%s,workdir=%s" % (self.base, self.upper_dir, self.overlay_work)
+        mounts = [("overlay", self.path, "overlay", options),
+                  ("proc", os.path.join (self.path, "proc"), "proc", None),
+                  ("tmpfs", os.path.join (self.path, "dev/shm"), "tmpfs", None)]
+        for bind in binds:
+            mounts.append ((os.path.join (self.base, bind), os.path.join (self.path, bind), None, "bind"))
+        for source, target in host_binds:
+            mounts.append ((source, os.path.join (self.path, target), None, "bind"))
+        for device, target, filesystem, options in mounts:
+            # Nothing may be mounted, or written, outside of the overlay
+            if not self._mount (device, target, filesystem=filesystem, options=options):
+                self.release ()
+                return False
+        return True
+
+    def release (self, keep=False):
+        '''
+        Unmount the root. Unless keep is set, the upper layer is thrown away
+        '''
+        for target in reversed (self.mounts):
+            SystemManager.umount (target)
+        self.mounts = list ()
+        if not keep:
+            self._discard ()
+
+class SnapshotManager:
+    '''
+    Hands out copy-on-write BuildRoots over the worker system. While sealed,
+    the worker system itself is read-only apart from the SHARED directories,
+    so a clean root is only ever an empty upper layer away.
+    '''
+
+    TRASH = ".trash"
+    SHARED = ["work_dir", "log_dir"]
+
+    def __init__(self, base, storage):
+        self.base = base
+        self.roots_dir = os.path.join (storage, "roots")
+        self.trash_dir = os.path.join (self.roots_dir, self.TRASH)
+        self.sealed = False
+
+    def seal (self):
+        ''' Make the base read-only, keeping the SHARED directories writable '''
+        for shared in self.SHARED:
+            path = os.path.join (self.base, shared)
+            if not os.path.exists (path):
+                os.makedirs (path)
+            # A bind mount over itself keeps its own (writable) mount flags
+            SystemManager.mount (path, path, options="bind")
+        SystemManager.mount (self.base, self.base, options="remount,bind,ro")
+        self.sealed = True
+
+    def unseal (self):
+        ''' Make the base writable again '''
+        if not self.sealed:
+            return
+        SystemManager.mount (self.base, self.base, options="remount,bind,rw")
+        for shared in reversed (self.SHARED):
+            SystemManager.umount (os.path.join (self.base, shared))
+        self.sealed = False
+
+    def get_root (self, name):
+        ''' A (not yet created) BuildRoot for the given package '''
+        return BuildRoot (self.base, self.roots_dir, name)
+
+    def reset (self):
+        '''
+        Discard every build root, including stale ones left behind by a
+        crash or kept around for inspection
+        '''
+        if not os.path.exists (self.trash_dir):
+            os.makedirs (self.trash_dir)
+        for name in os.listdir (self.roots_dir):
+            if name != self.TRASH:
+                self.get_root (name)._discard ()
+        # Finish off anything a previous run didn't get to
+        for name in os.listdir (self.trash_dir):
+            reaper = threading.Thread (target=_reap, args=(os.path.join (self.trash_dir, name),))
+            reaper.daemon = True
+            reaper.start ()
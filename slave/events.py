@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+'''
+Progress events of the whole slave, for clients to long-poll
+'''
+import time
+import uuid
+import threading
+from collections import deque
+
+class EventStream:
+    '''
+    The last KEEP events (imaging progress, worker states, build phases,
+    queue positions, syncs and jobs) numbered in order. A client asks for
+    everything after the last number it saw, waiting for new events if
+    there are none, so that one outstanding call replaces all polling.
+
+    The stream ID changes when the slave restarts, and missed is set when
+    events a client hasn't seen were already dropped: either way it should
+    refresh its view of the slave before carrying on.
+    '''
+
+    KEEP = 4096
+    MAX_EVENTS = 512
+    MAX_TIMEOUT = 60
+
+    def __init__(self):
+        self.id = uuid.uuid4 ().hex
+        self.condition = threading.Condition ()
+        self.events = deque (maxlen=self.KEEP)
+        self.seq = 0
+
+    def publish (self, kind, **fields):
+        ''' Add an event of type kind, returns its sequence number '''
+        with self.condition:
+            self.seq += 1
+            event = { 'seq': self.seq, 'time': time.time (), 'type': kind }
+            for key, value in fields.iteritems ():
+                # XML-RPC has no None
+                if value is not None:
+                    event[key] = value
+            self.events.append (event)
+            self.condition.notify_all ()
+            return self.seq
+
+    def since (self, seq, timeout=0, stream=None):
+        '''
+        Events after seq, waiting up to timeout seconds for some to arrive
+        '''
+        timeout = min (max (0, timeout), self.MAX_TIMEOUT)
+        deadline = time.time () + timeout
+        with self.condition:
+            if stream is not None and stream != self.id:
+                # From before a restart, numbers mean nothing any more
+                seq = 0
+            while self.seq <= seq:
+                remaining = deadline - time.time ()
+                if remaining <= 0:
+                    break
+                self.condition.wait (remaining)
+            first = self.events[0]['seq'] if self.events else self.seq + 1
+            missed = (stream is not None and stream != self.id) or seq + 1 < first
+            events = [event for event in self.events if event['seq'] > seq][:self.MAX_EVENTS]
+            return {
+                'stream': self.id,
+                'seq': events[-1]['seq'] if events else max (seq, 0),
+                'missed': missed,
+                'events': events,
+            }
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+'''
+Long running Worker operations as jobs, submitted over XML-RPC and polled
+for rather than waited on
+'''
+import time
+import uuid
+import threading
+import Queue
+from collections import OrderedDict
+from SimpleXMLRPCServer import resolve_dotted_attribute
+
+from worker import enum
+
+JobState = enum ('QUEUED', 'RUNNING', 'DONE', 'FAILED', 'CANCELLED')
+
+class Job:
+
+    def __init__(self, slot, method, params, call):
+        self.id = uuid.uuid4 ().hex
+        self.slot = slot
+        self.method = method
+        self.params = params
+        self.call = call
+        self.state = JobState.QUEUED
+        self.result = None
+        self.error = ""
+        self.submitted = time.time ()
+        self.started = 0.0
+        self.finished = 0.0
+
+    def to_dict (self):
+        job = {
+            'id': self.id,
+            'slot': self.slot,
+            'method': self.method,
+            'state': JobState.reverse_mapping[self.state],
+            'error': self.error,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+        }
+        # XML-RPC has no None
+        if self.result is not None:
+            job['result'] = self.result
+        return job
+
+class JobExecutor:
+    '''
+    Runs jobs on the Worker of their slot, one at a time per slot in the
+    order they were submitted. A job waits for any operation already
+    running on its worker (i.e. a plain RPC) to finish, then holds the
+    worker so that no RPC can start anything until it's done.
+    The most recent KEEP finished jobs are kept around to be polled for.
+
+    tasks are operations of the whole slave (e.g. update_media) by name.
+    They run one at a time on a queue of their own, as slot -1, each
+    holding every worker.
+    '''
+
+    KEEP = 256
+    # Seconds between checks for cancellation while waiting for a worker
+    WAIT_INTERVAL = 1.0
+
+    def __init__(self, workers, events=None, tasks=None):
+        self.workers = workers
+        self.events = events
+        self.tasks = tasks if tasks is not None else dict ()
+        self.lock = threading.Lock ()
+        self.jobs = OrderedDict ()
+        self.queues = list ()
+        for slot, worker in enumerate (workers):
+            self.queues.append (self._start_queue ([worker]))
+        self.task_queue = self._start_queue (workers)
+
+    def _start_queue (self, workers):
+        ''' A queue of jobs, run in order once all of workers are free '''
+        queue = Queue.Queue ()
+        thread = threading.Thread (target=self._run, args=(workers, queue))
+        thread.daemon = True
+        thread.start ()
+        return queue
+
+    def submit (self, method, params, slot=0):
+        '''
+        Queue method (a public Worker method, or one of tasks) to be called
+        with params on the worker in slot, returns the job ID
+        '''
+        if method in self.tasks:
+            job = Job (-1, method, list (params), self.tasks[method])
+            queue = self.task_queue
+        else:
+            if slot < 0 or slot >= len (self.workers):
+                raise Exception ('slot "%s" is not supported' % slot)
+            worker = self.workers[slot]
+            # Refuses private (_ prefixed) and dotted names, as the server would
+            call = resolve_dotted_attribute (worker, method, False)
+            job = Job (slot, method, list (params), call)
+            queue = self.queues[slot]
+        with self.lock:
+            self.jobs[job.id] = job
+            self._expire ()
+        self._publish (job)
+        queue.put (job)
+        return job.id
+
+    def _publish (self, job):
+        if self.events is not None:
+            self.events.publish ("job", id=job.id, slot=job.slot, method=job.method,
+                                 state=JobState.reverse_mapping[job.state], error=job.error or None)
+
+    def _expire (self):
+        finished = [job_id for job_id, job in self.jobs.iteritems () if job.state in (JobState.DONE, JobState.FAILED, JobState.CANCELLED)]
+        for job_id in finished[:max (0, len (finished) - self.KEEP)]:
+            del self.jobs[job_id]
+
+    def _reserve_workers (self, workers, job):
+        '''
+        Wait for workers to be free and hold them for job (see
+        Worker._reserve), returns False if job was cancelled meanwhile
+        '''
+        reserved = list ()
+        for worker in workers:
+            while not worker._reserve (self.WAIT_INTERVAL):
+                with self.lock:
+                    cancelled = job.state != JobState.QUEUED
+                if cancelled:
+                    for held in reserved:
+                        held._unreserve ()
+                    return False
+            reserved.append (worker)
+        return True
+
+    def _run (self, workers, queue):
+        while True:
+            job = queue.get ()
+            if not self._reserve_workers (workers, job):
+                continue
+            try:
+                with self.lock:
+                    if job.state != JobState.QUEUED:
+                        # Cancelled while waiting
+                        continue
+                    job.state = JobState.RUNNING
+                    job.started = time.time ()
+                self._publish (job)
+                try:
+                    result = job.call (*job.params)
+                    if result is not False:
+                        error = ""
+                    elif job.slot < 0:
+                        error = "%s failed" % job.method
+                    else:
+                        error = str (workers[0].errors or "")
+                except Exception, e:
+                    result = None
+                    error = str (e)
+            finally:
+                for worker in workers:
+                    worker._unreserve ()
+            with self.lock:
+                job.result = result
+                job.error = error
+                job.finished = time.time ()
+                if job.state != JobState.CANCELLED:
+                    job.state = JobState.FAILED if error or result is False else JobState.DONE
+            self._publish (job)
+
+    def get (self, job_id):
+        with self.lock:
+            job = self.jobs.get (job_id)
+            return job.to_dict () if job is not None else None
+
+    def list (self):
+        with self.lock:
+            return [job.to_dict () for job in self.jobs.itervalues ()]
+
+    def cancel (self, job_id):
+        '''
+        Cancel a queued job, or ask the worker running it to stop (see
+        Worker.cancel). Returns whether there was anything to cancel
+        '''
+        with self.lock:
+            job = self.jobs.get (job_id)
+            if job is None or job.state not in (JobState.QUEUED, JobState.RUNNING):
+                return False
+            running = job.state == JobState.RUNNING
+            if not running:
+                job.state = JobState.CANCELLED
+                job.finished = time.time ()
+        if running:
+            # Tasks can't be stopped halfway
+            if job.slot < 0 or not self.workers[job.slot].cancel ():
+                return False
+            with self.lock:
+                if job.state == JobState.RUNNING:
+                    job.state = JobState.CANCELLED
+        self._publish (job)
+        return True
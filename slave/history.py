@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+'''
+Resource usage of every build, kept across runs for capacity planning
+'''
+import os
+import os.path
+import json
+import time
+import threading
+
+from worker import BuildState
+from shared import SharedStore
+
+class BuildProfile:
+    '''
+    Wall time per BuildState phase of a single build, fed from the
+    BuildLogger callbacks, along with the resource usage of the build
+    once it has finished.
+    '''
+
+    def __init__(self, name, version):
+        self.name = name
+        self.version = version
+        self.started = time.time ()
+        self.phase = BuildState.STARTED
+        self.phase_started = self.started
+        self.phases = dict ()
+        self.usage = None
+        self.result = None
+        self.finished = None
+
+    def enter (self, state):
+        ''' Start timing state, None once the build is over '''
+        now = time.time ()
+        if state == self.phase or self.phase is None:
+            return
+        name = BuildState.reverse_mapping[self.phase]
+        self.phases[name] = self.phases.get (name, 0.0) + (now - self.phase_started)
+        self.phase = state
+        self.phase_started = now
+
+    def wrap (self, callback):
+        ''' A BuildLogger callback that times phases before passing them on '''
+        def profiled_callback (state, extra=None):
+            self.enter (state)
+            if extra is None:
+                callback (state)
+            else:
+                callback (state, extra)
+        return profiled_callback
+
+    def finish (self, result, usage):
+        ''' Close the last phase, usage being the resource.struct_rusage of the build '''
+        self.enter (None)
+        self.result = result
+        self.usage = usage
+        self.finished = time.time ()
+
+    def record (self):
+        ''' The build as stored in the history '''
+        record = {
+            'name': self.name,
+            'version': self.version,
+            'result': bool (self.result),
+            'started': self.started,
+            'wall': self.finished - self.started,
+            'phases': self.phases,
+            'cpu_user': 0.0,
+            'cpu_system': 0.0,
+            'max_rss': 0,
+            'read_bytes': 0,
+            'write_bytes': 0,
+        }
+        if self.usage is not None:
+            record['cpu_user'] = self.usage.ru_utime
+            record['cpu_system'] = self.usage.ru_stime
+            # ru_maxrss is in kilobytes on Linux, the block counts in 512 byte blocks
+            record['max_rss'] = self.usage.ru_maxrss * 1024
+            record['read_bytes'] = self.usage.ru_inblock * 512
+            record['write_bytes'] = self.usage.ru_oublock * 512
+        return record
+
+class BuildHistory (SharedStore):
+    '''
+    The last build record of every package version, as an append-only file
+    of JSON lines. Newer lines replace older ones for the same version, and
+    the file is rewritten once superseded lines make up most of it.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock ()
+        self.records = dict ()
+        self.lines = 0
+        directory = os.path.dirname (self.path)
+        if not os.path.exists (directory):
+            os.makedirs (directory)
+        self._load ()
+
+    def _load (self):
+        if not os.path.exists (self.path):
+            return
+        line = "\n"
+        with open (self.path, "r") as history:
+            for line in history:
+                try:
+                    record = json.loads (line)
+                    self.records[(record['name'], record['version'])] = record
+                except (ValueError, KeyError, TypeError):
+                    # Torn write from a crash, the rest is still good
+                    continue
+                self.lines += 1
+        if not line.endswith ("\n"):
+            # Or the next record would be appended to the torn one
+            with open (self.path, "a") as history:
+                history.write ("\n")
+
+    def _compact (self):
+        staging = "%s.new" % self.path
+        with open (staging, "w") as history:
+            for key in sorted (self.records):
+                history.write ("%s\n" % json.dumps (self.records[key], separators=(",", ":"), sort_keys=True))
+        os.rename (staging, self.path)
+        self.lines = len (self.records)
+
+    def add (self, record):
+        with self.lock:
+            self.records[(record['name'], record['version'])] = record
+            with open (self.path, "a") as history:
+                history.write ("%s\n" % json.dumps (record, separators=(",", ":"), sort_keys=True))
+            self.lines += 1
+            if self.lines > 2 * len (self.records) + 64:
+                self._compact ()
+
+    def latest (self, name):
+        ''' The most recent record of any version of name, or None '''
+        with self.lock:
+            records = [record for key, record in self.records.iteritems () if key[0] == name]
+        if not records:
+            return None
+        return dict (max (records, key=lambda record: record['started']))
+
+    def query (self, name=None, count=0):
+        '''
+        Records for the package name (every version of it), or for all
+        packages if name is None, the most expensive (by wall time) first
+        '''
+        with self.lock:
+            records = [dict (record) for key, record in self.records.iteritems () if name is None or key[0] == name]
+        records.sort (key=lambda record: record['wall'], reverse=True)
+        if count > 0:
+            records = records[:count]
+        return records
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''
+Choosing the make job count of each build
+'''
+import os
+import threading
+import multiprocessing
+
+class JobPlanner:
+    '''
+    Picks the job count of a build from its last profile in the build
+    history, the load average and the memory available right now.
+
+    Jobs are handed out from a budget shared by every build on the host
+    (every slot), so concurrent builds can't add up to more than cap.
+    '''
+
+    # Below this much CPU time, more jobs cost more to set up than they save
+    SMALL_BUILD = 60.0
+    SMALL_JOBS = 2
+    # Memory per job for packages we know nothing about
+    DEFAULT_JOB_MEMORY = 512 * 1024 * 1024
+
+    lock = threading.Lock ()
+    in_use = 0
+
+    def __init__(self, history, cap=None):
+        self.history = history
+        self.cpus = multiprocessing.cpu_count ()
+        self.cap = cap if cap is not None else self.cpus + 1
+
+    def _available_memory (self):
+        try:
+            with open ("/proc/meminfo", "r") as meminfo:
+                for line in meminfo:
+                    if line.startswith ("MemAvailable:"):
+                        return int (line.split ()[1]) * 1024
+        except (IOError, ValueError):
+            pass
+        return None
+
+    def wanted (self, name):
+        ''' The jobs a build of package name should get, ignoring the budget '''
+        jobs = self.cap
+        try:
+            jobs = min (jobs, int (self.cpus - os.getloadavg ()[0]) + 1)
+        except OSError:
+            pass
+
+        job_memory = self.DEFAULT_JOB_MEMORY
+        record = self.history.latest (name)
+        if record is not None:
+            if record['cpu_user'] + record['cpu_system'] < self.SMALL_BUILD:
+                jobs = min (jobs, self.SMALL_JOBS)
+            # The peak RSS is that of the biggest single process, i.e. one job
+            job_memory = max (job_memory, record['max_rss'])
+
+        memory = self._available_memory ()
+        if memory is not None:
+            jobs = min (jobs, memory / job_memory)
+        return max (1, jobs)
+
+    def acquire (self, name):
+        ''' Reserve jobs for a build of name, to be given back with release() '''
+        wanted = self.wanted (name)
+        with JobPlanner.lock:
+            # Every build gets at least one, even over budget
+            jobs = max (1, min (wanted, self.cap - JobPlanner.in_use))
+            JobPlanner.in_use += jobs
+        return jobs
+
+    def release (self, jobs):
+        with JobPlanner.lock:
+            JobPlanner.in_use -= jobs
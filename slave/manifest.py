@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Per-file manifests of a system root, used to apply only what changed
+between two versions of the backing image
+'''
+import os
+import os.path
+import stat
+import json
+import time
+import multiprocessing
+
+from solusos.download import file_checksum
+
+# Entry fields
+KIND, MODE, UID, GID, SIZE, MTIME, DATA, CTIME = range (8)
+
+def _hash_file (path):
+    ''' sha1 of path, None if it can't be read. For Pool.map '''
+    try:
+        return file_checksum (path)
+    except IOError:
+        return None
+
+class MediaManifest:
+    '''
+    Maps every path (relative to the root) to a list of
+        [kind, mode, uid, gid, size, mtime, data, ctime]
+    where kind is f(ile), d(irectory), l(ink) or o(ther), and data is the
+    sha1 of a file (None if never hashed), or the target of a link, and
+    ctime is None if it was too recent to trust.
+    '''
+
+    def __init__(self, entries=None):
+        self.entries = entries if entries is not None else dict ()
+
+    @staticmethod
+    def load (path):
+        if not os.path.exists (path):
+            return None
+        with open (path, "r") as manifest:
+            return MediaManifest (json.load (manifest))
+
+    def save (self, path):
+        staging = "%s.new" % path
+        with open (staging, "w") as manifest:
+            json.dump (self.entries, manifest, separators=(",", ":"))
+        os.rename (staging, path)
+
+    @staticmethod
+    def scan (root, previous=None, hash_files=True, processes=None, exact=False):
+        '''
+        Build the manifest of root. Files whose size and mtime match the
+        previous manifest keep its digest, the rest are hashed in parallel
+        (unless hash_files is False). With exact, the ctime has to match
+        too, so that anything written since the previous scan of this same
+        root is hashed again whatever its mtime says. A ctime within the
+        second the scan started isn't kept, as the filesystem may only store
+        whole seconds and a write later in that second would go unseen.
+        '''
+        started = int (time.time ())
+        entries = dict ()
+        to_hash = list ()
+        for dirpath, dirnames, filenames in os.walk (root):
+            for name in dirnames + filenames:
+                fpath = os.path.join (dirpath, name)
+                rel = os.path.relpath (fpath, root)
+                st = os.lstat (fpath)
+                ctime = st.st_ctime if int (st.st_ctime) < started else None
+                entry = [None, stat.S_IMODE (st.st_mode), st.st_uid, st.st_gid, 0, 0, None, ctime]
+                if stat.S_ISDIR (st.st_mode):
+                    entry[KIND] = "d"
+                elif stat.S_ISLNK (st.st_mode):
+                    entry[KIND] = "l"
+                    entry[DATA] = os.readlink (fpath)
+                elif stat.S_ISREG (st.st_mode):
+                    entry[KIND] = "f"
+                    entry[SIZE] = st.st_size
+                    entry[MTIME] = int (st.st_mtime)
+                    old = previous.entries.get (rel) if previous is not None else None
+                    if old is not None and old[KIND] == "f" and old[SIZE] == entry[SIZE] and old[MTIME] == entry[MTIME] \
+                            and (not exact or (old[CTIME] is not None and old[CTIME] == entry[CTIME])):
+                        entry[DATA] = old[DATA]
+                    elif hash_files:
+                        to_hash.append (rel)
+                else:
+                    entry[KIND] = "o"
+                    entry[DATA] = "%d:%d" % (st.st_mode, st.st_rdev)
+                entries[rel] = entry
+
+        manifest = MediaManifest (entries)
+        manifest._hash (root, to_hash, processes)
+        return manifest
+
+    def _hash (self, root, paths, processes=None):
+        ''' Hash the files at paths (relative to root) in parallel '''
+        if not paths:
+            return
+        pool = multiprocessing.Pool (processes or multiprocessing.cpu_count ())
+        try:
+            digests = pool.map (_hash_file, [os.path.join (root, rel) for rel in paths], chunksize=64)
+        finally:
+            pool.close ()
+            pool.join ()
+        for rel, digest in zip (paths, digests):
+            self.entries[rel][DATA] = digest
+
+    @staticmethod
+    def _same (old, new):
+        if old[:SIZE] != new[:SIZE]:
+            return False
+        if new[KIND] != "f":
+            return old[DATA] == new[DATA]
+        if old[DATA] is not None and new[DATA] is not None:
+            return old[DATA] == new[DATA]
+        # Unhashed on one side, size and mtime are all we have
+        return old[SIZE] == new[SIZE] and old[MTIME] == new[MTIME]
+
+    def diff (self, new):
+        '''
+        Compare against a newer manifest. Returns (changed, removed): paths
+        to apply from the new root, and paths no longer in it (deepest first)
+        '''
+        changed = list ()
+        for rel, entry in new.entries.iteritems ():
+            old = self.entries.get (rel)
+            if old is None or not self._same (old, entry):
+                changed.append (rel)
+        removed = [rel for rel in self.entries if rel not in new.entries]
+        removed.sort (key=lambda rel: rel.count ("/"), reverse=True)
+        return (sorted (changed), removed)
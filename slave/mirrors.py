@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+'''
+Local mirrors of source repositories, kept on the host across queues
+'''
+import os
+import os.path
+import shutil
+import hashlib
+import threading
+import subprocess
+
+VCS_TYPES = ["git", "mercurial"]
+
+def _call (cmd):
+    return subprocess.call (cmd) == 0
+
+def _output (cmd):
+    p = subprocess.Popen (cmd, stdout=subprocess.PIPE)
+    output = p.communicate ()[0]
+    return output.strip () if p.returncode == 0 else None
+
+class RepoMirror:
+    '''
+    A mirror of a remote repository (git or mercurial) on the host. Each
+    update only pulls in what's new, and working copies are checked out from
+    the mirror rather than the remote: git ones sharing its objects, so a
+    repeat checkout is a local fetch and a checkout of what changed.
+
+    Mirrors are shared between every slot, one at a time.
+    '''
+
+    _locks = dict ()
+    _locks_lock = threading.Lock ()
+
+    def __init__(self, mirror_dir, uri, vcs, username=None, password=None):
+        self.uri = uri
+        self.vcs = vcs
+        self.remote = uri
+        if username is not None and password is not None:
+            parts = uri.split ("//")
+            self.remote = "%s//%s:%s@%s" % (parts[0], username, password, parts[1])
+        self.name = os.path.basename (uri.rstrip ("/"))
+        if self.name.endswith (".git"):
+            self.name = self.name[:-4]
+        if not os.path.exists (mirror_dir):
+            os.makedirs (mirror_dir)
+        self.path = os.path.join (mirror_dir, "%s.%s" % (hashlib.sha1 (uri).hexdigest ()[:16], vcs))
+        with RepoMirror._locks_lock:
+            self.lock = RepoMirror._locks.setdefault (self.path, threading.Lock ())
+
+    def _clone_mirror (self, target):
+        if self.vcs == "git":
+            return _call (["git", "clone", "--mirror", "--quiet", self.remote, target])
+        return _call (["hg", "clone", "--noupdate", "--quiet", self.remote, target])
+
+    def _pull_mirror (self):
+        if self.vcs == "git":
+            return _call (["git", "--git-dir", self.path, "fetch", "--prune", "--quiet", self.remote,
+                           "+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"])
+        return _call (["hg", "pull", "--quiet", "-R", self.path, self.remote])
+
+    def update (self):
+        ''' Bring the mirror up to date with the remote, cloning it the first time '''
+        with self.lock:
+            if os.path.exists (self.path):
+                if self._pull_mirror ():
+                    return True
+                print "Unable to update mirror of %s, cloning it again" % self.uri
+                shutil.rmtree (self.path)
+            staging = "%s.new" % self.path
+            if os.path.exists (staging):
+                shutil.rmtree (staging)
+            if not self._clone_mirror (staging):
+                shutil.rmtree (staging, ignore_errors=True)
+                return False
+            os.rename (staging, self.path)
+            return True
+
+    def _origin (self, target):
+        if self.vcs == "git":
+            return _output (["git", "-C", target, "config", "remote.origin.url"])
+        return _output (["hg", "paths", "-R", target, "default"])
+
+    def _sync_working_copy (self, target, revision):
+        if not os.path.exists (target):
+            if self.vcs == "git":
+                # Shares the mirror's objects rather than copying them
+                if not _call (["git", "clone", "--shared", "--no-checkout", "--quiet", self.path, target]):
+                    return False
+            elif not _call (["hg", "clone", "--noupdate", "--quiet", self.path, target]):
+                return False
+        if self.vcs == "git":
+            return _call (["git", "-C", target, "fetch", "--prune", "--quiet", "origin",
+                           "+refs/heads/*:refs/remotes/origin/*", "+refs/tags/*:refs/tags/*"]) \
+                and _call (["git", "-C", target, "checkout", "--force", "--detach", "--quiet", revision or "origin/HEAD"]) \
+                and _call (["git", "-C", target, "clean", "-fdxq"])
+        return _call (["hg", "pull", "--quiet", "-R", target, self.path]) \
+            and _call (["hg", "update", "--clean", "--quiet", "-R", target, revision or "default"]) \
+            and _call (["hg", "--config", "extensions.purge=", "purge", "--all", "-R", target])
+
+    def checkout (self, target, revision=None):
+        '''
+        Make target a clean working copy of revision (the default branch if
+        None), reusing whatever is there already
+        '''
+        with self.lock:
+            if os.path.exists (target) and self._origin (target) != self.path:
+                shutil.rmtree (target)
+            if self._sync_working_copy (target, revision):
+                return True
+            # Start over from scratch, once
+            if os.path.exists (target):
+                shutil.rmtree (target)
+            return self._sync_working_copy (target, revision)
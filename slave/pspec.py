@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+'''
+What the slave needs to know about a package's pspec.xml
+'''
+import xml.etree.ElementTree as ElementTree
+
+class PspecInfo:
+    '''
+    The source name and version, the package names it provides, its build
+    dependencies and its source archives, as (url, sha1sum). Empty for a
+    pspec.xml that can't be read
+    '''
+
+    def __init__(self):
+        self.name = None
+        self.version = None
+        self.provides = set ()
+        self.depends = set ()
+        self.archives = list ()
+
+def read_pspec (pspec):
+    ''' Parse the pspec.xml at pspec into a PspecInfo '''
+    info = PspecInfo ()
+    try:
+        tree = ElementTree.parse (pspec)
+    except (IOError, ElementTree.ParseError), e:
+        print "Unable to parse %s: %s" % (pspec, e)
+        return info
+
+    source_name = tree.findtext ("Source/Name")
+    if source_name:
+        info.name = source_name.strip ()
+        info.provides.add (info.name)
+    version = tree.findtext ("History/Update/Version")
+    if version:
+        info.version = version.strip ()
+    for name in tree.findall ("Package/Name"):
+        if name.text:
+            info.provides.add (name.text.strip ())
+    for dep in tree.findall ("Source/BuildDependencies/Dependency"):
+        if dep.text:
+            info.depends.add (dep.text.strip ())
+    for archive in tree.findall ("Source/Archive"):
+        info.archives.append (((archive.text or "").strip (), archive.get ("sha1sum", "")))
+    return info
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+'''
+Caching HTTP proxy for the binary repositories the build system installs from
+'''
+import os
+import os.path
+import json
+import shutil
+import tempfile
+import threading
+import urllib2
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from shared import SharedStore
+
+class ThreadedHTTPServer (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class RepoProxyHandler (BaseHTTPRequestHandler):
+
+    def _send (self, body):
+        # /<repo name>/<path in the repo>
+        parts = urlparse.urlparse (self.path).path.lstrip ("/").split ("/", 1)
+        source = None
+        if len (parts) == 2:
+            source = self.server.proxy.fetch (parts[0], parts[1])
+        if source is None:
+            self.send_error (404)
+            return
+        with source:
+            self.send_response (200)
+            self.send_header ("Content-Type", "application/octet-stream")
+            self.send_header ("Content-Length", str (os.fstat (source.fileno ()).st_size))
+            self.end_headers ()
+            if body:
+                shutil.copyfileobj (source, self.wfile, 256 * 1024)
+
+    def do_GET (self):
+        self._send (True)
+
+    def do_HEAD (self):
+        self._send (False)
+
+    def log_message (self, format, *args):
+        pass
+
+class RepoProxy (SharedStore):
+    '''
+    Serves repositories added with add_repo over HTTP on address:port,
+    keeping everything fetched from upstream on disk.
+
+    Index files (pisi-index.xml and friends) are revalidated with upstream
+    on every request, conditionally (ETag/Last-Modified) so an unchanged
+    index costs a 304, and served stale if upstream can't be reached.
+    Packages never change under the same name, so are only ever fetched
+    once, until evicted (least recently used first) to stay within budget
+    bytes.
+
+    Upstream is an http(s) or file URL, or a plain path to a local
+    directory standing in for one. Serving starts once the shared
+    instance is opened.
+    '''
+
+    INDEX = "pisi-index.xml"
+    META = ".meta"
+    REPOS = "repos.json"
+    BLOCK_SIZE = 256 * 1024
+
+    def __init__(self, cache_dir, budget, address="127.0.0.1", port=0):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.address = address
+        self.port = port
+        self.server = None
+        self.lock = threading.Lock ()
+        # Cached path -> requests for it that haven't opened it yet, never evicted
+        self.serving = dict ()
+        self.stats = { 'hits': 0, 'misses': 0, 'revalidated': 0, 'refreshed': 0, 'stale': 0,
+                       'bytes_served': 0, 'bytes_fetched': 0, 'evicted': 0 }
+        if not os.path.exists (self.cache_dir):
+            os.makedirs (self.cache_dir)
+        # Repo name -> upstream base URL, kept so we still know them after a restart
+        self.repos_file = os.path.join (self.cache_dir, self.REPOS)
+        self.repos = dict ()
+        if os.path.exists (self.repos_file):
+            with open (self.repos_file, "r") as repos:
+                self.repos = json.load (repos)
+        self.size = self._scan_size ()
+
+    def _opened (self):
+        self.start ()
+
+    def start (self):
+        self.server = ThreadedHTTPServer ((self.address, self.port), RepoProxyHandler)
+        self.server.proxy = self
+        self.port = self.server.server_address[1]
+        thread = threading.Thread (target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start ()
+
+    def add_repo (self, name, uri):
+        '''
+        Proxy the repository whose index is at uri as name. Returns the
+        URL of the index through the proxy
+        '''
+        base, index = uri.rstrip ("/").rsplit ("/", 1) if "/" in uri else ("", uri)
+        with self.lock:
+            self.repos[name] = base
+            staging = "%s.new" % self.repos_file
+            with open (staging, "w") as repos:
+                json.dump (self.repos, repos)
+            os.rename (staging, self.repos_file)
+        return "http://%s:%d/%s/%s" % (self.address, self.port, name, index)
+
+    def _count (self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def _open_upstream (self, url, meta):
+        '''
+        A (file-like) response for url, or None when it's unchanged since
+        meta was recorded. Returns (response, new meta)
+        '''
+        if "://" not in url or url.startswith ("file://"):
+            path = url[len ("file://"):] if url.startswith ("file://") else url
+            st = os.stat (path)
+            new_meta = { 'size': st.st_size, 'mtime': st.st_mtime }
+            if meta is not None and meta == new_meta:
+                return (None, meta)
+            return (open (path, "rb"), new_meta)
+        request = urllib2.Request (url)
+        if meta is not None:
+            if meta.get ('etag'):
+                request.add_header ("If-None-Match", meta['etag'])
+            if meta.get ('last_modified'):
+                request.add_header ("If-Modified-Since", meta['last_modified'])
+        try:
+            response = urllib2.urlopen (request)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                return (None, meta)
+            raise
+        info = response.info ()
+        return (response, { 'etag': info.getheader ("ETag"), 'last_modified': info.getheader ("Last-Modified") })
+
+    def _store (self, response, target):
+        ''' Write response to target atomically, returns the bytes written '''
+        directory = os.path.dirname (target)
+        if not os.path.exists (directory):
+            os.makedirs (directory)
+        written = 0
+        fd, staging = tempfile.mkstemp (dir=directory, prefix=".fetch-")
+        try:
+            with os.fdopen (fd, "wb") as output:
+                while True:
+                    buffer = response.read (self.BLOCK_SIZE)
+                    if not buffer:
+                        break
+                    output.write (buffer)
+                    written += len (buffer)
+            os.rename (staging, target)
+        except:
+            os.unlink (staging)
+            raise
+        finally:
+            response.close ()
+        return written
+
+    def _fetch_index (self, upstream, cached):
+        meta_file = cached + self.META
+        meta = None
+        if os.path.exists (cached) and os.path.exists (meta_file):
+            with open (meta_file, "r") as stored:
+                meta = json.load (stored)
+        try:
+            response, new_meta = self._open_upstream (upstream, meta)
+        except (urllib2.URLError, IOError, OSError), e:
+            if meta is None:
+                print "Unable to fetch %s: %s" % (upstream, e)
+                return None
+            self._count ('stale')
+            return cached
+        if response is None:
+            self._count ('revalidated')
+            return cached
+        self._count ('bytes_fetched', self._store (response, cached))
+        with open (meta_file, "w") as stored:
+            json.dump (new_meta, stored)
+        self._count ('refreshed')
+        return cached
+
+    def _fetch_package (self, upstream, cached):
+        if os.path.exists (cached):
+            # mtime is the last use, for eviction
+            os.utime (cached, None)
+            self._count ('hits')
+            return cached
+        try:
+            response, meta = self._open_upstream (upstream, None)
+            written = self._store (response, cached)
+        except (urllib2.URLError, IOError, OSError), e:
+            print "Unable to fetch %s: %s" % (upstream, e)
+            return None
+        self._count ('misses')
+        self._count ('bytes_fetched', written)
+        with self.lock:
+            self.size += written
+        if self.size > self.budget:
+            self.evict ()
+        return cached
+
+    def fetch (self, name, path):
+        '''
+        The local copy of path in the repository name, fetched or
+        revalidated as needed, opened for reading. None if it can't be had
+        '''
+        base = self.repos.get (name)
+        segments = path.split ("/")
+        if base is None or ".." in segments or "" in segments:
+            return None
+        upstream = "%s/%s" % (base, path)
+        cached = os.path.join (self.cache_dir, name, *segments)
+        with self.lock:
+            self.serving[cached] = self.serving.get (cached, 0) + 1
+        try:
+            if segments[-1].startswith (self.INDEX):
+                found = self._fetch_index (upstream, cached)
+            else:
+                found = self._fetch_package (upstream, cached)
+            if found is None:
+                return None
+            # Once open, an eviction can't take it from under the request
+            with self.lock:
+                try:
+                    source = open (found, "rb")
+                except IOError, e:
+                    print "Unable to serve %s: %s" % (found, e)
+                    return None
+                self.stats['bytes_served'] += os.fstat (source.fileno ()).st_size
+            return source
+        finally:
+            with self.lock:
+                self.serving[cached] -= 1
+                if self.serving[cached] == 0:
+                    del self.serving[cached]
+
+    def _packages (self):
+        ''' (mtime, size, path) of every cached package '''
+        packages = list ()
+        for dirpath, dirnames, filenames in os.walk (self.cache_dir):
+            for filename in filenames:
+                if filename.startswith (self.INDEX) or filename.startswith (".") or filename == self.REPOS:
+                    continue
+                fpath = os.path.join (dirpath, filename)
+                try:
+                    st = os.stat (fpath)
+                except OSError:
+                    continue
+                packages.append ((st.st_mtime, st.st_size, fpath))
+        return packages
+
+    def _scan_size (self):
+        return sum (size for mtime, size, fpath in self._packages ())
+
+    def evict (self):
+        '''
+        Remove the least recently used packages until under budget, except
+        those still being served
+        '''
+        with self.lock:
+            packages = sorted (self._packages ())
+            total = sum (size for mtime, size, fpath in packages)
+            for mtime, size, fpath in packages:
+                if total <= self.budget:
+                    break
+                if fpath in self.serving:
+                    continue
+                try:
+                    os.unlink (fpath)
+                except OSError:
+                    continue
+                total -= size
+                self.stats['evicted'] += 1
+            self.size = total
+
+    def get_stats (self):
+        with self.lock:
+            stats = dict (self.stats)
+            stats['size'] = self.size
+        # XML-RPC integers are only 32 bit
+        for field in ('bytes_served', 'bytes_fetched', 'size'):
+            stats[field] = float (stats[field])
+        return stats
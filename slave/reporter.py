@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+'''
+Background delivery of build status to the frontend
+'''
+import threading
+import time
+
+from collections import OrderedDict
+
+class StatusReporter:
+    '''
+    Queue QueueAPI updates and deliver them from a background thread, so a
+    slow frontend never holds up log consumption or the build itself.
+
+    Updates that haven't been sent yet are superseded by newer ones for the
+    same package (or, for the queue position, by any newer position). Failed
+    calls are retried with exponential backoff.
+    '''
+
+    def __init__(self, remote, queue_id, retries=5, backoff=0.5, max_backoff=30.0):
+        self.remote = remote
+        self.queue_id = queue_id
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Condition ()
+        self.pending = OrderedDict ()
+        self.closed = False
+
+        self.queued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+
+        self.thread = threading.Thread (target=self._run)
+        self.thread.daemon = True
+        self.thread.start ()
+
+    def _enqueue (self, key, method, request):
+        with self.lock:
+            self.queued += 1
+            if key in self.pending:
+                self.coalesced += 1
+                del self.pending[key]
+            self.pending[key] = (method, request)
+            self.lock.notify ()
+
+    def update_status (self, request):
+        ''' Queue a QueueRequest for delivery '''
+        self._enqueue (("status", request.name), self.remote.update_status, request)
+
+    def update_queue (self, request):
+        ''' Queue a QueueStatusRequest for delivery '''
+        self._enqueue (("queue",), self.remote.update_queue, request)
+
+    def _deliver (self, method, request):
+        delay = self.backoff
+        for attempt in range (self.retries + 1):
+            try:
+                method (self.queue_id, request=request)
+                return True
+            except Exception, e:
+                print "Status update failed (attempt %d): %s" % (attempt + 1, e)
+                if attempt < self.retries:
+                    time.sleep (delay)
+                    delay = min (delay * 2, self.max_backoff)
+        return False
+
+    def _run (self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.lock.wait ()
+                if not self.pending:
+                    return
+                key, (method, request) = self.pending.popitem (last=False)
+            if self._deliver (method, request):
+                with self.lock:
+                    self.sent += 1
+            else:
+                with self.lock:
+                    self.failed += 1
+
+    def close (self, timeout=60.0):
+        '''
+        Deliver whatever is still queued, waiting at most timeout seconds
+        '''
+        with self.lock:
+            self.closed = True
+            self.lock.notify ()
+        self.thread.join (timeout)
+
+    def get_stats (self):
+        with self.lock:
+            return {
+                'queued': self.queued,
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'failed': self.failed,
+                'pending': len (self.pending),
+            }
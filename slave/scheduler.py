@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+'''
+Dependency-aware scheduling of a build queue.
+
+The queue is turned into a DAG using the build dependencies declared in each
+item's pspec.xml, and independent items are handed out to worker threads.
+'''
+import threading
+
+from pspec import read_pspec
+
+class BuildGraph:
+    '''
+    Build dependencies between the items of a queue. Items are referred to by
+    their index in the queue throughout.
+    '''
+
+    def __init__(self, items, spec_for):
+        self.items = list (items)
+        self.requires = dict ()
+        self.dependents = dict ()
+
+        provided_by = dict ()
+        depends = dict ()
+        for index, item in enumerate (self.items):
+            info = read_pspec (spec_for (item))
+            depends[index] = info.depends
+            for name in info.provides:
+                # First one wins, same as the old in-order behaviour
+                provided_by.setdefault (name, index)
+
+        for index in range (len (self.items)):
+            self.requires[index] = set ()
+            self.dependents[index] = set ()
+        for index in range (len (self.items)):
+            for name in depends[index]:
+                dep = provided_by.get (name)
+                if dep is not None and dep != index:
+                    self.requires[index].add (dep)
+                    self.dependents[dep].add (index)
+
+    def __len__(self):
+        return len (self.items)
+
+class QueueScheduler:
+    '''
+    Run a BuildGraph with up to max_parallel builds at once.
+
+    build (index, position) is called on a worker thread and returns True on
+    success. report (index, result) is always called on the calling thread,
+    and always in queue order, regardless of the order builds complete in.
+
+    With skip_dependents, everything that (indirectly) depends on a failed
+    build is never started: it's reported as failed straight away, with
+    the reason in skipped. Otherwise items wait for their dependencies to
+    finish, whatever the result.
+    '''
+
+    def __init__(self, graph, max_parallel=1, skip_dependents=True):
+        self.graph = graph
+        self.max_parallel = max (1, int (max_parallel))
+        self.skip_dependents = skip_dependents
+
+        self.lock = threading.Condition ()
+        self.pending = set (range (len (graph)))
+        self.running = set ()
+        self.results = dict ()
+        self.started = 0
+        self.cancelled = False
+        # Index -> why it was never built
+        self.skipped = dict ()
+
+    def cancel (self):
+        ''' Stop handing out new builds, running ones are left to finish '''
+        with self.lock:
+            self.cancelled = True
+            self.lock.notify_all ()
+
+    def _is_ready (self, index):
+        for dep in self.graph.requires[index]:
+            if dep not in self.results:
+                return False
+        return True
+
+    def _skip_dependents (self, failed):
+        ''' Give up on whatever is waiting on failed. Must be called with the lock held '''
+        reason = "build dependency %s failed" % self.graph.items[failed].name
+        stack = list (self.graph.dependents[failed])
+        while stack:
+            index = stack.pop ()
+            if index not in self.pending:
+                continue
+            self.pending.discard (index)
+            self.skipped[index] = reason
+            self.results[index] = False
+            stack.extend (self.graph.dependents[index])
+
+    def _start_ready (self, build):
+        ''' Start whatever we can. Must be called with the lock held '''
+        if self.cancelled:
+            return
+        ready = [index for index in sorted (self.pending) if self._is_ready (index)]
+        if not ready and not self.running and self.pending:
+            # Dependency cycle, fall back to queue order to break it
+            ready = [min (self.pending)]
+        for index in ready:
+            if len (self.running) >= self.max_parallel:
+                break
+            self.pending.discard (index)
+            self.running.add (index)
+            self.started += 1
+            thread = threading.Thread (target=self._run, args=(index, self.started, build))
+            thread.daemon = True
+            thread.start ()
+
+    def _run (self, index, position, build):
+        result = False
+        try:
+            result = build (index, position)
+        except Exception, e:
+            print "Build of %s raised: %s" % (self.graph.items[index].name, e)
+        with self.lock:
+            self.running.discard (index)
+            self.results[index] = result
+            if not result and self.skip_dependents:
+                self._skip_dependents (index)
+            self.lock.notify_all ()
+
+    def run (self, build, report):
+        ''' Run the whole graph, returns once nothing is left running '''
+        next_report = 0
+        while True:
+            batch = list ()
+            with self.lock:
+                self._start_ready (build)
+                while next_report in self.results:
+                    batch.append ((next_report, self.results[next_report]))
+                    next_report += 1
+                done = not self.running and (self.cancelled or not self.pending)
+                if done:
+                    # Anything held back by a gap (i.e. cancelled items)
+                    for index in sorted (self.results):
+                        if index >= next_report:
+                            batch.append ((index, self.results[index]))
+                elif not batch:
+                    self.lock.wait ()
+            for index, result in batch:
+                report (index, result)
+            if done:
+                break
+        return self.results
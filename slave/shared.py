@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+'''
+Stores on the host that every worker slot shares
+'''
+import os.path
+import threading
+
+class SharedStore:
+    '''
+    Base for a store kept in a file or directory on the host. open() hands
+    every worker slot the same instance per path, so that they all go
+    through one lock and one set of counters.
+    '''
+
+    _instances = dict ()
+    _instances_lock = threading.Lock ()
+
+    @classmethod
+    def open (cls, path, *args, **kwargs):
+        '''
+        The instance for path, created with the remaining arguments (and
+        _opened) the first time
+        '''
+        key = (cls, os.path.abspath (path))
+        with SharedStore._instances_lock:
+            if key not in SharedStore._instances:
+                store = cls (key[1], *args, **kwargs)
+                store._opened ()
+                SharedStore._instances[key] = store
+            return SharedStore._instances[key]
+
+    def _opened (self):
+        ''' Called once on the shared instance, before anyone gets it '''
+        pass
@@ -3,7 +3,8 @@ import xmlrpclib
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 from configobj import ConfigObj
 from solusos.console import *
-from solusos.system import SystemManager
+from solusos.system import SystemManager, UnderlayManager
+from solusos.download import Downloader
 
 from SocketServer import ThreadingMixIn
 
@@ -13,12 +14,17 @@ import platform
 import os
 import os.path
 import multiprocessing
-import urllib2
 import subprocess
-import re
+import time
 import shutil
+import tempfile
+import commands
 
 from worker import Worker, WorkerState, work_environment
+from manifest import MediaManifest
+from slots import WorkerSlots
+from executor import JobExecutor
+from events import EventStream
 
 FORK = False
 
@@ -37,6 +43,10 @@ class SlaveController:
     
     # Temporary, pending setup.py creation
     DATA_DIR = os.path.abspath ("./data")
+
+    # What one worker slot is sized for, when Slots is "auto"
+    SLOT_CORES = 4
+    SLOT_MEMORY = 4 * 1024 * 1024 * 1024
     
     def __init__(self):
         self.config = ConfigObj ("slave.conf")
@@ -47,81 +57,239 @@ class SlaveController:
         self.server.register_function (self.get_host_info, "get_host_info")
         self.server.register_function (self.get_storage_info, "get_storage_info")
         self.server.register_function (self.update_media, "update_media")
+        self.server.register_function (self.get_slots, "get_slots")
         
         self.fs_image = os.path.join (self.config["Builder"]["Storage"], "storage.image")
         self.fs_info = os.path.join (self.config["Builder"]["Storage"], "storage.info")
+        self.fs_manifest = os.path.join (self.config["Builder"]["Storage"], "media.manifest")
         
         self.loop_point = os.path.join (self.config["Builder"]["Storage"], "loopback")
         self.mount_point = os.path.join (self.config["Builder"]["Storage"], "mountpoint")
         
         self.imaging_progress = 0
+        self.events = EventStream ()
+        self.server.register_function (self.get_events, "get_events")
         
-        self.worker = Worker (self.config)
-        self.server.register_instance (self.worker)
+        slots = self._slot_count ()
+        self.workers = [Worker (self.config, slot=slot, slots=slots, events=self.events) for slot in range (slots)]
+        self.server.register_instance (WorkerSlots (self.workers))
+
+        # Long operations run as jobs, rather than holding a connection open
+        self.executor = JobExecutor (self.workers, events=self.events, tasks={ 'update_media': self.update_media })
+        self.server.register_function (self.submit_job, "submit_job")
+        self.server.register_function (self.get_job, "get_job")
+        self.server.register_function (self.list_jobs, "list_jobs")
+        self.server.register_function (self.cancel_job, "cancel_job")
         
         storage_dir = self.config ["Builder"]["Storage"]
         if not os.path.exists (storage_dir):
             os.makedirs (storage_dir)
         
+    def _slot_count (self):
+        '''
+        How many workers to run, from Slots in the Settings section. "auto"
+        (the default) gives each SLOT_CORES cores and SLOT_MEMORY of RAM
+        '''
+        setting = str (self.config["Settings"].get ("Slots", "auto")).lower ()
+        if setting != "auto":
+            return max (1, int (setting))
+        slots = multiprocessing.cpu_count () / self.SLOT_CORES
+        try:
+            with open ("/proc/meminfo", "r") as meminfo:
+                for line in meminfo:
+                    if line.startswith ("MemTotal:"):
+                        memory = int (line.split ()[1]) * 1024
+                        slots = min (slots, memory / self.SLOT_MEMORY)
+                        break
+        except (IOError, ValueError):
+            pass
+        return max (1, slots)
+
+    def get_slots (self):
+        '''
+        State of every worker slot. Slot N is driven through the slotN.
+        prefixed methods, e.g. slot1.begin_build
+        '''
+        return [worker.get_slot_info () for worker in self.workers]
+
+    def submit_job (self, method, params, slot=0):
+        '''
+        Run a Worker method (e.g. begin_build) with the list params in the
+        background on the given slot, or update_media for the whole slave.
+        Returns the job ID to poll get_job with
+        '''
+        return self.executor.submit (method, params, slot)
+
+    def get_job (self, job_id):
+        '''
+        State of a job (QUEUED, RUNNING, DONE, FAILED or CANCELLED), with
+        its result and errors once finished
+        '''
+        job = self.executor.get (job_id)
+        if job is None:
+            return False
+        return job
+
+    def list_jobs (self):
+        ''' Every queued, running and recently finished job '''
+        return self.executor.list ()
+
+    def cancel_job (self, job_id):
+        ''' Cancel a queued job, or stop the build a running one is doing '''
+        return self.executor.cancel (job_id)
+
+    def _set_imaging_progress (self, progress):
+        if progress != self.imaging_progress:
+            self.imaging_progress = progress
+            self.events.publish ("imaging", progress=progress)
+
+    def get_events (self, since=0, timeout=30, stream=""):
+        '''
+        Progress events after sequence number since (of the given stream),
+        waiting up to timeout seconds for new ones. Pass back the returned
+        seq and stream to carry on from there, and refresh everything when
+        missed is set
+        '''
+        return self.events.since (since, timeout, stream or None)
+
     def serve (self):
         self.server.serve_forever ()
     
     def sync_new_media (self):
+        '''
+        Copy the backing image onto the fresh filesystem, returns whether
+        it all made it
+        '''
         for item in [self.mount_point, self.loop_point]:
             if not os.path.exists (item):
                 os.mkdir (item)
                 
         # Mount loopback
-        SystemManager.mount (self.image_source, self.loop_point, options="loop")
+        if not SystemManager.mount (self.image_source, self.loop_point, options="loop"):
+            print "Imaging failed: unable to mount %s" % self.image_source
+            return False
         
         # Mount fresh filesystem
-        SystemManager.mount (self.fs_image, self.mount_point, options="loop")
-        
-        # Find the actual total number of files
-        dry_run = "rsync -az --stats --dry-run \"%s/\" \"%s/\"" % (self.loop_point, self.mount_point)
-        p = subprocess.Popen (dry_run, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        remainder = p.communicate() [0]
-        mn = re.findall(r'Number of files: (\d+)', remainder)
-        total_files = int(mn[0])
-        
-        # Really run rsync now
-        cmd = "rsync -avz \"%s/\" \"%s/\" --progress" % (self.loop_point, self.mount_point)
-        p = subprocess.Popen (cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        if not SystemManager.mount (self.fs_image, self.mount_point, options="loop"):
+            print "Imaging failed: unable to mount %s" % self.fs_image
+            SystemManager.umount (self.loop_point)
+            return False
         
-        while True:
-            output = p.stdout.readline()
-            if 'to-check' in output:
-                m = re.findall(r'to-check=(\d+)/(\d+)', output)
-                progress = (100 * (int(m[0][1]) - int(m[0][0]))) / total_files
-                self.imaging_progress = progress
-                if int(m[0][0]) == 0:
-                    break
-            if output is None or p.poll() is not None:
-                break
+        # Totals come straight from the source filesystem's metadata,
+        # progress from how much of that has landed on the target. Inodes
+        # first, as squashfs only knows its compressed size in bytes
+        source = os.statvfs (self.loop_point)
+        total_bytes = (source.f_blocks - source.f_bfree) * source.f_frsize
+        total_inodes = source.f_files - source.f_ffree
+        target = os.statvfs (self.mount_point)
+        start_bytes = (target.f_blocks - target.f_bfree) * target.f_frsize
+        start_inodes = target.f_files - target.f_ffree
+
+        # One pass, no compression between two local filesystems
+        cmd = ["rsync", "-aHAX", "--numeric-ids", "%s/" % self.loop_point, "%s/" % self.mount_point]
+        with open (os.devnull, "w") as devnull:
+            p = subprocess.Popen (cmd, stdin=subprocess.PIPE, stdout=devnull)
+            while p.poll () is None:
+                target = os.statvfs (self.mount_point)
+                if total_inodes > 0:
+                    done = ((target.f_files - target.f_ffree) - start_inodes) / float (total_inodes)
+                else:
+                    done = ((target.f_blocks - target.f_bfree) * target.f_frsize - start_bytes) / float (max (total_bytes, 1))
+                # Filesystem overhead means we can overshoot, 100 means done
+                self._set_imaging_progress (max (0, min (99, int (done * 100))))
+                time.sleep (0.5)
+        if p.returncode != 0:
+            print "Imaging failed: rsync exited with %d" % p.returncode
+            if os.path.exists (self.fs_manifest):
+                os.unlink (self.fs_manifest)
         
-        self.imaging_progress = 0
+        self._set_imaging_progress (0)
         
         # Quickly install dbus
         self.install_dbus ()
+
+        if p.returncode == 0:
+            # Baseline for delta refreshes: the root itself, as imaged
+            MediaManifest.scan (self.mount_point).save (self.fs_manifest)
                 
         # Unmount it
         SystemManager.umount (self.mount_point)
         SystemManager.umount (self.loop_point)
+        return p.returncode == 0
     
     def install_dbus (self):
-        source_lib = os.path.join (self.DATA_DIR, "lsb")
-        target_lib = os.path.join (self.mount_point, "lib/lsb")
+        ''' Copy lsb-functions and the D-BUS init script into the root, where missing '''
+        copies = [(os.path.join (self.DATA_DIR, "lsb"), os.path.join (self.mount_point, "lib/lsb")),
+                  (os.path.join (self.DATA_DIR, "init.d"), os.path.join (self.mount_point, "etc/rc.d/init.d"))]
         
-        source_etc = os.path.join (self.DATA_DIR, "init.d")
-        target_etc = os.path.join (self.mount_point, "etc/rc.d/init.d")
+        for source, target in copies:
+            for dirpath, dirnames, filenames in os.walk (source):
+                target_dir = os.path.normpath (os.path.join (target, os.path.relpath (dirpath, source)))
+                if not os.path.exists (target_dir):
+                    os.makedirs (target_dir)
+                for filename in filenames:
+                    target_file = os.path.join (target_dir, filename)
+                    if not os.path.exists (target_file):
+                        shutil.copy2 (os.path.join (dirpath, filename), target_file)
+        
+    def refresh_media (self):
+        '''
+        Apply only what differs between the root and the current backing
+        image, so that it ends up as a full sync would leave it. The root is
+        scanned first, as the worker changes it (pisi upgrades, repositories,
+        pisi.conf) after imaging; the stored manifest only saves hashing the
+        files it hasn't touched since
+        '''
+        previous = MediaManifest.load (self.fs_manifest)
+        if previous is None:
+            return False
+        for item in [self.mount_point, self.loop_point]:
+            if not os.path.exists (item):
+                os.mkdir (item)
         
-        # Copy lsb-functions, etc.
+        if not SystemManager.mount (self.image_source, self.loop_point, options="loop"):
+            return False
         try:
-            shutil.copytree (source_lib, target_lib)
-            shutil.copytree (source_etc, target_etc)
-        except:
-            # Already installed
-            pass
+            if not SystemManager.mount (self.fs_image, self.mount_point, options="loop"):
+                return False
+            try:
+                live = MediaManifest.scan (self.mount_point, previous=previous, exact=True)
+                # Not previous=live: a rewritten file in the root can keep
+                # the size and mtime of the one in the image
+                current = MediaManifest.scan (self.loop_point, previous=previous)
+                changed, removed = live.diff (current)
+                print_info ("Delta refresh: %d changed, %d removed" % (len (changed), len (removed)))
+                self._set_imaging_progress (50)
+                
+                for rel in removed:
+                    path = os.path.join (self.mount_point, rel)
+                    if os.path.isdir (path) and not os.path.islink (path):
+                        shutil.rmtree (path, ignore_errors=True)
+                    elif os.path.lexists (path):
+                        os.unlink (path)
+                
+                if changed:
+                    with tempfile.NamedTemporaryFile (prefix="refresh-") as file_list:
+                        file_list.write ("\n".join (changed))
+                        file_list.write ("\n")
+                        file_list.flush ()
+                        # --force so a directory can be replaced by a file
+                        cmd = ["rsync", "-aHAX", "--numeric-ids", "--force", "--files-from=%s" % file_list.name,
+                               "%s/" % self.loop_point, "%s/" % self.mount_point]
+                        with open (os.devnull, "w") as devnull:
+                            ret = subprocess.call (cmd, stdout=devnull)
+                    if ret != 0:
+                        print "Delta refresh failed: rsync exited with %d" % ret
+                        return False
+                
+                self.install_dbus ()
+                MediaManifest.scan (self.mount_point, previous=current).save (self.fs_manifest)
+                return True
+            finally:
+                self._set_imaging_progress (0)
+                SystemManager.umount (self.mount_point)
+        finally:
+            SystemManager.umount (self.loop_point)
         
     def get_storage_info (self):
         config = ConfigObj (self.fs_info)
@@ -135,59 +303,130 @@ class SlaveController:
         except:
             return None
     
-    def get_backing_source (self):
-        # Ensure we have the backing source.
+    def get_backing_source (self, refresh=False):
+        '''
+        Ensure we have the backing source. With refresh, check for a newer
+        one even if we have it already (only downloaded if it changed)
+        '''
         backing_store = self.get_storage_info ()[2]
         backing_uri = "http://ng.solusos.com/root_32.squashfs" if backing_store == "32" else None
         
         self.image_source = os.path.join (self.config["Builder"]["Storage"], "system%s.image" % backing_store)
-        if not os.path.exists (self.image_source):
-            self.download_file (backing_uri, self.image_source)
+        if refresh or not os.path.exists (self.image_source):
+            return self.download_file (backing_uri, self.image_source)
+        return True
         
-    def download_file (self, url, target):
-        u = urllib2.urlopen(url)
-        f = open(target, 'wb')
-        meta = u.info()
-        file_size = int(meta.getheaders("Content-Length")[0])
-
-        file_size_dl = 0
-        block_sz = 8192
-        while True:
-                buffer = u.read(block_sz)
-                if not buffer:
-                        break
+    def download_file (self, url, target, checksum=None):
+        '''
+        Download and verify url. Images are cached by checksum, so
+        reprovisioning never downloads the same one twice
+        '''
+        published = [-1]
+        def download_progress (current, total):
+            if total <= 0:
+                return
+            if not FORK:
+                progress (current, total)
+            # At most one event per percent
+            percent = int (100 * current / total)
+            if percent != published[0]:
+                published[0] = percent
+                self.events.publish ("download", url=url, progress=percent, current=float (current), total=float (total))
 
-                file_size_dl += len(buffer)
-                f.write(buffer)
-                if not FORK:
-                    progress (file_size_dl, file_size)
+        cache_dir = os.path.join (self.config["Builder"]["Storage"], "cache", "images")
+        downloader = Downloader (cache_dir=cache_dir, callback=download_progress)
+        return downloader.fetch (url, target, checksum=checksum)
                 
-    def update_media (self, filesystem, size, backing_store):
-        ''' Rebuild the backing media '''
+    def update_media (self, filesystem, size, backing_store, resize=False, delta=False):
+        '''
+        Rebuild the backing media. With resize, an existing image with the
+        same filesystem is resized in place instead of being recreated.
+        With delta, an existing image of the same filesystem and size only
+        has the files that changed in the backing store applied to it.
+        Every worker is kept BUSY throughout, so fails if any is in use
+        '''
+        claimed = list ()
+        for worker in self.workers:
+            if not worker._begin_media_update ():
+                # A worker still has the current media in use
+                print "Slot %d is busy, not updating media" % worker.slot
+                for held in claimed:
+                    held._end_media_update ()
+                return False
+            claimed.append (worker)
+        try:
+            return self._update_media (filesystem, size, backing_store, resize, delta)
+        finally:
+            for worker in claimed:
+                worker._end_media_update ()
+
+    def _update_media (self, filesystem, size, backing_store, resize, delta):
         #### WE NEED PRE CHECKS, mounts, etc ######
         if size >= (self.get_host_info()[1]):
             # Don't attempt to create larger files than free space.
             return False
-        
+        if not filesystem.startswith ("ext"):
+            print "FILESYSTEM NOT IMPLEMENTED: %s" % filesystem
+            return False
+
+        # Sizes are in MB, as with the dd bs=1MB this used to be
+        image_size = size * 1000 * 1000
+        sparse = str (self.config["Builder"].get ("SparseImages", "False")).lower () == "true"
+
+        def allocation_progress (done, total):
+            self._set_imaging_progress ((100 * done) / total if total else 100)
+
         current_info = self.get_storage_info ()
-        noImage = False
-        if current_info != None:
-            if int(current_info [1]) == size:
-                noImage = True    
+        if delta and current_info is not None and current_info[0] == filesystem and int (current_info[1]) == size \
+                and os.path.exists (self.fs_image) and os.path.exists (self.fs_manifest):
+            self._store_storage_info (filesystem, size, backing_store)
+            if not self.get_backing_source (refresh=True):
+                return False
+            if self.refresh_media ():
+                return self.clone_media ()
+            print "Delta refresh of %s failed, recreating it" % self.fs_image
+
+        resized = False
+        if resize and current_info is not None and current_info[0] == filesystem and os.path.exists (self.fs_image):
+            resized = UnderlayManager.ResizeImage (self.fs_image, image_size, filesystem, sparse=sparse, callback=allocation_progress)
+            if not resized:
+                print "Unable to resize %s, recreating it" % self.fs_image
 
-        cmd = "dd if=/dev/zero of=\"%s\" bs=1MB count=%d" % (self.fs_image, size)
-        if not noImage:
+        if not resized:
             if os.path.exists (self.fs_image):
-                os.unlink (self.fs_image)             
-            os.system (cmd)
-       
-        if filesystem.startswith ("ext"):
+                os.unlink (self.fs_image)
+            UnderlayManager.AllocateImage (self.fs_image, image_size, sparse=sparse, callback=allocation_progress)
             cmd = "mkfs.%s -F \"%s\"" % (filesystem, self.fs_image)
-        else:
-            print "FILESYSTEM NOT IMPLEMENTED: %s" % filesystem
+            os.system (cmd)
+        self._set_imaging_progress (0)
+
+        self._store_storage_info (filesystem, size, backing_store)
+        if not self.get_backing_source ():
+            return False
+        if not self.sync_new_media ():
+            # Never hand a broken image to the other slots
             return False
-        os.system (cmd)
+        return self.clone_media ()
 
+    def clone_media (self):
+        '''
+        Give every other slot its own copy of the (unmounted) slot 0 image.
+        Reflinked where the filesystem allows, so cheap on btrfs/xfs
+        '''
+        for worker in self.workers[1:]:
+            if not os.path.exists (worker.storage_dir):
+                os.makedirs (worker.storage_dir)
+            staging = "%s.new" % worker.fs_image
+            cmd = ["cp", "--reflink=auto", "--sparse=always", self.fs_image, staging]
+            if subprocess.call (cmd) != 0:
+                print "Unable to copy media to slot %d" % worker.slot
+                if os.path.exists (staging):
+                    os.unlink (staging)
+                return False
+            os.rename (staging, worker.fs_image)
+        return True
+            
+    def _store_storage_info (self, filesystem, size, backing_store):
         # Write our currently known config (for get_storage_info)
         conf = ConfigObj ()
         conf.filename = self.fs_info
@@ -198,10 +437,6 @@ class SlaveController:
         conf["DiskInfo"] = config
         conf.write ()
         
-        self.get_backing_source ()
-        self.sync_new_media ()
-        return True
-            
     def get_host_info (self):
         '''
         Retrieve basic information about the host
@@ -231,6 +466,8 @@ def main():
         control.serve ()
     except KeyboardInterrupt:
         print_info ("Shutdown requested")
+        for worker in control.workers:
+            worker.release_environment ()
         sys.exit (0)
     except Exception, e:
         print e        
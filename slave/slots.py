@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+'''
+XML-RPC routing for several Workers on one SlaveController
+'''
+import pydoc
+from SimpleXMLRPCServer import resolve_dotted_attribute, list_public_methods
+
+SLOT_PREFIX = "slot"
+
+class WorkerSlots:
+    '''
+    Exposes every Worker method once per slot, as slotN.method. The
+    unprefixed names still reach slot 0, so a frontend that only knows
+    about one worker keeps working.
+    '''
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def _resolve (self, method):
+        worker = self.workers[0]
+        if method.startswith (SLOT_PREFIX) and "." in method:
+            slot, method = method.split (".", 1)
+            try:
+                index = int (slot[len (SLOT_PREFIX):])
+            except ValueError:
+                index = -1
+            if index < 0 or index >= len (self.workers):
+                raise Exception ('slot "%s" is not supported' % slot)
+            worker = self.workers[index]
+        # Refuses private (_ prefixed) and dotted names, as the server would
+        return resolve_dotted_attribute (worker, method, False)
+
+    def _dispatch (self, method, params):
+        return self._resolve (method) (*params)
+
+    def _listMethods (self):
+        methods = list_public_methods (self.workers[0])
+        slotted = list ()
+        for slot in range (len (self.workers)):
+            slotted.extend (["%s%d.%s" % (SLOT_PREFIX, slot, method) for method in methods])
+        return methods + slotted
+
+    def _methodHelp (self, method):
+        try:
+            return pydoc.getdoc (self._resolve (method))
+        except Exception:
+            return ""
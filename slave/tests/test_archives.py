@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from archives import ArchiveCache, source_archives
+
+PSPEC = '''<PISI>
+    <Source>
+        <Name>foo</Name>
+%s
+    </Source>
+</PISI>
+'''
+
+class ArchiveCacheTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.cache = ArchiveCache (os.path.join (self.directory, "archives"), 1024 * 1024)
+        self.archives = { "foo-1.0.tar.gz": "foo" * 100, "foo-data.tar.xz": "data" * 100 }
+        self.pspec = os.path.join (self.directory, "pspec.xml")
+        with open (self.pspec, "w") as pspec:
+            pspec.write (PSPEC % "\n".join ('<Archive sha1sum="%s" type="targz">http://example.com/src/%s</Archive>' %
+                                             (hashlib.sha1 (data).hexdigest (), name) for name, data in self.archives.iteritems ()))
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def download (self, staging, archives=None):
+        ''' What pisi would do in the staging directory '''
+        for name, data in (archives or self.archives).iteritems ():
+            if not os.path.exists (os.path.join (staging, name)):
+                with open (os.path.join (staging, name), "w") as archive:
+                    archive.write (data)
+
+    def test_source_archives (self):
+        self.assertEqual (sorted (source_archives (self.pspec)),
+                          sorted ((name, hashlib.sha1 (data).hexdigest ()) for name, data in self.archives.iteritems ()))
+        self.assertEqual (source_archives (os.path.join (self.directory, "missing.xml")), [])
+
+    def test_fetched_once (self):
+        staging = self.cache.stage ("foo", self.pspec)
+        self.assertEqual (os.listdir (staging), [])
+        self.download (staging)
+        self.cache.collect ("foo", self.pspec)
+        self.assertFalse (os.path.exists (staging))
+
+        staging = self.cache.stage ("foo", self.pspec)
+        self.assertEqual (sorted (os.listdir (staging)), sorted (self.archives))
+        with open (os.path.join (staging, "foo-1.0.tar.gz"), "r") as archive:
+            self.assertEqual (archive.read (), self.archives["foo-1.0.tar.gz"])
+        self.cache.collect ("foo", self.pspec)
+
+        stats = self.cache.get_stats ()
+        self.assertEqual ((stats['hits'], stats['misses'], stats['hit_rate']), (2, 2, 0.5))
+        self.assertEqual (stats['bytes_saved'], 700.0)
+        self.assertEqual (stats['bytes_fetched'], 700.0)
+
+    def test_corrupt_download_not_stored (self):
+        staging = self.cache.stage ("foo", self.pspec)
+        self.download (staging, { "foo-1.0.tar.gz": "truncated" })
+        self.cache.collect ("foo", self.pspec)
+        staging = self.cache.stage ("foo", self.pspec)
+        self.assertEqual (os.listdir (staging), [])
+        self.assertEqual (self.cache.get_stats ()['bytes_fetched'], 0.0)
+
+    def test_least_recently_used_evicted (self):
+        staging = self.cache.stage ("foo", self.pspec)
+        self.download (staging)
+        self.cache.collect ("foo", self.pspec)
+        # foo-data was used last
+        oldest = os.path.join (self.cache.cache_dir, hashlib.sha1 (self.archives["foo-1.0.tar.gz"]).hexdigest ())
+        os.utime (oldest, (1, 1))
+        self.cache.budget = 500
+        self.assertEqual (self.cache.evict (), 400)
+        staging = self.cache.stage ("foo", self.pspec)
+        self.assertEqual (os.listdir (staging), ["foo-data.tar.xz"])
+        self.assertEqual (self.cache.get_stats ()['evicted'], 1)
+
+if __name__ == "__main__":
+    unittest.main ()
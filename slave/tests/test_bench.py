@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import os
+import os.path
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import urllib2
+import unittest
+
+from bench_pipeline import Timings, QueueAPIStub
+
+class TimingsTest (unittest.TestCase):
+
+    def test_summary (self):
+        timings = Timings ()
+        timings.add ("enter", 1.0)
+        timings.add ("enter", 3.0)
+        def broken ():
+            raise Exception ("broken")
+        # Timed even when it fails
+        self.assertRaises (Exception, timings.timed ("build", broken))
+        self.assertEqual (timings.timed ("log", lambda value: value) ("value"), "value")
+
+        summary = timings.summary ()
+        self.assertEqual (sorted (summary), ["build", "enter", "log"])
+        self.assertEqual (summary["enter"], { 'count': 2, 'total': 4.0, 'mean': 2.0, 'min': 1.0, 'max': 3.0 })
+        self.assertEqual (summary["build"]['count'], 1)
+
+class QueueAPIStubTest (unittest.TestCase):
+
+    def setUp (self):
+        self.timings = Timings ()
+        self.frontend = QueueAPIStub (self.timings)
+        self.frontend.add_queue (1, [{ 'name': "bench000" }])
+
+    def tearDown (self):
+        self.frontend.shutdown ()
+
+    def request (self, path, method="GET", data=None):
+        request = urllib2.Request ("http://%s%s" % (self.frontend.address, path), data)
+        request.get_method = lambda: method
+        return urllib2.urlopen (request).read ()
+
+    def test_queue (self):
+        self.assertEqual (json.loads (self.request ("/api/queue/1/")), [{ 'name': "bench000" }])
+        self.assertEqual (self.request ("/api/queuestatus/1/", "PUT", '{"status": "BUILDING"}'), "{}")
+        self.assertEqual (self.timings.summary ()["frontend_request"]['count'], 1)
+
+    def test_not_found (self):
+        for path, method in [("/api/queue/2/", "GET"), ("/api/other/1/", "PUT")]:
+            try:
+                self.request (path, method, "{}" if method == "PUT" else None)
+                self.fail ("%s %s was answered" % (method, path))
+            except urllib2.HTTPError, e:
+                self.assertEqual (e.code, 404)
+        self.assertEqual (self.timings.summary (), {})
+
+@unittest.skipUnless (os.geteuid () == 0, "needs root for mounts")
+class BenchRunTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def bench (self, *args):
+        with open (os.devnull, "w") as devnull:
+            return subprocess.call ([sys.executable, "bench_pipeline.py"] + list (args), stdout=devnull, stderr=devnull)
+
+    def test_results (self):
+        output = os.path.join (self.directory, "results.json")
+        self.assertEqual (self.bench ("--sizes", "1,2", "--log-size", "1", "--image-size", "64", "--tmpfs-size", "256", "-o", output), 0)
+        with open (output, "r") as results:
+            results = json.load (results)
+        self.assertEqual ([(run['size'], run['ok']) for run in results['throughput']], [(1, True), (2, True)])
+        for stage in ["enter", "exit", "build", "log", "queue", "report_drain"]:
+            self.assertTrue (stage in results['stages'], stage)
+        self.assertEqual (results['stages']["log"]['count'], 3)
+        self.assertEqual (self.bench ("--compare", output, output), 0)
+
+    def test_compare_needs_two_files (self):
+        self.assertNotEqual (self.bench ("--compare", "results.json"), 0)
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+import buildcache
+from buildcache import BuildCache, installed_packages, missing_dependencies
+
+PSPEC = ("<PISI><Source><Name>foo</Name>"
+         "<Archive sha1sum=\"%s\">http://example.com/foo.tar.gz</Archive>"
+         "<BuildDependencies><Dependency>bar</Dependency><Dependency>baz</Dependency></BuildDependencies>"
+         "</Source><Package><Name>foo</Name></Package></PISI>\n")
+
+def write (path, data):
+    directory = os.path.dirname (path)
+    if not os.path.exists (directory):
+        os.makedirs (directory)
+    with open (path, "w") as output:
+        output.write (data)
+
+class BuildCacheTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.root = os.path.join (self.directory, "root")
+        self.pspec = os.path.join (self.directory, "spec", "foo", "pspec.xml")
+        write (self.pspec, PSPEC % "1111")
+        self.install ("bar", "1.0-1")
+        self.packages = os.path.join (self.directory, "packages")
+        write (os.path.join (self.packages, "foo-1.0-1-1.pisi"), "package")
+        self.log = os.path.join (self.directory, "foo-1.0.txt")
+        write (self.log, "build log")
+        write (self.log + ".index", "{}")
+        self.cache = BuildCache (os.path.join (self.directory, "cache"))
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def install (self, name, version):
+        os.makedirs (os.path.join (self.root, buildcache.PISI_PACKAGE_DIR, "%s-%s" % (name, version)))
+
+    def test_installed_and_missing (self):
+        self.assertEqual (installed_packages (self.root), { 'bar': "1.0-1" })
+        self.assertEqual (missing_dependencies (self.pspec, self.root), ["baz"])
+
+    def test_key_follows_everything_built_from (self):
+        key = self.cache.key_for (self.pspec, self.root)
+        self.assertEqual (key, self.cache.key_for (self.pspec, self.root))
+
+        # A build dependency being installed, or upgraded
+        self.install ("baz", "2.0-1")
+        with_baz = self.cache.key_for (self.pspec, self.root)
+        self.assertNotEqual (key, with_baz)
+        shutil.rmtree (os.path.join (self.root, buildcache.PISI_PACKAGE_DIR, "baz-2.0-1"))
+        self.install ("baz", "2.0-2")
+        self.assertNotEqual (with_baz, self.cache.key_for (self.pspec, self.root))
+
+        # Anything in the spec directory, the archives and the salt
+        write (os.path.join (os.path.dirname (self.pspec), "files", "fix.patch"), "patch")
+        patched = self.cache.key_for (self.pspec, self.root)
+        write (self.pspec, PSPEC % "2222")
+        self.assertNotEqual (patched, self.cache.key_for (self.pspec, self.root))
+        salted = BuildCache (os.path.join (self.directory, "cache"), salt="other")
+        self.assertNotEqual (salted.key_for (self.pspec, self.root), self.cache.key_for (self.pspec, self.root))
+
+    def test_store_and_restore (self):
+        self.cache.store ("ab12", self.packages, self.log, self.log + ".index")
+        target = os.path.join (self.directory, "restored")
+        log = os.path.join (self.directory, "restored.txt")
+        write (log + ".index", "stale")
+
+        self.assertTrue (self.cache.restore ("ab12", target, log, log + ".index"))
+        self.assertEqual (os.listdir (target), ["foo-1.0-1-1.pisi"])
+        with open (log, "r") as restored:
+            self.assertEqual (restored.read (), "build log")
+        with open (log + ".index", "r") as index:
+            self.assertEqual (index.read (), "{}")
+        self.assertFalse (self.cache.restore ("cd34", target, log, log + ".index"))
+        self.assertEqual (self.cache.get_stats ()['hits'], 1)
+        self.assertEqual (self.cache.get_stats ()['misses'], 1)
+
+    def test_restore_without_index_removes_stale_one (self):
+        os.unlink (self.log + ".index")
+        self.cache.store ("ab12", self.packages, self.log, self.log + ".index")
+        log = os.path.join (self.directory, "restored.txt")
+        write (log + ".index", "stale")
+        self.assertTrue (self.cache.restore ("ab12", os.path.join (self.directory, "restored"), log, log + ".index"))
+        self.assertFalse (os.path.exists (log + ".index"))
+
+    def test_entry_evicted_while_restoring_is_a_miss (self):
+        self.cache.store ("ab12", self.packages, self.log, self.log + ".index")
+        entry = self.cache._entry ("ab12")
+        place = buildcache._place
+        def evicted (source, target):
+            shutil.rmtree (entry)
+            place (source, target)
+        buildcache._place = evicted
+        try:
+            target = os.path.join (self.directory, "restored")
+            log = os.path.join (self.directory, "restored.txt")
+            self.assertFalse (self.cache.restore ("ab12", target, log, log + ".index"))
+        finally:
+            buildcache._place = place
+        self.assertEqual (os.listdir (target), [])
+        self.assertFalse (os.path.exists (log))
+        self.assertEqual (self.cache.get_stats ()['misses'], 1)
+
+    def test_evicts_least_recently_used (self):
+        for key in ["aa01", "bb02", "cc03"]:
+            self.cache.store (key, self.packages, self.log, self.log + ".index")
+            # Entries are told apart by mtime
+            past = time.time () - 100 + len (self.cache._entries ())
+            os.utime (self.cache._entry (key), (past, past))
+        size = self.cache._entries ()[0][1]
+        self.cache.budget = 2 * size
+        # Using the oldest keeps it
+        self.cache.restore ("aa01", os.path.join (self.directory, "restored"), self.log + ".out", self.log + ".out.index")
+        self.cache.store ("dd04", self.packages, self.log, self.log + ".index")
+
+        remaining = sorted (os.path.basename (entry) for mtime, size, entry in self.cache._entries ())
+        self.assertEqual (remaining, ["aa01", "dd04"])
+        self.assertEqual (self.cache.get_stats ()['evicted'], 2)
+
+    def test_shared_instance (self):
+        path = os.path.join (self.directory, "shared")
+        self.assertTrue (BuildCache.open (path) is BuildCache.open (path + "/"))
+
+if __name__ == "__main__":
+    unittest.main ()
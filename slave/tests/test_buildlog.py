@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+import os
+import os.path
+import re
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+# buildlog and worker import each other, worker has to come first
+from worker import BuildState
+from buildlog import BuildLogger
+
+GREEN = "\x1b[1;32m"
+RESET = "\x1b[0m"
+
+# What pisi build prints, more or less
+BUILD = [
+    "%sBuilding source package: foo%s\n" % (GREEN, RESET),
+    "Fetching source from: http://example.com/foo.tar.gz\n",
+    "foo.tar.gz (1.0 MB) 100% 1.0 MB/s [00:01] [complete]\n",
+    "%sUnpacking archive(s)...%s\n" % (GREEN, RESET),
+    "%sApplying patch: fix-build.patch%s\n" % (GREEN, RESET),
+    "%sSetting up source...%s\n" % (GREEN, RESET),
+    "checking for gcc... gcc\n",
+    "%sBuilding source...%s\n" % (GREEN, RESET),
+    "gcc -c foo.c\n",
+]
+
+def command (stdout, stderr="", returncode=0):
+    ''' A process writing stdout and stderr, then exiting with returncode '''
+    script = "import sys; sys.stdout.write (%r); sys.stdout.flush (); sys.stderr.write (%r); sys.exit (%d)" % (stdout, stderr, returncode)
+    return subprocess.Popen ([sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+class BuildLoggerTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.log_file = os.path.join (self.directory, "foo-1.0.txt")
+        self.states = list ()
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def callback (self, state, *args):
+        self.states.append ((BuildState.reverse_mapping[state],) + args)
+
+    def run_logger (self, process, **kwargs):
+        with open (self.log_file, "w") as log:
+            logger = BuildLogger (process, log, self.callback, **kwargs)
+        process.wait ()
+        with open (self.log_file, "r") as log:
+            return (logger, log.read ())
+
+    def test_phases_and_log (self):
+        logger, log = self.run_logger (command ("".join (BUILD), "warning: unused\n"))
+        self.assertEqual (self.states, [
+            ("STARTED",),
+            ("FETCHING", "http://example.com/foo.tar.gz"),
+            ("UNPACKING",),
+            ("PATCHING", "fix-build.patch"),
+            ("CONFIGURING",),
+            ("BUILDING",),
+        ])
+        # Colour codes stripped and the download progress left out
+        self.assertTrue ("Building source package: foo\n" in log)
+        self.assertFalse ("\x1b" in log)
+        self.assertFalse ("[complete]" in log)
+        self.assertTrue ("gcc -c foo.c\n" in log)
+        self.assertTrue ("warning: unused\n" in log)
+        self.assertEqual (logger.written, len (log))
+
+    def test_busy_stderr_does_not_stall (self):
+        # Far more than a pipe holds, on both at once
+        script = "import sys\nfor i in range (20000):\n    sys.stderr.write ('x' * 79 + '\\n')\n    sys.stdout.write ('y' * 79 + '\\n')\n"
+        process = subprocess.Popen ([sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        logger, log = self.run_logger (process)
+        self.assertEqual (log.count ("x" * 79 + "\n"), 20000)
+        self.assertEqual (log.count ("y" * 79 + "\n"), 20000)
+
+    def test_partial_lines_held_back (self):
+        script = ("import sys, time; sys.stdout.write ('%sBuilding so'); sys.stdout.flush (); time.sleep (0.2); "
+                  "sys.stdout.write ('urce...%s\\n')") % (GREEN, RESET)
+        process = subprocess.Popen ([sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        logger, log = self.run_logger (process)
+        self.assertEqual (self.states, [("BUILDING",)])
+        self.assertEqual (log, "Building source...\n")
+
+    def test_failed_build_keeps_unfinished_line (self):
+        process = command ("gcc -c foo.c\nfoo.c:1: error: broken", "make: *** [all] Error 1", returncode=2)
+        logger, log = self.run_logger (process)
+        self.assertEqual (process.returncode, 2)
+        self.assertTrue ("foo.c:1: error: broken" in log)
+        self.assertTrue ("make: *** [all] Error 1" in log)
+
+    def test_fatal_pattern_aborts (self):
+        script = "import sys, time; sys.stdout.write ('cc1: No space left on device\\n'); sys.stdout.flush (); time.sleep (30)"
+        process = subprocess.Popen ([sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        started = time.time ()
+        logger, log = self.run_logger (process, fatal=re.compile ("No space left|Error [0-9]+"))
+        self.assertTrue (time.time () - started < 10)
+        self.assertEqual (logger.aborted, "cc1: No space left on device")
+        self.assertNotEqual (process.returncode, 0)
+        logger.write_index (BuildLogger.index_file (self.log_file), process.returncode)
+        self.assertEqual (BuildLogger.load_index (self.log_file)['aborted'], "cc1: No space left on device")
+
+    def test_fatal_pattern_custom_abort (self):
+        aborted = list ()
+        process = command ("ok\nmake: *** [all] Error 2\nmore\n")
+        logger, log = self.run_logger (process, fatal=re.compile ("Error [0-9]+"), abort=lambda: aborted.append (True))
+        # Only the first match aborts
+        self.assertEqual ((aborted, logger.aborted), ([True], "make: *** [all] Error 2"))
+
+    def test_fatal_pattern_not_matched (self):
+        process = command ("".join (BUILD))
+        logger, log = self.run_logger (process, fatal=re.compile ("No space left"))
+        self.assertEqual ((logger.aborted, process.returncode), (None, 0))
+
+    def test_index (self):
+        process = command ("".join (BUILD) + "foo.c:1: error: broken\n", returncode=1)
+        logger, log = self.run_logger (process)
+        index_file = BuildLogger.index_file (self.log_file)
+        logger.write_index (index_file, process.returncode)
+        index = BuildLogger.load_index (self.log_file)
+
+        self.assertEqual ((index['size'], index['returncode'], index['aborted']), (len (log), 1, ""))
+        self.assertEqual ([phase['phase'] for phase in index['phases']],
+                          ["STARTED", "FETCHING", "UNPACKING", "PATCHING", "CONFIGURING", "BUILDING"])
+        for phase, line in zip (index['phases'], ["Building source package", "Fetching source", "Unpacking archive",
+                                                   "Applying patch", "Setting up source", "Building source..."]):
+            self.assertTrue (log[phase['offset']:phase['end']].startswith (line), phase)
+        self.assertEqual (index['phases'][-1]['end'], len (log))
+        self.assertEqual ([patch['patch'] for patch in index['patches']], ["fix-build.patch"])
+        self.assertTrue (log[index['patches'][0]['offset']:].startswith ("Applying patch: fix-build.patch"))
+        error = index['errors'][0]
+        self.assertEqual ((error['phase'], error['line']), ("BUILDING", "foo.c:1: error: broken"))
+        self.assertEqual (log[error['offset']:].split ("\n")[0], error['line'])
+
+    def test_no_index (self):
+        self.assertEqual (BuildLogger.load_index (self.log_file), None)
+        with open (BuildLogger.index_file (self.log_file), "w") as index:
+            index.write ("{ torn")
+        self.assertEqual (BuildLogger.load_index (self.log_file), None)
+
+if __name__ == "__main__":
+    unittest.main ()
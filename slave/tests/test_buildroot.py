@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from solusos.mounts import MountManager
+from buildroot import SnapshotManager
+
+@unittest.skipUnless (os.geteuid () == 0, "needs root for mounts")
+class BuildRootTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        # The base is a filesystem of its own, as the worker system is
+        self.base = os.path.join (self.directory, "base")
+        os.makedirs (self.base)
+        self.assertTrue (MountManager.mount ("tmpfs", self.base, filesystem="tmpfs"))
+        for item in ["proc", "dev/shm", "work_dir", "log_dir"]:
+            os.makedirs (os.path.join (self.base, item))
+        with open (os.path.join (self.base, "system"), "w") as system:
+            system.write ("base")
+        self.snapshots = SnapshotManager (self.base, os.path.join (self.directory, "storage"))
+
+    def tearDown (self):
+        self.snapshots.unseal ()
+        MountManager.umount (self.base, lazy=True, recursive=True)
+        shutil.rmtree (self.directory, ignore_errors=True)
+
+    def test_changes_stay_in_the_root (self):
+        root = self.snapshots.get_root ("package")
+        self.assertTrue (root.create (binds=["work_dir"]))
+        try:
+            with open (os.path.join (root.path, "system"), "w") as system:
+                system.write ("changed")
+            with open (os.path.join (root.path, "work_dir", "package.pisi"), "w") as package:
+                package.write ("built")
+            self.assertTrue (MountManager.is_mounted (os.path.join (root.path, "proc")))
+        finally:
+            root.release ()
+
+        with open (os.path.join (self.base, "system"), "r") as system:
+            self.assertEqual (system.read (), "base")
+        # Shared through the bind
+        self.assertTrue (os.path.exists (os.path.join (self.base, "work_dir", "package.pisi")))
+        self.assertEqual (MountManager.mounts_below (root.root_dir), [])
+        self.assertFalse (os.path.exists (root.root_dir))
+
+    def test_failed_mount_leaves_nothing_mounted (self):
+        root = self.snapshots.get_root ("package")
+        missing = os.path.join (self.directory, "missing")
+        self.assertFalse (root.create (host_binds=[(missing, "var/cache/archives")]))
+        self.assertEqual (MountManager.mounts_below (root.root_dir), [])
+        self.assertEqual (root.mounts, [])
+
+    def test_sealed_base_is_read_only (self):
+        self.snapshots.seal ()
+        self.assertRaises (IOError, open, os.path.join (self.base, "new"), "w")
+        # Apart from the shared directories
+        with open (os.path.join (self.base, "log_dir", "package.txt"), "w") as log:
+            log.write ("log")
+        self.snapshots.unseal ()
+        with open (os.path.join (self.base, "new"), "w") as new:
+            new.write ("writable")
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import subprocess
+import unittest
+import uuid
+
+from solusos.cgroup import ProcessGroup
+
+def running (pid):
+    ''' Whether pid is alive, a zombie waiting to be reaped isn't '''
+    try:
+        with open ("/proc/%d/stat" % pid, "r") as stat:
+            return stat.read ().rsplit (")", 1)[1].split ()[0] != "Z"
+    except IOError:
+        return False
+
+class ProcessGroupTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    @unittest.skipUnless (os.geteuid () == 0, "needs root for cgroups")
+    def test_escaped_children_are_killed (self):
+        group = ProcessGroup ("test-%s" % uuid.uuid4 ().hex[:8], self.directory)
+        if group.path is None:
+            self.skipTest ("no usable cgroup hierarchy")
+        # The sleeps daemonize, so only the cgroup still knows about them
+        process = subprocess.Popen (group.wrap ("(sleep 60 &) ; (setsid sleep 60 &)"), shell=True)
+        process.wait ()
+        pids = group.pids ()
+        self.assertTrue (all (running (pid) for pid in pids))
+        self.assertEqual (len (pids), 2)
+
+        self.assertTrue (group.destroy ())
+        self.assertEqual ([pid for pid in pids if running (pid)], [])
+        self.assertFalse (os.path.exists (group.path))
+
+    def test_without_cgroup (self):
+        group = ProcessGroup ("unused", self.directory, cgroup=False)
+        self.assertEqual (group.wrap ("true"), "true")
+        # Nothing is chrooted in there
+        self.assertEqual (group.pids (), [])
+        self.assertTrue (group.destroy ())
+
+if __name__ == "__main__":
+    unittest.main ()
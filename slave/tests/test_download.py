@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+import os
+import os.path
+import re
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from solusos.download import Downloader, file_checksum
+
+class ThreadedHTTPServer (ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FileHandler (BaseHTTPRequestHandler):
+    ''' Serves server.files, with Range support unless server.ranges is off '''
+
+    RANGE = re.compile (r'^bytes=(\d+)-(\d+)$')
+
+    def _serve (self, body):
+        data = self.server.files.get (self.path)
+        if data is None:
+            self.send_error (404)
+            return
+        match = self.RANGE.match (self.headers.getheader ("Range", ""))
+        with self.server.lock:
+            self.server.requests.append ((self.command, self.path, self.headers.getheader ("Range")))
+            truncate = body and match is not None and self.server.truncate > 0
+            if truncate:
+                self.server.truncate -= 1
+            hangup = body and match is not None and self.server.hangup > 0
+            if hangup:
+                self.server.hangup -= 1
+        if hangup:
+            # No response at all, a BadStatusLine for the client
+            self.close_connection = 1
+            return
+        if match is not None and self.server.ranges:
+            start, end = int (match.group (1)), int (match.group (2))
+            self.send_response (206)
+            data = data[start:end + 1]
+        else:
+            self.send_response (200)
+        if self.server.ranges:
+            self.send_header ("Accept-Ranges", "bytes")
+        self.send_header ("Content-Length", str (len (data)))
+        self.end_headers ()
+        if body:
+            # A dropped connection halfway through
+            self.wfile.write (data[:len (data) / 2] if truncate else data)
+
+    def do_GET (self):
+        self._serve (True)
+
+    def do_HEAD (self):
+        self._serve (False)
+
+    def log_message (self, format, *args):
+        pass
+
+class DownloaderTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.server = ThreadedHTTPServer (("127.0.0.1", 0), FileHandler)
+        self.server.lock = threading.Lock ()
+        self.server.requests = list ()
+        self.server.ranges = True
+        self.server.truncate = 0
+        self.server.hangup = 0
+        self.data = os.urandom (300 * 1024)
+        self.checksum = hashlib.sha256 (self.data).hexdigest ()
+        self.server.files = {
+            "/root.image": self.data,
+            "/root.image.sha256": "%s  root.image\n" % self.checksum,
+        }
+        thread = threading.Thread (target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start ()
+        self.url = "http://127.0.0.1:%d/root.image" % self.server.server_address[1]
+        self.target = os.path.join (self.directory, "root.image")
+        self.cache = os.path.join (self.directory, "cache")
+
+    def tearDown (self):
+        self.server.shutdown ()
+        self.server.server_close ()
+        shutil.rmtree (self.directory)
+
+    def downloader (self, **kwargs):
+        downloader = Downloader (**kwargs)
+        downloader.CHUNK_SIZE = 64 * 1024
+        return downloader
+
+    def ranges_fetched (self):
+        return [request for request in self.server.requests if request[0] == "GET" and request[2] is not None]
+
+    def test_parallel_ranges_verified_and_cached (self):
+        progress = list ()
+        downloader = self.downloader (cache_dir=self.cache, callback=lambda done, total: progress.append ((done, total)))
+        self.assertTrue (downloader.fetch (self.url, self.target))
+        self.assertEqual (file_checksum (self.target, "sha256"), self.checksum)
+        self.assertEqual (len (self.ranges_fetched ()), 5)
+        self.assertEqual (progress[-1], (len (self.data), len (self.data)))
+
+        # The cached copy is used from then on
+        os.unlink (self.target)
+        self.server.requests = list ()
+        self.assertTrue (downloader.fetch (self.url, self.target, checksum=self.checksum))
+        self.assertEqual (self.server.requests, [])
+        self.assertEqual (file_checksum (self.target, "sha256"), self.checksum)
+
+    def test_without_range_support (self):
+        self.server.ranges = False
+        self.assertTrue (self.downloader ().fetch (self.url, self.target))
+        self.assertEqual (self.ranges_fetched (), [])
+        self.assertEqual (file_checksum (self.target, "sha256"), self.checksum)
+
+    def test_checksum_mismatch (self):
+        self.assertFalse (self.downloader ().fetch (self.url, self.target, checksum="0" * 40))
+        self.assertFalse (os.path.exists (self.target))
+        self.assertFalse (os.path.exists (self.target + ".part"))
+
+    def test_no_checksum (self):
+        del self.server.files["/root.image.sha256"]
+        self.assertFalse (self.downloader ().fetch (self.url, self.target))
+        self.assertFalse (os.path.exists (self.target))
+
+    def test_dropped_connection_resumes (self):
+        self.server.truncate = 1
+        downloader = self.downloader (connections=1)
+        self.assertFalse (downloader.fetch (self.url, self.target))
+        # What made it is kept for the next attempt
+        self.assertTrue (os.path.exists (self.target + ".part.state"))
+        done = len (self.ranges_fetched ())
+
+        self.server.requests = list ()
+        self.assertTrue (downloader.fetch (self.url, self.target))
+        self.assertEqual (len (self.ranges_fetched ()), 5 - (done - 1))
+        self.assertEqual (file_checksum (self.target, "sha256"), self.checksum)
+        self.assertFalse (os.path.exists (self.target + ".part.state"))
+
+    def test_protocol_error_keeps_state (self):
+        self.server.hangup = 1
+        downloader = self.downloader (connections=1)
+        self.assertFalse (downloader.fetch (self.url, self.target))
+        self.assertTrue (os.path.exists (self.target + ".part.state"))
+        self.assertTrue (downloader.fetch (self.url, self.target))
+        self.assertEqual (file_checksum (self.target, "sha256"), self.checksum)
+
+if __name__ == "__main__":
+    unittest.main ()
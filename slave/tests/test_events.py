@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import shutil
+import tempfile
+import threading
+import time
+import xmlrpclib
+import unittest
+
+from test_media import Controller
+from test_worker import make_worker
+from worker import WorkerState
+from events import EventStream
+
+class SmallStream (EventStream):
+    KEEP = 4
+    MAX_EVENTS = 2
+
+class EventStreamTest (unittest.TestCase):
+
+    def setUp (self):
+        self.events = EventStream ()
+
+    def test_resume_from_seq (self):
+        self.assertEqual (self.events.publish ("imaging", progress=10), 1)
+        self.assertEqual (self.events.publish ("state", slot=0, state="BUSY", errors=None), 2)
+        reply = self.events.since (0)
+        self.assertEqual ((reply['stream'], reply['seq'], reply['missed']), (self.events.id, 2, False))
+        self.assertEqual ([event['type'] for event in reply['events']], ["imaging", "state"])
+        # None can't go over XML-RPC, so it's left out
+        self.assertFalse ('errors' in reply['events'][1])
+        xmlrpclib.dumps ((reply,), methodresponse=True)
+
+        reply = self.events.since (1, stream=self.events.id)
+        self.assertEqual ([event['seq'] for event in reply['events']], [2])
+        reply = self.events.since (2, stream=self.events.id)
+        self.assertEqual ((reply['seq'], reply['events'], reply['missed']), (2, [], False))
+
+    def test_long_poll (self):
+        started = time.time ()
+        self.assertEqual (self.events.since (0, timeout=0.2)['events'], [])
+        self.assertTrue (time.time () - started >= 0.2)
+
+        timer = threading.Timer (0.1, self.events.publish, ["sync"], { 'slot': 0, 'done': True })
+        timer.start ()
+        started = time.time ()
+        reply = self.events.since (0, timeout=10)
+        timer.join ()
+        self.assertEqual ([event['type'] for event in reply['events']], ["sync"])
+        self.assertTrue (time.time () - started < 5)
+
+    def test_missed_events (self):
+        events = SmallStream ()
+        for progress in range (6):
+            events.publish ("imaging", progress=progress)
+        # 1 and 2 were already dropped
+        reply = events.since (0, stream=events.id)
+        self.assertTrue (reply['missed'])
+        self.assertEqual ([event['seq'] for event in reply['events']], [3, 4])
+        reply = events.since (reply['seq'], stream=events.id)
+        self.assertFalse (reply['missed'])
+        self.assertEqual ([event['seq'] for event in reply['events']], [5, 6])
+
+    def test_other_stream (self):
+        self.events.publish ("imaging", progress=10)
+        self.events.publish ("imaging", progress=20)
+        # Numbers from before a restart start over
+        reply = self.events.since (5, stream="restarted")
+        self.assertTrue (reply['missed'])
+        self.assertEqual ([event['seq'] for event in reply['events']], [1, 2])
+
+class PublishTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_imaging_progress (self):
+        controller = Controller (self.directory)
+        controller._set_imaging_progress (50)
+        controller._set_imaging_progress (50)
+        controller._set_imaging_progress (0)
+        reply = controller.get_events (0, 0)
+        self.assertEqual ([(event['type'], event['progress']) for event in reply['events']], [("imaging", 50), ("imaging", 0)])
+
+    def test_worker_states (self):
+        events = EventStream ()
+        worker = make_worker (self.directory)
+        worker.events = events
+        self.assertTrue (worker._begin (WorkerState.BUSY))
+        self.assertFalse (worker._begin (WorkerState.BUSY))
+        worker._finish ()
+        self.assertEqual ([event['state'] for event in events.since (0)['events']], ["BUSY", "IDLE"])
+
+if __name__ == "__main__":
+    unittest.main ()
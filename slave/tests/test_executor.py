@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from test_worker import make_worker
+from worker import WorkerState
+from executor import JobExecutor
+from events import EventStream
+
+def wait_for (condition, timeout=5):
+    deadline = time.time () + timeout
+    while not condition ():
+        if time.time () > deadline:
+            raise AssertionError ("timed out")
+        time.sleep (0.01)
+
+class JobExecutorTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.workers = [make_worker (self.directory)]
+        self.gate = threading.Event ()
+        self.calls = list ()
+        for worker in self.workers:
+            # Public, so that jobs can call them like any Worker method
+            worker.blocking = self.blocking
+            worker.failing = self.failing
+            worker.raising = self.raising
+            worker.building = self.building
+        self.events = EventStream ()
+        self.executor = JobExecutor (self.workers, events=self.events)
+        self.executor.WAIT_INTERVAL = 0.05
+
+    def tearDown (self):
+        self.gate.set ()
+        shutil.rmtree (self.directory)
+
+    def blocking (self, value):
+        self.calls.append (value)
+        self.gate.wait ()
+        return value
+
+    def building (self):
+        worker = self.workers[0]
+        worker._begin (WorkerState.BUILDING)
+        try:
+            self.gate.wait ()
+            return not worker.cancelled
+        finally:
+            worker._finish ()
+
+    def failing (self):
+        self.workers[0].errors = "Failed to build package"
+        return False
+
+    def raising (self):
+        raise Exception ("broken")
+
+    def state (self, job_id):
+        return self.executor.get (job_id)['state']
+
+    def finished (self, job_id):
+        wait_for (lambda: self.state (job_id) in ("DONE", "FAILED", "CANCELLED"))
+        return self.executor.get (job_id)
+
+    def test_result (self):
+        job_id = self.executor.submit ("blocking", ["value"])
+        wait_for (lambda: self.state (job_id) == "RUNNING")
+        self.gate.set ()
+        job = self.finished (job_id)
+        self.assertEqual ((job['state'], job['result'], job['error'], job['slot']), ("DONE", "value", "", 0))
+        states = [event['state'] for event in self.events.since (0)['events'] if event.get ('id') == job_id]
+        self.assertEqual (states, ["QUEUED", "RUNNING", "DONE"])
+        self.assertEqual ([job['id'] for job in self.executor.list ()], [job_id])
+
+    def test_failures (self):
+        job = self.finished (self.executor.submit ("failing", []))
+        self.assertEqual ((job['state'], job['error']), ("FAILED", "Failed to build package"))
+        job = self.finished (self.executor.submit ("raising", []))
+        self.assertEqual ((job['state'], job['error']), ("FAILED", "broken"))
+        self.assertFalse ('result' in job)
+        self.assertEqual (self.executor.get ("unknown"), None)
+
+    def test_refused (self):
+        self.assertRaises (Exception, self.executor.submit, "blocking", ["value"], 1)
+        self.assertRaises (Exception, self.executor.submit, "blocking", ["value"], -1)
+        self.assertRaises (Exception, self.executor.submit, "_begin", [WorkerState.BUSY])
+        self.assertRaises (Exception, self.executor.submit, "missing", [])
+        self.assertEqual (self.executor.list (), [])
+
+    def test_worker_held_while_running (self):
+        job_id = self.executor.submit ("blocking", ["value"])
+        wait_for (lambda: self.state (job_id) == "RUNNING")
+        # A plain RPC can't start anything meanwhile
+        self.assertFalse (self.workers[0]._begin (WorkerState.BUSY))
+        self.gate.set ()
+        self.finished (job_id)
+        wait_for (lambda: self.workers[0].reserved_by is None)
+        self.assertTrue (self.workers[0]._begin (WorkerState.BUSY))
+        self.workers[0]._finish ()
+
+    def test_waits_for_running_operation (self):
+        self.gate.set ()
+        worker = self.workers[0]
+        self.assertTrue (worker._begin (WorkerState.BUSY))
+        job_id = self.executor.submit ("blocking", ["value"])
+        time.sleep (0.2)
+        self.assertEqual ((self.state (job_id), self.calls), ("QUEUED", []))
+        worker._finish ()
+        self.assertEqual (self.finished (job_id)['state'], "DONE")
+
+    def test_cancel_queued (self):
+        first = self.executor.submit ("blocking", ["first"])
+        second = self.executor.submit ("blocking", ["second"])
+        wait_for (lambda: self.state (first) == "RUNNING")
+        self.assertTrue (self.executor.cancel (second))
+        self.assertEqual (self.state (second), "CANCELLED")
+        self.assertFalse (self.executor.cancel (second))
+        # Not a build, so it can't be stopped
+        self.assertFalse (self.executor.cancel (first))
+        self.gate.set ()
+        self.assertEqual (self.finished (first)['state'], "DONE")
+        time.sleep (0.1)
+        self.assertEqual (self.calls, ["first"])
+
+    def test_cancel_running_build (self):
+        job_id = self.executor.submit ("building", [])
+        wait_for (lambda: self.workers[0].state == WorkerState.BUILDING)
+        self.assertTrue (self.executor.cancel (job_id))
+        self.assertEqual (self.state (job_id), "CANCELLED")
+        self.gate.set ()
+        wait_for (lambda: self.executor.get (job_id)['finished'] > 0)
+        job = self.executor.get (job_id)
+        self.assertEqual ((job['state'], job['result']), ("CANCELLED", False))
+
+    def test_cancel_while_waiting_for_worker (self):
+        worker = self.workers[0]
+        self.assertTrue (worker._begin (WorkerState.BUSY))
+        job_id = self.executor.submit ("blocking", ["value"])
+        time.sleep (0.1)
+        self.assertTrue (self.executor.cancel (job_id))
+        worker._finish ()
+        self.gate.set ()
+        # The queue carries on with the next job
+        self.assertEqual (self.finished (self.executor.submit ("blocking", ["next"]))['state'], "DONE")
+        self.assertEqual (self.calls, ["next"])
+
+class TaskTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.workers = [make_worker (self.directory) for slot in range (2)]
+        self.gate = threading.Event ()
+        self.executor = JobExecutor (self.workers, tasks={ 'update_media': self.update_media, 'broken': lambda: False })
+
+    def tearDown (self):
+        self.gate.set ()
+        shutil.rmtree (self.directory)
+
+    def update_media (self):
+        self.gate.wait ()
+        return True
+
+    def test_task_holds_every_worker (self):
+        job_id = self.executor.submit ("update_media", [], slot=5)
+        wait_for (lambda: self.executor.get (job_id)['state'] == "RUNNING")
+        self.assertEqual (self.executor.get (job_id)['slot'], -1)
+        for worker in self.workers:
+            self.assertFalse (worker._begin (WorkerState.BUSY))
+        self.assertFalse (self.executor.cancel (job_id))
+        self.gate.set ()
+        wait_for (lambda: self.executor.get (job_id)['state'] == "DONE")
+
+    def test_failed_task (self):
+        job_id = self.executor.submit ("broken", [])
+        wait_for (lambda: self.executor.get (job_id)['state'] == "FAILED")
+        self.assertEqual (self.executor.get (job_id)['error'], "broken failed")
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import resource
+import subprocess
+import tempfile
+import unittest
+
+from test_worker import make_worker
+from worker import BuildState
+from history import BuildProfile, BuildHistory
+
+def record (name, version, wall, started=0.0):
+    return { 'name': name, 'version': version, 'wall': wall, 'started': started, 'max_rss': 1 << 40,
+             'read_bytes': 0, 'write_bytes': 0 }
+
+class BuildProfileTest (unittest.TestCase):
+
+    def test_phases_and_usage (self):
+        seen = list ()
+        profile = BuildProfile ("foo", "1.0")
+        callback = profile.wrap (lambda state, extra=None: seen.append ((state, extra)))
+        # As if the build had been fetching for two seconds
+        profile.started -= 2
+        profile.phase_started -= 2
+        callback (BuildState.FETCHING)
+        callback (BuildState.BUILDING, "make")
+        callback (BuildState.BUILDING)
+        subprocess.check_call (["dd", "if=/dev/zero", "of=/dev/null", "bs=1M", "count=4"], stderr=open (os.devnull, "w"))
+        profile.finish (True, resource.getrusage (resource.RUSAGE_CHILDREN))
+
+        self.assertEqual (seen, [(BuildState.FETCHING, None), (BuildState.BUILDING, "make"), (BuildState.BUILDING, None)])
+        stored = profile.record ()
+        self.assertEqual (sorted (stored['phases']), ["BUILDING", "FETCHING", "STARTED"])
+        self.assertTrue (stored['phases']['STARTED'] >= 2)
+        self.assertTrue (stored['wall'] >= sum (stored['phases'].values ()) - 0.001)
+        self.assertTrue (stored['result'])
+        self.assertTrue (stored['max_rss'] > 0)
+
+    def test_no_usage (self):
+        profile = BuildProfile ("foo", "1.0")
+        profile.finish (False, None)
+        stored = profile.record ()
+        self.assertFalse (stored['result'])
+        self.assertEqual ((stored['cpu_user'], stored['max_rss'], stored['read_bytes']), (0.0, 0, 0))
+
+class BuildHistoryTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.path = os.path.join (self.directory, "history", "builds")
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_query (self):
+        history = BuildHistory (self.path)
+        history.add (record ("foo", "1.0", 10, started=1))
+        history.add (record ("foo", "2.0", 30, started=2))
+        history.add (record ("bar", "1.0", 20))
+        # A rebuild replaces the record of that version
+        history.add (record ("foo", "1.0", 5, started=3))
+
+        self.assertEqual ([(r['name'], r['wall']) for r in history.query ()], [("foo", 30), ("bar", 20), ("foo", 5)])
+        self.assertEqual ([r['wall'] for r in history.query ("foo")], [30, 5])
+        self.assertEqual (len (history.query (count=1)), 1)
+        self.assertEqual (history.latest ("foo")['version'], "1.0")
+        self.assertEqual (history.latest ("baz"), None)
+
+    def test_reload_skips_torn_lines (self):
+        history = BuildHistory (self.path)
+        history.add (record ("foo", "1.0", 10))
+        with open (self.path, "a") as stored:
+            stored.write ('{"name": "bar", "vers')
+        reloaded = BuildHistory (self.path)
+        self.assertEqual ([r['name'] for r in reloaded.query ()], ["foo"])
+        reloaded.add (record ("baz", "1.0", 1))
+        self.assertEqual (len (BuildHistory (self.path).query ()), 2)
+
+    def test_compaction (self):
+        history = BuildHistory (self.path)
+        for wall in range (200):
+            history.add (record ("foo", "1.0", wall))
+        with open (self.path, "r") as stored:
+            self.assertTrue (len (stored.readlines ()) < 100)
+        self.assertEqual ([r['wall'] for r in BuildHistory (self.path).query ()], [199])
+
+class HistoryRPCTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.worker = make_worker (self.directory)
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_large_counts_are_floats (self):
+        self.worker.history.add (record ("foo", "1.0", 10))
+        records = self.worker.get_build_history ("foo")
+        self.assertEqual (records[0]['max_rss'], float (1 << 40))
+        self.assertTrue (isinstance (records[0]['max_rss'], float))
+        self.assertEqual (self.worker.get_build_history ("bar"), [])
+
+if __name__ == "__main__":
+    unittest.main ()
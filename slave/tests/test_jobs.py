@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import jobs
+from test_worker import make_worker
+from jobs import JobPlanner
+
+GB = 1024 * 1024 * 1024
+
+class FakeHistory:
+
+    def __init__(self, records):
+        self.records = records
+
+    def latest (self, name):
+        return self.records.get (name)
+
+def profile (cpu, max_rss):
+    return { 'cpu_user': cpu, 'cpu_system': 0.0, 'max_rss': max_rss }
+
+class Planner (JobPlanner):
+    ''' A JobPlanner with a fixed amount of memory available '''
+
+    memory = 64 * GB
+
+    def _available_memory (self):
+        return self.memory
+
+class JobPlannerTest (unittest.TestCase):
+
+    def setUp (self):
+        self.load = 0.0
+        self.getloadavg = jobs.os.getloadavg
+        jobs.os.getloadavg = lambda: (self.load, 0.0, 0.0)
+        history = FakeHistory ({
+            'small': profile (10.0, 0),
+            'large': profile (3600.0, 0),
+            'hungry': profile (3600.0, 16 * GB),
+        })
+        self.planner = Planner (history, cap=8)
+        self.planner.cpus = 8
+
+    def tearDown (self):
+        jobs.os.getloadavg = self.getloadavg
+        JobPlanner.in_use = 0
+
+    def test_from_profile (self):
+        self.assertEqual (self.planner.wanted ("unknown"), 8)
+        self.assertEqual (self.planner.wanted ("large"), 8)
+        self.assertEqual (self.planner.wanted ("small"), JobPlanner.SMALL_JOBS)
+        self.assertEqual (self.planner.wanted ("hungry"), 4)
+
+    def test_load_and_memory (self):
+        self.load = 6.5
+        self.assertEqual (self.planner.wanted ("large"), 2)
+        self.load = 0.0
+        self.planner.memory = GB
+        self.assertEqual (self.planner.wanted ("unknown"), 2)
+        # Never less than one, however tight things are
+        self.load = 64.0
+        self.planner.memory = 0
+        self.assertEqual (self.planner.wanted ("hungry"), 1)
+
+    def test_without_loadavg (self):
+        def unavailable ():
+            raise OSError ("no load average")
+        jobs.os.getloadavg = unavailable
+        self.assertEqual (self.planner.wanted ("large"), 8)
+
+    def test_budget_is_shared (self):
+        other = Planner (FakeHistory ({}), cap=8)
+        other.cpus = 8
+        first = self.planner.acquire ("large")
+        second = other.acquire ("unknown")
+        third = self.planner.acquire ("large")
+        self.assertEqual ((first, second, third), (8, 1, 1))
+        self.planner.release (first)
+        self.assertEqual (other.acquire ("unknown"), 6)
+
+class PisiConfTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.worker = make_worker (self.directory)
+        self.root = os.path.join (self.directory, "root")
+        os.makedirs (os.path.join (self.root, "etc/pisi"))
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_jobs_written (self):
+        self.worker._write_pisi_conf (self.root, 3)
+        with open (os.path.join (self.root, "etc/pisi/pisi.conf"), "r") as conf:
+            lines = conf.read ().splitlines ()
+        self.assertTrue ("jobs = -j3" in lines)
+        self.assertFalse ([line for line in lines if "[[[" in line])
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+from solusos.download import file_checksum
+from manifest import MediaManifest, KIND, DATA, CTIME
+
+def write (root, rel, data, mtime=None):
+    fpath = os.path.join (root, rel)
+    if not os.path.exists (os.path.dirname (fpath)):
+        os.makedirs (os.path.dirname (fpath))
+    with open (fpath, "w") as output:
+        output.write (data)
+    if mtime is not None:
+        os.utime (fpath, (mtime, mtime))
+
+class MediaManifestTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.old = os.path.join (self.directory, "old")
+        self.new = os.path.join (self.directory, "new")
+        for root in [self.old, self.new]:
+            write (root, "etc/same", "same", mtime=1000)
+            write (root, "usr/lib/dir/file", "nested", mtime=1000)
+            os.symlink ("same", os.path.join (root, "etc/link"))
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def scan (self, root, **kwargs):
+        return MediaManifest.scan (root, processes=1, **kwargs)
+
+    def test_entries (self):
+        manifest = self.scan (self.old)
+        self.assertEqual (manifest.entries["etc"][KIND], "d")
+        self.assertEqual (manifest.entries["etc/link"][KIND], "l")
+        self.assertEqual (manifest.entries["etc/link"][DATA], "same")
+        self.assertEqual (manifest.entries["etc/same"][DATA], file_checksum (os.path.join (self.old, "etc/same")))
+
+    def test_diff (self):
+        write (self.new, "etc/changed", "new")
+        write (self.old, "etc/changed", "old")
+        # Touched, but the same contents
+        os.utime (os.path.join (self.new, "etc/same"), (2000, 2000))
+        shutil.rmtree (os.path.join (self.new, "usr/lib"))
+        os.unlink (os.path.join (self.new, "etc/link"))
+        os.symlink ("changed", os.path.join (self.new, "etc/link"))
+
+        changed, removed = self.scan (self.old).diff (self.scan (self.new))
+        self.assertEqual (changed, ["etc/changed", "etc/link"])
+        # Deepest first, so directories are emptied before they go
+        self.assertEqual (removed, ["usr/lib/dir/file", "usr/lib/dir", "usr/lib"])
+
+    def test_digests_reused (self):
+        previous = self.scan (self.old)
+        previous.entries["etc/same"][DATA] = "reused"
+        self.assertEqual (self.scan (self.old, previous=previous).entries["etc/same"][DATA], "reused")
+
+    def test_exact_rehashes_anything_written (self):
+        # Past the second the files were written in, so their ctimes are kept
+        time.sleep (1.1)
+        previous = self.scan (self.old)
+        self.assertNotEqual (previous.entries["etc/same"][CTIME], None)
+        # Rewritten the way an upgrade might, size and mtime as they were
+        write (self.old, "etc/same", "SAME", mtime=1000)
+        loose = self.scan (self.old, previous=previous)
+        exact = self.scan (self.old, previous=previous, exact=True)
+        self.assertEqual (loose.entries["etc/same"][DATA], previous.entries["etc/same"][DATA])
+        self.assertEqual (exact.entries["etc/same"][DATA], file_checksum (os.path.join (self.old, "etc/same")))
+        self.assertEqual (previous.diff (exact)[0], ["etc/same"])
+
+    def test_recent_ctime_not_trusted (self):
+        previous = self.scan (self.old)
+        if previous.entries["etc/same"][CTIME] is not None:
+            self.skipTest ("the scan crossed into a new second")
+        # Within the same second, so the ctime alone couldn't tell
+        write (self.old, "etc/same", "SAME", mtime=1000)
+        exact = self.scan (self.old, previous=previous, exact=True)
+        self.assertEqual (previous.diff (exact)[0], ["etc/same"])
+
+    def test_save_and_load (self):
+        path = os.path.join (self.directory, "media.manifest")
+        self.assertEqual (MediaManifest.load (path), None)
+        manifest = self.scan (self.old)
+        manifest.save (path)
+        self.assertEqual (MediaManifest.load (path).entries, manifest.entries)
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from solusos.mounts import MountManager
+from solusos.system import UnderlayManager
+from events import EventStream
+from slave import SlaveController
+
+MB = 1024 * 1024
+
+def have (*tools):
+    with open (os.devnull, "w") as devnull:
+        return all (subprocess.call (["which", tool], stdout=devnull, stderr=devnull) == 0 for tool in tools)
+
+def make_image (path, files=None, size=32 * MB):
+    ''' An ext4 image at path holding files, a dict of path to contents '''
+    UnderlayManager.AllocateImage (path, size, sparse=True)
+    with open (os.devnull, "w") as devnull:
+        subprocess.check_call (["mkfs.ext4", "-F", "-q", path], stdout=devnull, stderr=devnull)
+    if files:
+        with mounted (path) as root:
+            write_files (root, files)
+
+def write_files (root, files):
+    for rel, data in files.iteritems ():
+        fpath = os.path.join (root, rel)
+        if not os.path.exists (os.path.dirname (fpath)):
+            os.makedirs (os.path.dirname (fpath))
+        with open (fpath, "w") as output:
+            output.write (data)
+
+def read_files (root):
+    ''' Every file below root (lost+found aside) and its contents '''
+    files = dict ()
+    for dirpath, dirnames, filenames in os.walk (root):
+        if "lost+found" in dirnames:
+            dirnames.remove ("lost+found")
+        for filename in filenames:
+            fpath = os.path.join (dirpath, filename)
+            with open (fpath, "r") as source:
+                files[os.path.relpath (fpath, root)] = source.read ()
+    return files
+
+class mounted:
+    ''' with mounted (image) as root: the image, mounted read-write '''
+
+    def __init__(self, image):
+        self.image = image
+        self.root = tempfile.mkdtemp ()
+
+    def __enter__(self):
+        if not MountManager.mount (self.image, self.root, options="loop"):
+            raise Exception ("Unable to mount %s" % self.image)
+        return self.root
+
+    def __exit__(self, *args):
+        MountManager.umount (self.root)
+        os.rmdir (self.root)
+
+class Controller (SlaveController):
+    ''' Just the media handling of a SlaveController, on storage '''
+
+    def __init__(self, storage):
+        self.config = { 'Builder': { 'Storage': storage }, 'Settings': {} }
+        self.fs_image = os.path.join (storage, "storage.image")
+        self.fs_info = os.path.join (storage, "storage.info")
+        self.fs_manifest = os.path.join (storage, "media.manifest")
+        self.loop_point = os.path.join (storage, "loopback")
+        self.mount_point = os.path.join (storage, "mountpoint")
+        self.image_source = os.path.join (storage, "system32.image")
+        self.imaging_progress = 0
+        self.events = EventStream ()
+        self.workers = list ()
+
+SYSTEM = {
+    "etc/os-release": "SolusOS 1",
+    "usr/bin/tool": "tool 1",
+    "usr/lib/old.so": "old",
+}
+
+# What install_dbus adds to every root
+DBUS = set (["lib/lsb/init-functions", "etc/rc.d/init.d/dbus"])
+
+@unittest.skipUnless (os.geteuid () == 0, "needs root for mounts")
+@unittest.skipUnless (have ("mkfs.ext4", "rsync"), "needs mkfs.ext4 and rsync")
+class MediaTest (unittest.TestCase):
+
+    def setUp (self):
+        self.storage = tempfile.mkdtemp ()
+        self.controller = Controller (self.storage)
+        make_image (self.controller.image_source, SYSTEM)
+        make_image (self.controller.fs_image)
+
+    def tearDown (self):
+        MountManager.umount (self.storage, lazy=True, recursive=True)
+        for target in MountManager.mounts_below (self.storage):
+            MountManager.umount (target, lazy=True)
+        shutil.rmtree (self.storage)
+
+    def test_sync_new_media (self):
+        self.assertTrue (self.controller.sync_new_media ())
+        with mounted (self.controller.fs_image) as root:
+            files = read_files (root)
+        self.assertEqual (set (files), set (SYSTEM) | DBUS)
+        self.assertEqual (files["usr/bin/tool"], "tool 1")
+        self.assertTrue (os.path.exists (self.controller.fs_manifest))
+        self.assertFalse (MountManager.mounts_below (self.storage))
+
+    def test_sync_without_source (self):
+        os.unlink (self.controller.image_source)
+        self.assertFalse (self.controller.sync_new_media ())
+        self.assertFalse (os.path.exists (self.controller.fs_manifest))
+        self.assertFalse (MountManager.mounts_below (self.storage))
+
+    def test_refresh_media (self):
+        self.assertTrue (self.controller.sync_new_media ())
+        with mounted (self.controller.fs_image) as root:
+            # What the worker does to the root after imaging: new files, and
+            # rewrites that keep the size and mtime of the original
+            write_files (root, { "var/lib/pisi/extra": "extra" })
+            release = os.path.join (root, "etc/os-release")
+            st = os.stat (release)
+            write_files (root, { "etc/os-release": "SolusOS X" })
+            os.utime (release, (st.st_atime, st.st_mtime))
+        with mounted (self.controller.image_source) as root:
+            write_files (root, { "usr/bin/tool": "tool 2", "usr/share/new": "new" })
+            # Like rsync, the image is compared by size and mtime, and a new
+            # image is never built within the same second as the last one
+            tool = os.path.join (root, "usr/bin/tool")
+            os.utime (tool, (os.stat (tool).st_atime, os.stat (tool).st_mtime + 60))
+            shutil.rmtree (os.path.join (root, "usr/lib"))
+
+        self.assertTrue (self.controller.refresh_media ())
+        with mounted (self.controller.fs_image) as root:
+            files = read_files (root)
+        expected = dict (SYSTEM)
+        del expected["usr/lib/old.so"]
+        expected.update ({ "usr/bin/tool": "tool 2", "usr/share/new": "new" })
+        self.assertEqual (set (files), set (expected) | DBUS)
+        for rel, data in expected.iteritems ():
+            self.assertEqual (files[rel], data)
+        self.assertFalse (MountManager.mounts_below (self.storage))
+
+    def test_refresh_without_manifest (self):
+        self.assertTrue (self.controller.sync_new_media ())
+        os.unlink (self.controller.fs_manifest)
+        self.assertFalse (self.controller.refresh_media ())
+        self.assertFalse (MountManager.mounts_below (self.storage))
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from solusos.mounts import MountEntry, MountManager, MS_BIND, MS_RDONLY, MS_REMOUNT, _probe_filesystem
+
+def make_ext4 (path, size=8 * 1024 * 1024):
+    with open (path, "wb") as image:
+        image.truncate (size)
+    with open (os.devnull, "w") as devnull:
+        return subprocess.call (["mkfs.ext4", "-F", "-q", path], stdout=devnull, stderr=devnull) == 0
+
+class MountTableTest (unittest.TestCase):
+
+    def test_mountinfo_line (self):
+        entry = MountEntry ("36 35 98:0 / /mnt/with\\040space rw,noatime master:1 - ext4 /dev/loop0 rw,errors=continue")
+        self.assertEqual ((entry.mount_id, entry.parent_id), (36, 35))
+        self.assertEqual (entry.target, "/mnt/with space")
+        self.assertEqual (entry.options, ["rw", "noatime"])
+        self.assertEqual ((entry.filesystem, entry.source), ("ext4", "/dev/loop0"))
+
+    def test_options (self):
+        self.assertEqual (MountManager._parse_options ("remount,bind,ro"), (MS_REMOUNT | MS_BIND | MS_RDONLY, "", False))
+        self.assertEqual (MountManager._parse_options ("loop,ro,size=10m"), (MS_RDONLY, "size=10m", True))
+        self.assertEqual (MountManager._parse_options (None), (0, "", False))
+
+    def test_probe (self):
+        directory = tempfile.mkdtemp ()
+        try:
+            image = os.path.join (directory, "ext4.image")
+            if not make_ext4 (image):
+                self.skipTest ("mkfs.ext4 not available")
+            self.assertEqual (_probe_filesystem (image), "ext4")
+            with open (os.path.join (directory, "other"), "wb") as other:
+                other.write ("\0" * 4096)
+            self.assertEqual (_probe_filesystem (os.path.join (directory, "other")), None)
+            self.assertEqual (_probe_filesystem (os.path.join (directory, "missing")), None)
+        finally:
+            shutil.rmtree (directory)
+
+@unittest.skipUnless (os.geteuid () == 0, "needs root for mounts")
+class MountManagerTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.target = os.path.join (self.directory, "target")
+        os.makedirs (self.target)
+
+    def tearDown (self):
+        MountManager.umount (self.target, lazy=True, recursive=True)
+        shutil.rmtree (self.directory)
+
+    def test_repeated_mount_is_a_no_op (self):
+        self.assertTrue (MountManager.mount ("tmpfs", self.target, filesystem="tmpfs"))
+        self.assertTrue (MountManager.mount ("tmpfs", self.target, filesystem="tmpfs"))
+        self.assertEqual (MountManager.mounts_below (self.target), [self.target])
+
+    def test_recursive_umount (self):
+        self.assertTrue (MountManager.mount ("tmpfs", self.target, filesystem="tmpfs"))
+        inner = os.path.join (self.target, "inner")
+        os.makedirs (inner)
+        self.assertTrue (MountManager.mount ("tmpfs", inner, filesystem="tmpfs"))
+        self.assertEqual (MountManager.mounts_below (self.target), [inner, self.target])
+        self.assertTrue (MountManager.umount (self.target, recursive=True))
+        self.assertEqual (MountManager.mounts_below (self.target), [])
+
+    def test_loop_mount (self):
+        image = os.path.join (self.directory, "ext4.image")
+        if not make_ext4 (image):
+            self.skipTest ("mkfs.ext4 not available")
+        self.assertTrue (MountManager.mount (image, self.target, options="loop,ro"))
+        self.assertEqual (MountManager.find (self.target).backing_file (), image)
+        self.assertTrue (MountManager.mount (image, self.target, options="loop,ro"))
+        self.assertTrue (MountManager.umount (self.target))
+        self.assertFalse (MountManager.is_mounted (self.target))
+
+    def test_failed_mounts (self):
+        missing = os.path.join (self.directory, "missing.image")
+        self.assertFalse (MountManager.mount (missing, self.target, filesystem="ext4", options="loop"))
+        self.assertFalse (MountManager.mount (missing, self.target, options="bind"))
+        self.assertFalse (MountManager.is_mounted (self.target))
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import urllib2
+import unittest
+
+from repoproxy import RepoProxy
+
+class RepoProxyTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.upstream = os.path.join (self.directory, "upstream")
+        os.makedirs (os.path.join (self.upstream, "f"))
+        self.write ("pisi-index.xml", "index 1")
+        self.write ("f/foo-1.0-1-1.pisi", "foo" * 100)
+        self.write ("f/bar-1.0-1-1.pisi", "bar" * 100)
+        self.cache_dir = os.path.join (self.directory, "cache")
+        self.proxy = self.start ()
+        self.index = self.proxy.add_repo ("main", os.path.join (self.upstream, "pisi-index.xml"))
+
+    def tearDown (self):
+        self.stop (self.proxy)
+        shutil.rmtree (self.directory)
+
+    def start (self, budget=1024 * 1024):
+        proxy = RepoProxy (self.cache_dir, budget)
+        proxy.start ()
+        return proxy
+
+    def stop (self, proxy):
+        proxy.server.shutdown ()
+        proxy.server.server_close ()
+
+    def write (self, rel, data):
+        with open (os.path.join (self.upstream, rel), "w") as output:
+            output.write (data)
+
+    def get (self, rel):
+        return urllib2.urlopen ("http://127.0.0.1:%d/main/%s" % (self.proxy.port, rel)).read ()
+
+    def test_index_revalidated (self):
+        self.assertEqual (self.index, "http://127.0.0.1:%d/main/pisi-index.xml" % self.proxy.port)
+        self.assertEqual (urllib2.urlopen (self.index).read (), "index 1")
+        self.assertEqual (self.get ("pisi-index.xml"), "index 1")
+        self.write ("pisi-index.xml", "index 22")
+        self.assertEqual (self.get ("pisi-index.xml"), "index 22")
+        stats = self.proxy.get_stats ()
+        self.assertEqual ((stats['refreshed'], stats['revalidated']), (2, 1))
+
+    def test_stale_index_when_upstream_is_gone (self):
+        self.get ("pisi-index.xml")
+        shutil.rmtree (self.upstream)
+        self.assertEqual (self.get ("pisi-index.xml"), "index 1")
+        self.assertEqual (self.proxy.get_stats ()['stale'], 1)
+
+    def test_packages_fetched_once (self):
+        self.assertEqual (self.get ("f/foo-1.0-1-1.pisi"), "foo" * 100)
+        os.unlink (os.path.join (self.upstream, "f/foo-1.0-1-1.pisi"))
+        self.assertEqual (self.get ("f/foo-1.0-1-1.pisi"), "foo" * 100)
+        stats = self.proxy.get_stats ()
+        self.assertEqual ((stats['hits'], stats['misses'], stats['bytes_fetched'], stats['bytes_served']), (1, 1, 300.0, 600.0))
+        self.assertEqual (stats['size'], 300.0)
+
+    def test_not_found (self):
+        for rel in ["f/missing.pisi", "../upstream/pisi-index.xml", "f//foo-1.0-1-1.pisi"]:
+            try:
+                self.get (rel)
+                self.fail ("%s was served" % rel)
+            except urllib2.HTTPError, e:
+                self.assertEqual (e.code, 404)
+        self.assertEqual (self.proxy.fetch ("other", "pisi-index.xml"), None)
+        self.assertFalse (os.path.exists (os.path.join (self.cache_dir, "main", "f", "missing.pisi")))
+        self.assertFalse (self.proxy.serving)
+
+    def test_least_recently_used_evicted (self):
+        self.get ("f/foo-1.0-1-1.pisi")
+        os.utime (os.path.join (self.cache_dir, "main", "f", "foo-1.0-1-1.pisi"), (1, 1))
+        self.proxy.budget = 400
+        self.get ("f/bar-1.0-1-1.pisi")
+        self.assertFalse (os.path.exists (os.path.join (self.cache_dir, "main", "f", "foo-1.0-1-1.pisi")))
+        self.assertTrue (os.path.exists (os.path.join (self.cache_dir, "main", "f", "bar-1.0-1-1.pisi")))
+        self.assertEqual (self.proxy.get_stats ()['evicted'], 1)
+
+    def test_package_over_budget_still_served (self):
+        self.proxy.budget = 100
+        self.assertEqual (self.get ("f/foo-1.0-1-1.pisi"), "foo" * 100)
+        # Evicted by the next fetch, once nobody is being served it
+        self.assertEqual (self.get ("f/bar-1.0-1-1.pisi"), "bar" * 100)
+        self.assertFalse (os.path.exists (os.path.join (self.cache_dir, "main", "f", "foo-1.0-1-1.pisi")))
+
+    def test_evict_skips_packages_being_served (self):
+        self.get ("f/foo-1.0-1-1.pisi")
+        cached = os.path.join (self.cache_dir, "main", "f", "foo-1.0-1-1.pisi")
+        self.proxy.serving[cached] = 1
+        self.proxy.budget = 0
+        self.proxy.evict ()
+        self.assertTrue (os.path.exists (cached))
+        del self.proxy.serving[cached]
+        self.proxy.evict ()
+        self.assertFalse (os.path.exists (cached))
+
+    def test_repos_kept_across_restarts (self):
+        self.get ("f/foo-1.0-1-1.pisi")
+        self.stop (self.proxy)
+        self.proxy = self.start ()
+        self.assertEqual (self.proxy.size, 300)
+        self.assertEqual (self.get ("pisi-index.xml"), "index 1")
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+import threading
+import unittest
+
+from reporter import StatusReporter
+
+class Request:
+
+    def __init__(self, name, status):
+        self.name = name
+        self.build_status = status
+
+class Frontend:
+    ''' Stands in for QueueAPI, held up until released '''
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.released = threading.Event ()
+        self.statuses = list ()
+        self.queues = list ()
+
+    def _call (self, calls, queue_id, request):
+        self.released.wait ()
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError ("frontend unreachable")
+        calls.append ((queue_id, request))
+
+    def update_status (self, queue_id, request=None):
+        self._call (self.statuses, queue_id, request)
+
+    def update_queue (self, queue_id, request=None):
+        self._call (self.queues, queue_id, request)
+
+class StatusReporterTest (unittest.TestCase):
+
+    def test_coalesces_while_frontend_is_slow (self):
+        frontend = Frontend ()
+        reporter = StatusReporter (frontend, 7, backoff=0.01)
+        first = Request ("foo", "building")
+        reporter.update_status (first)
+        # Held up on the first, the rest queue behind it
+        for status in ["building", "failed"]:
+            reporter.update_status (Request ("bar", status))
+        for position in range (3):
+            reporter.update_queue (position)
+        frontend.released.set ()
+        reporter.close ()
+
+        self.assertEqual ([(request.name, request.build_status) for queue_id, request in frontend.statuses],
+                          [("foo", "building"), ("bar", "failed")])
+        self.assertEqual (frontend.queues, [(7, 2)])
+        stats = reporter.get_stats ()
+        self.assertEqual ((stats['queued'], stats['sent'], stats['failed'], stats['pending']), (6, 3, 0, 0))
+        self.assertEqual (stats['coalesced'], 3)
+
+    def test_retries_then_gives_up (self):
+        frontend = Frontend (failures=2)
+        frontend.released.set ()
+        reporter = StatusReporter (frontend, 7, retries=1, backoff=0.01)
+        reporter.update_status (Request ("foo", "building"))
+        reporter.update_status (Request ("bar", "building"))
+        reporter.close ()
+
+        # foo failed twice, bar got through
+        self.assertEqual ([request.name for queue_id, request in frontend.statuses], ["bar"])
+        self.assertEqual (reporter.get_stats ()['failed'], 1)
+        self.assertEqual (reporter.get_stats ()['sent'], 1)
+
+if __name__ == "__main__":
+    unittest.main ()
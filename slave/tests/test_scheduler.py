@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+from scheduler import BuildGraph, QueueScheduler
+
+class Item:
+
+    def __init__(self, name):
+        self.name = name
+
+def write_pspec (directory, name, depends):
+    pspec = os.path.join (directory, "%s.xml" % name)
+    deps = "".join ("<Dependency>%s</Dependency>" % dep for dep in depends)
+    with open (pspec, "w") as spec:
+        spec.write ("<PISI><Source><Name>%s</Name><BuildDependencies>%s</BuildDependencies></Source>"
+                    "<Package><Name>%s</Name></Package></PISI>\n" % (name, deps, name))
+    return pspec
+
+class SchedulerTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def graph (self, queue):
+        ''' queue is a list of (name, [build dependency]) '''
+        specs = dict ((name, write_pspec (self.directory, name, depends)) for name, depends in queue)
+        return BuildGraph ([Item (name) for name, depends in queue], lambda item: specs[item.name])
+
+    def test_graph_from_pspecs (self):
+        graph = self.graph ([("a", []), ("b", ["a", "outside"]), ("c", ["b"])])
+        self.assertEqual (graph.requires, { 0: set (), 1: set ([0]), 2: set ([1]) })
+        self.assertEqual (graph.dependents, { 0: set ([1]), 1: set ([2]), 2: set () })
+
+    def test_dependencies_built_first (self):
+        graph = self.graph ([("c", ["b"]), ("b", ["a"]), ("a", []), ("d", [])])
+        order = list ()
+        lock = threading.Lock ()
+        def build (index, position):
+            with lock:
+                order.append (graph.items[index].name)
+            return True
+        reported = list ()
+        results = QueueScheduler (graph, max_parallel=4).run (build, lambda index, result: reported.append ((index, result)))
+
+        self.assertTrue (order.index ("a") < order.index ("b") < order.index ("c"))
+        self.assertEqual (reported, [(0, True), (1, True), (2, True), (3, True)])
+        self.assertEqual (results, { 0: True, 1: True, 2: True, 3: True })
+
+    def test_failure_does_not_block (self):
+        graph = self.graph ([("a", []), ("b", [])])
+        def build (index, position):
+            return index != 0
+        self.assertEqual (QueueScheduler (graph).run (build, lambda index, result: None), { 0: False, 1: True })
+
+    def test_failure_skips_dependents (self):
+        graph = self.graph ([("a", []), ("b", ["a"]), ("c", ["b"]), ("d", [])])
+        built = list ()
+        def build (index, position):
+            built.append (graph.items[index].name)
+            return graph.items[index].name != "a"
+        scheduler = QueueScheduler (graph)
+        results = scheduler.run (build, lambda index, result: None)
+
+        self.assertEqual (sorted (built), ["a", "d"])
+        self.assertEqual (results, { 0: False, 1: False, 2: False, 3: True })
+        self.assertEqual (scheduler.skipped, { 1: "build dependency a failed", 2: "build dependency a failed" })
+
+    def test_failure_without_skipping (self):
+        graph = self.graph ([("a", []), ("b", ["a"])])
+        built = list ()
+        def build (index, position):
+            built.append (graph.items[index].name)
+            return index != 0
+        scheduler = QueueScheduler (graph, skip_dependents=False)
+        results = scheduler.run (build, lambda index, result: None)
+
+        self.assertEqual (built, ["a", "b"])
+        self.assertEqual (results, { 0: False, 1: True })
+        self.assertEqual (scheduler.skipped, {})
+
+    def test_raising_build_fails (self):
+        graph = self.graph ([("a", [])])
+        def build (index, position):
+            raise Exception ("broken")
+        self.assertEqual (QueueScheduler (graph).run (build, lambda index, result: None), { 0: False })
+
+    def test_cycle_falls_back_to_queue_order (self):
+        graph = self.graph ([("a", ["b"]), ("b", ["a"])])
+        order = list ()
+        def build (index, position):
+            order.append (index)
+            return True
+        QueueScheduler (graph).run (build, lambda index, result: None)
+        self.assertEqual (order, [0, 1])
+
+    def test_cancel_stops_new_builds (self):
+        graph = self.graph ([("a", []), ("b", []), ("c", [])])
+        scheduler = QueueScheduler (graph)
+        def build (index, position):
+            scheduler.cancel ()
+            return True
+        self.assertEqual (scheduler.run (build, lambda index, result: None), { 0: True })
+
+if __name__ == "__main__":
+    unittest.main ()
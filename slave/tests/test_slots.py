@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from worker import Worker
+from slots import WorkerSlots
+from slave import SlaveController
+
+class FakeWorker:
+    ''' Just enough of a Worker to tell the slots apart '''
+
+    def __init__(self, slot):
+        self.slot = slot
+
+    def whoami (self, suffix=""):
+        ''' Which slot answered '''
+        return "%d%s" % (self.slot, suffix)
+
+    def _private (self):
+        return self.slot
+
+class WorkerSlotsTest (unittest.TestCase):
+
+    def setUp (self):
+        self.slots = WorkerSlots ([FakeWorker (slot) for slot in range (3)])
+
+    def test_routing (self):
+        self.assertEqual (self.slots._dispatch ("slot2.whoami", ["!"]), "2!")
+        self.assertEqual (self.slots._dispatch ("slot0.whoami", []), "0")
+        # Unprefixed names reach slot 0
+        self.assertEqual (self.slots._dispatch ("whoami", []), "0")
+
+    def test_unknown_slots_refused (self):
+        for method in ["slot3.whoami", "slot-1.whoami", "slotx.whoami"]:
+            self.assertRaises (Exception, self.slots._dispatch, method, [])
+
+    def test_private_methods_refused (self):
+        self.assertRaises (Exception, self.slots._dispatch, "_private", [])
+        self.assertRaises (Exception, self.slots._dispatch, "slot1._private", [])
+
+    def test_introspection (self):
+        methods = self.slots._listMethods ()
+        self.assertEqual (sorted (methods), ["slot0.whoami", "slot1.whoami", "slot2.whoami", "whoami"])
+        self.assertEqual (self.slots._methodHelp ("slot1.whoami"), "Which slot answered")
+        self.assertEqual (self.slots._methodHelp ("slot9.whoami"), "")
+
+class Controller (SlaveController):
+    ''' Only the slot sizing of a SlaveController '''
+
+    def __init__(self, **settings):
+        self.config = { 'Settings': settings }
+
+class SlotCountTest (unittest.TestCase):
+
+    def test_configured (self):
+        self.assertEqual (Controller (Slots="3")._slot_count (), 3)
+        self.assertEqual (Controller (Slots="0")._slot_count (), 1)
+
+    def test_auto (self):
+        self.assertTrue (Controller ()._slot_count () >= 1)
+        self.assertEqual (Controller (Slots="auto")._slot_count (), Controller ()._slot_count ())
+
+class SlotStorageTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        config = {
+            'Frontend': { 'Username': "test", 'Password': "test", 'URL': "127.0.0.1:1" },
+            'Builder': { 'Architecture': "i686", 'Name': "Test", 'Storage': self.directory },
+            'Settings': { 'Autoclean': "True", 'RepoProxyPort': "0" },
+        }
+        self.workers = [Worker (config, slot=slot, slots=2) for slot in range (2)]
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_own_storage_shared_caches (self):
+        first, second = self.workers
+        self.assertEqual (first.fs_image, os.path.join (self.directory, "storage.image"))
+        self.assertEqual (second.fs_image, os.path.join (self.directory, "slots", "1", "storage.image"))
+        self.assertNotEqual (first.mount_point, second.mount_point)
+        self.assertNotEqual (first.session_name, second.session_name)
+        self.assertTrue (first.build_cache is second.build_cache)
+        self.assertTrue (first.repo_proxy is second.repo_proxy)
+
+    def test_slot_info (self):
+        info = WorkerSlots (self.workers)._dispatch ("slot1.get_slot_info", [])
+        self.assertEqual ((info['slot'], info['state'], info['busy'], info['building']), (1, "OFF", False, []))
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from solusos.system import UnderlayManager
+
+MB = 1024 * 1024
+
+def have (*tools):
+    with open (os.devnull, "w") as devnull:
+        return all (subprocess.call (["which", tool], stdout=devnull, stderr=devnull) == 0 for tool in tools)
+
+def debugfs (image, request, write=False):
+    cmd = ["debugfs"] + (["-w"] if write else []) + ["-R", request, image]
+    with open (os.devnull, "w") as devnull:
+        return subprocess.Popen (cmd, stdout=subprocess.PIPE, stderr=devnull).communicate ()[0]
+
+class AllocateImageTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.image = os.path.join (self.directory, "storage.image")
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_sparse (self):
+        UnderlayManager.AllocateImage (self.image, 64 * MB, sparse=True)
+        st = os.stat (self.image)
+        self.assertEqual (st.st_size, 64 * MB)
+        self.assertTrue (st.st_blocks * 512 < MB)
+
+    def test_preallocated_with_progress (self):
+        reported = list ()
+        UnderlayManager.AllocateImage (self.image, 64 * MB, callback=lambda done, total: reported.append ((done, total)))
+        st = os.stat (self.image)
+        self.assertEqual (st.st_size, 64 * MB)
+        # Either reserved, or fell back to sparse where fallocate isn't supported
+        self.assertTrue (st.st_blocks * 512 >= 64 * MB or st.st_blocks * 512 < MB)
+        self.assertEqual (reported[-1], (1, 1))
+        self.assertEqual (reported[0][1], 64 * MB)
+
+    def test_grow_and_shrink_keep_contents (self):
+        with open (self.image, "wb") as image:
+            image.write ("data")
+        UnderlayManager.AllocateImage (self.image, 2 * MB, sparse=True)
+        UnderlayManager.AllocateImage (self.image, MB)
+        self.assertEqual (os.path.getsize (self.image), MB)
+        with open (self.image, "rb") as image:
+            self.assertEqual (image.read (4), "data")
+
+@unittest.skipUnless (have ("mkfs.ext4", "e2fsck", "resize2fs", "debugfs"), "needs e2fsprogs")
+class ResizeImageTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.image = os.path.join (self.directory, "storage.image")
+        UnderlayManager.AllocateImage (self.image, 32 * MB, sparse=True)
+        with open (os.devnull, "w") as devnull:
+            subprocess.check_call (["mkfs.ext4", "-F", "-q", self.image], stdout=devnull, stderr=devnull)
+        source = os.path.join (self.directory, "hello")
+        with open (source, "w") as hello:
+            hello.write ("hello")
+        debugfs (self.image, "write %s hello" % source, write=True)
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_grow_and_shrink (self):
+        self.assertTrue (UnderlayManager.ResizeImage (self.image, 64 * MB, "ext4", sparse=True))
+        self.assertEqual (os.path.getsize (self.image), 64 * MB)
+        self.assertTrue (UnderlayManager.ResizeImage (self.image, 24 * MB, "ext4"))
+        self.assertEqual (os.path.getsize (self.image), 24 * MB)
+        self.assertEqual (debugfs (self.image, "cat hello"), "hello")
+
+    def test_unsupported (self):
+        self.assertFalse (UnderlayManager.ResizeImage (self.image, 64 * MB, "xfs"))
+        # Far smaller than the filesystem can go
+        self.assertFalse (UnderlayManager.ResizeImage (self.image, MB, "ext4"))
+        self.assertEqual (os.path.getsize (self.image), 32 * MB)
+        self.assertEqual (debugfs (self.image, "cat hello"), "hello")
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from solusos.download import file_checksum
+from uploads import UploadManifest
+
+class UploadManifestTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.manifests = os.path.join (self.directory, "uploads")
+        self.package = os.path.join (self.directory, "foo-1.0-1-1.pisi")
+        with open (self.package, "w") as package:
+            package.write ("package")
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_recorded_uploads_persist (self):
+        manifest = UploadManifest (self.manifests, "host", "incoming")
+        checksum = manifest.checksum_for (self.package)
+        self.assertEqual (checksum, file_checksum (self.package))
+        self.assertFalse (manifest.is_uploaded (checksum))
+        manifest.record ([(checksum, self.package)])
+
+        again = UploadManifest (self.manifests, "host", "incoming")
+        self.assertTrue (again.is_uploaded (checksum))
+        # Another target has its own
+        self.assertFalse (UploadManifest (self.manifests, "host", "other").is_uploaded (checksum))
+
+    def test_known_files_are_not_hashed_again (self):
+        manifest = UploadManifest (self.manifests, "host", "incoming")
+        manifest.record ([("0" * 40, self.package)])
+        self.assertEqual (manifest.checksum_for (self.package), "0" * 40)
+
+    def test_changed_file_is_hashed_again (self):
+        manifest = UploadManifest (self.manifests, "host", "incoming")
+        manifest.record ([(manifest.checksum_for (self.package), self.package)])
+        with open (self.package, "w") as package:
+            package.write ("rebuilt")
+        os.utime (self.package, (0, 0))
+        checksum = manifest.checksum_for (self.package)
+        self.assertEqual (checksum, file_checksum (self.package))
+        self.assertFalse (manifest.is_uploaded (checksum))
+
+    def test_damaged_lines_are_skipped (self):
+        manifest = UploadManifest (self.manifests, "host", "incoming")
+        with open (manifest.path, "w") as damaged:
+            damaged.write ("truncated\n%s 7 0 foo-1.0-1-1.pisi\n" % ("1" * 40))
+        self.assertTrue (UploadManifest (self.manifests, "host", "incoming").is_uploaded ("1" * 40))
+
+if __name__ == "__main__":
+    unittest.main ()
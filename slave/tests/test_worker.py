@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+import os
+import os.path
+import json
+import shutil
+import tempfile
+import time
+import unittest
+from configobj import ConfigObj
+
+from worker import Worker
+from buildlog import BuildLogger
+
+def make_worker (storage, **settings):
+    ''' A Worker on storage, whose system is left to each test '''
+    config = {
+        'Frontend': { 'Username': "test", 'Password': "test", 'URL': "127.0.0.1:1" },
+        'Builder': { 'Architecture': "i686", 'Name': "Test", 'Storage': storage },
+        'Settings': { 'Autoclean': "True", 'RepoProxyPort': "0" },
+    }
+    config['Settings'].update (settings)
+    return Worker (config)
+
+class LogTest (unittest.TestCase):
+    ''' Reading build logs, with the system entered as after a build '''
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.worker = make_worker (self.directory)
+        self.worker.env_entered = True
+        self.log_dir = os.path.join (self.worker.mount_point, "log_dir")
+        os.makedirs (self.log_dir)
+        self.log = os.path.join (self.log_dir, "foo-1.0.txt")
+        with open (self.log, "w") as log:
+            log.write ("0123456789")
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_tail_by_offset (self):
+        chunk = self.worker.tail_log ("foo", 0, 4)
+        self.assertEqual ((chunk['data'].data, chunk['offset'], chunk['size'], chunk['complete']), ("0123", 4, 10, True))
+        chunk = self.worker.tail_log ("foo-1.0", chunk['offset'], 100)
+        self.assertEqual ((chunk['data'].data, chunk['offset']), ("456789", 10))
+        # Nothing new yet
+        self.assertEqual (self.worker.tail_log ("foo", 10)['data'].data, "")
+
+    def test_running_build_is_incomplete (self):
+        self.worker.active_logs['foo'] = self.log
+        self.assertFalse (self.worker.tail_log ("foo")['complete'])
+        self.assertFalse (self.worker.tail_log ("foo-1.0")['complete'])
+
+    def test_size_is_clamped (self):
+        self.assertEqual (self.worker.tail_log ("foo", 0, -1)['data'].data, "")
+        chunk = self.worker.tail_log ("foo", 0, Worker.MAX_LOG_CHUNK * 4)
+        self.assertEqual (chunk['data'].data, "0123456789")
+
+    def test_unknown_or_outside_logs (self):
+        self.assertFalse (self.worker.tail_log ("bar"))
+        self.assertFalse (self.worker.tail_log ("../foo-1.0"))
+
+    def test_nothing_read_while_media_is_replaced (self):
+        self.worker.media_offline = True
+        self.assertFalse (self.worker.tail_log ("foo"))
+
+    def test_unmountable_image (self):
+        # Not entered, and there's no image to mount read only
+        self.worker.env_entered = False
+        self.assertFalse (self.worker.tail_log ("foo"))
+
+class LogWindowTest (unittest.TestCase):
+    ''' The index and phase windows of a finished build log '''
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.worker = make_worker (self.directory)
+        self.worker.env_entered = True
+        log_dir = os.path.join (self.worker.mount_point, "log_dir")
+        os.makedirs (log_dir)
+        self.log = os.path.join (log_dir, "foo-1.0.txt")
+        self.phases = [("STARTED", "Building source package: foo\n"), ("CONFIGURING", "checking for gcc... gcc\n"),
+                       ("BUILDING", "gcc -c foo.c\nfoo.c:1: error: broken\n")]
+        index = { 'size': 0, 'returncode': 1, 'phases': [], 'patches': [], 'errors': [], 'aborted': "" }
+        with open (self.log, "w") as log:
+            for phase, data in self.phases:
+                index['phases'].append ({ 'phase': phase, 'offset': index['size'], 'end': index['size'] + len (data) })
+                index['size'] += len (data)
+                log.write (data)
+        error = "foo.c:1: error: broken"
+        index['errors'].append ({ 'offset': index['size'] - len (error) - 1, 'phase': "BUILDING", 'line': error })
+        with open (BuildLogger.index_file (self.log), "w") as output:
+            json.dump (index, output)
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_index (self):
+        index = self.worker.get_log_index ("foo-1.0")
+        self.assertEqual ([phase['phase'] for phase in index['phases']], ["STARTED", "CONFIGURING", "BUILDING"])
+        self.assertEqual (index['returncode'], 1)
+
+    def test_failing_phase_by_default (self):
+        window = self.worker.get_log_window ("foo")
+        self.assertEqual ((window['phase'], window['data'].data, window['returncode']), ("BUILDING", self.phases[2][1], 1))
+        self.assertEqual ([error['line'] for error in window['errors']], ["foo.c:1: error: broken"])
+
+    def test_given_phase (self):
+        window = self.worker.get_log_window ("foo", "CONFIGURING")
+        self.assertEqual ((window['data'].data, window['errors']), (self.phases[1][1], []))
+        self.assertFalse (self.worker.get_log_window ("foo", "TESTING"))
+
+    def test_window_cut_to_its_end (self):
+        window = self.worker.get_log_window ("foo", "", 10)
+        self.assertEqual (window['data'].data, self.phases[2][1][-10:])
+        self.assertEqual ((window['offset'], window['end']), (window['end'] - 10, os.path.getsize (self.log)))
+
+    def test_running_or_unindexed (self):
+        self.worker.active_logs['foo'] = self.log
+        self.assertFalse (self.worker.get_log_index ("foo"))
+        self.assertFalse (self.worker.get_log_window ("foo"))
+        del self.worker.active_logs['foo']
+        os.unlink (BuildLogger.index_file (self.log))
+        self.assertFalse (self.worker.get_log_index ("foo"))
+        self.assertFalse (self.worker.get_log_window ("foo"))
+
+class FatalPatternsTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def patterns (self, line):
+        ''' The fatal pattern of a worker, given the FatalPatterns line of slave.conf '''
+        setting = ConfigObj (["[Settings]", line])["Settings"]["FatalPatterns"]
+        return make_worker (self.directory, FatalPatterns=setting).fatal_patterns
+
+    def test_quoted_list (self):
+        fatal = self.patterns ('FatalPatterns = "No space left on device", "error: [0-9]{1,3} errors"')
+        self.assertTrue (fatal.search ("cc1: No space left on device"))
+        self.assertTrue (fatal.search ("make: error: 12 errors"))
+        self.assertFalse (fatal.search ("error: 1234 errors"))
+
+    def test_single_pattern (self):
+        self.assertTrue (self.patterns ("FatalPatterns = No space left on device").search ("No space left on device"))
+
+    def test_nothing_or_invalid (self):
+        self.assertEqual (self.patterns ("FatalPatterns ="), None)
+        self.assertEqual (self.patterns ('FatalPatterns = "error: (unclosed"'), None)
+
+class EnvironmentTest (unittest.TestCase):
+    ''' Keeping the system entered between calls, entering it is counted '''
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.worker = make_worker (self.directory, EnvironmentIdleTimeout="0.2")
+        self.entered = 0
+        self.exited = 0
+        self.enters = True
+        self.worker._enter_system = self._enter_system
+        self.worker._exit_system = self._exit_system
+        self.worker._system_healthy = lambda: True
+
+    def tearDown (self):
+        self.worker.release_environment ()
+        shutil.rmtree (self.directory)
+
+    def _enter_system (self):
+        self.entered += 1
+        return self.enters
+
+    def _exit_system (self):
+        self.exited += 1
+
+    def test_kept_entered_between_calls (self):
+        for call in range (3):
+            self.assertTrue (self.worker._acquire_system ())
+            self.worker._release_system ()
+        self.assertEqual ((self.entered, self.exited), (1, 0))
+        time.sleep (0.5)
+        self.assertEqual ((self.entered, self.exited), (1, 1))
+        self.assertFalse (self.worker.env_entered)
+
+    def test_release_waits_for_users (self):
+        self.assertTrue (self.worker._acquire_system ())
+        self.assertFalse (self.worker.release_environment ())
+        self.worker._release_system ()
+        self.assertTrue (self.worker.release_environment ())
+        self.assertEqual (self.exited, 1)
+
+    def test_unhealthy_system_entered_again (self):
+        self.assertTrue (self.worker._acquire_system ())
+        self.worker._release_system ()
+        self.worker._system_healthy = lambda: False
+        self.assertTrue (self.worker._acquire_system ())
+        self.worker._release_system ()
+        self.assertEqual ((self.entered, self.exited), (2, 1))
+
+    def test_failing_to_enter (self):
+        self.enters = False
+        self.assertFalse (self.worker._acquire_system ())
+        self.assertEqual (self.worker.env_users, 0)
+        self.assertFalse (self.worker.env_entered)
+
+class EnterSystemTest (unittest.TestCase):
+
+    def setUp (self):
+        self.directory = tempfile.mkdtemp ()
+        self.worker = make_worker (self.directory)
+        os.makedirs (self.worker.mount_point)
+
+    def tearDown (self):
+        shutil.rmtree (self.directory)
+
+    def test_missing_image_is_not_entered (self):
+        self.assertFalse (self.worker._acquire_system ())
+        self.assertEqual (self.worker.errors, "Could not mount %s" % self.worker.fs_image)
+        self.assertFalse (self.worker.env_entered)
+        # Nothing was started in the bare mountpoint
+        self.assertEqual (self.worker.process_groups, {})
+        self.assertEqual (os.listdir (self.worker.mount_point), [])
+
+if __name__ == "__main__":
+    unittest.main ()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+Bookkeeping of packages already uploaded to a repository
+'''
+import os
+import os.path
+import hashlib
+import threading
+
+from solusos.download import file_checksum
+
+class UploadManifest:
+    '''
+    Checksums of every package uploaded to one target, one per line as:
+        sha1 size mtime filename
+
+    The size and mtime let unchanged files skip being hashed again.
+    '''
+
+    def __init__(self, manifest_dir, host, target):
+        if not os.path.exists (manifest_dir):
+            os.makedirs (manifest_dir)
+        name = hashlib.sha1 ("%s::%s" % (host, target)).hexdigest ()
+        self.path = os.path.join (manifest_dir, "%s.manifest" % name)
+        self.lock = threading.Lock ()
+        self.checksums = set ()
+        self.known = dict ()
+        self._load ()
+
+    def _load (self):
+        if not os.path.exists (self.path):
+            return
+        with open (self.path, "r") as manifest:
+            for line in manifest:
+                parts = line.rstrip ("\n").split (" ", 3)
+                if len (parts) != 4:
+                    continue
+                checksum, size, mtime, filename = parts
+                self.checksums.add (checksum)
+                self.known[(filename, int (size), mtime)] = checksum
+
+    def checksum_for (self, path):
+        ''' The sha1 of path, without hashing it again if we've seen it before '''
+        st = os.stat (path)
+        key = (os.path.basename (path), st.st_size, "%d" % st.st_mtime)
+        with self.lock:
+            if key in self.known:
+                return self.known[key]
+        return file_checksum (path)
+
+    def is_uploaded (self, checksum):
+        with self.lock:
+            return checksum in self.checksums
+
+    def record (self, entries):
+        ''' Remember a list of (checksum, path) as successfully uploaded '''
+        with self.lock:
+            with open (self.path, "a") as manifest:
+                for checksum, path in entries:
+                    st = os.stat (path)
+                    filename = os.path.basename (path)
+                    mtime = "%d" % st.st_mtime
+                    manifest.write ("%s %d %s %s\n" % (checksum, st.st_size, mtime, filename))
+                    self.checksums.add (checksum)
+                    self.known[(filename, st.st_size, mtime)] = checksum
@@ -2,6 +2,7 @@
 
 import subprocess
 from solusos.system import SystemManager
+from solusos.cgroup import ProcessGroup
 import os.path
 
 import shutil
@@ -10,10 +11,12 @@ from contextlib import contextmanager
 from remote_api import QueueAPI, QueueRequest, QueueResponse, QueueStatusRequest
 from piston_mini_client.auth import BasicAuthorizer
 
-import glob
 import hashlib
+import xmlrpclib
 
 import multiprocessing
+import threading
+import re
 
 ''' We haven't got enum support in python 2.x '''
 def enum(*sequential, **named):
@@ -28,14 +31,50 @@ Possible build states
 BuildState = enum ('STARTED', 'FETCHING', 'UNPACKING', 'PATCHING', 'CONFIGURING', 'BUILDING', 'TESTING')
 
 from buildlog import BuildLogger
+from buildroot import SnapshotManager
+from buildcache import BuildCache, missing_dependencies
+from reporter import StatusReporter
+from uploads import UploadManifest
+from scheduler import BuildGraph, QueueScheduler
+from history import BuildProfile, BuildHistory
+from jobs import JobPlanner
+from archives import ArchiveCache
+from mirrors import RepoMirror, VCS_TYPES
+from repoproxy import RepoProxy
+from events import EventStream
 
 @contextmanager
 def work_environment (worker):
-    if worker._enter_system ():
-        yield
-        worker._exit_system ()
+    if worker._acquire_system ():
+        try:
+            yield
+        finally:
+            worker._release_system ()
     else:
         worker.errors = "Could not enter system"
+
+@contextmanager
+def log_environment (worker):
+    '''
+    The system's logs readable, yielding whether they are. An entered
+    system is used as it is, otherwise only the image is mounted (read
+    only, no D-BUS) for as long as the block runs
+    '''
+    with worker.env_lock:
+        if worker.media_offline:
+            yield False
+            return
+        if worker.env_entered:
+            # Can't be torn down under us while we hold env_lock
+            yield True
+            return
+        if not SystemManager.mount (worker.fs_image, worker.mount_point, options="loop,ro"):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            SystemManager.umount (worker.mount_point)
         
 
     
@@ -50,8 +89,31 @@ RepoType = enum ('GIT', 'MERCURIAL')
 class Worker:
     
     DATA_DIR = os.path.abspath ("./data")
+
+    # Upper bound for a single tail_log chunk
+    MAX_LOG_CHUNK = 256 * 1024
+
+    # Runs commands in the system, replaced by bench_pipeline.py
+    CHROOT = "chroot"
+
+    # Seconds an unused system stays entered, unless configured otherwise
+    IDLE_TIMEOUT = 300
+
+    # Megabytes of source archives kept, unless configured otherwise
+    ARCHIVE_CACHE_SIZE = 10 * 1024
+
+    # Megabytes of cached build results kept, unless configured otherwise
+    BUILD_CACHE_SIZE = 20 * 1024
+
+    # Megabytes of binary packages the repository proxy keeps, and its port
+    REPO_CACHE_SIZE = 20 * 1024
+    REPO_PROXY_PORT = 9091
+
+    # Where pisi keeps source archives, see data/pisi-template
+    ARCHIVES_DIR = "var/cache/pisi/archives"
     
-    state = WorkerState.OFF
+    # States in which a new operation may start
+    READY_STATES = (WorkerState.IDLE, WorkerState.OFF, WorkerState.FAILED)
     
     config = None
     
@@ -89,43 +151,550 @@ class Worker:
         p.wait ()
         return p.returncode == 0
         
-    def _run_chroot_command_in_system (self, command):
+    def _track_command (self, root, command):
+        '''
+        Have command run in the process group of root, if it has one
         '''
-        Run a CHROOT'd command in our system
+        group = self.process_groups.get (root)
+        if group is None:
+            return command
+        return group.wrap (command)
+
+    def _run_chroot_command_in_system (self, command, root=None):
+        '''
+        Run a CHROOT'd command in our system, or in the given build root
         '''
-        cmd = "chroot \"%s\" %s" % (self.mount_point, command)
+        if root is None:
+            root = self.mount_point
+        cmd = self._track_command (root, "%s \"%s\" %s" % (self.CHROOT, root, command))
         p = subprocess.Popen (cmd, shell=True)
         p.wait ()
         return p.returncode == 0
     
-    def _run_logged_chroot_command_in_system (self, command, filename, callback):
+    def _run_logged_chroot_command_in_system (self, command, filename, callback, root=None, profile=None, fatal=None):
         '''
-        Run a CHROOT'd command in our system, and log
-        it to a file
+        Run a CHROOT'd command in our system (or the given build root),
+        and log it to a file. A BuildProfile is given the phase timings and
+        resource usage of the command. Everything the command started is
+        killed as soon as a line matching fatal is logged
         '''
-        cmd = "chroot \"%s\" %s" % (self.mount_point, command)
+        if root is None:
+            root = self.mount_point
+        if profile is not None:
+            callback = profile.wrap (callback)
+        cmd = self._track_command (root, "%s \"%s\" %s" % (self.CHROOT, root, command))
+        index_file = BuildLogger.index_file (filename)
+        if os.path.exists (index_file):
+            # Would describe the log we're about to replace
+            os.unlink (index_file)
         p = subprocess.Popen (cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         log_file = open (filename, "w")
-        logger = BuildLogger (p, log_file, callback)
-        p.communicate()
-        p.wait ()
+        group = self.process_groups.get (root)
+        logger = BuildLogger (p, log_file, callback, fatal=fatal, abort=group.kill if group is not None else None)
+        p.stdin.close ()
+        p.stdout.close ()
+        p.stderr.close ()
+        # Reaped ourselves, for the usage of the whole (waited for) process tree
+        pid, status, usage = os.wait4 (p.pid, 0)
+        p.returncode = -os.WTERMSIG (status) if os.WIFSIGNALED (status) else os.WEXITSTATUS (status)
         log_file.close ()
+        logger.write_index (index_file, p.returncode)
+        if profile is not None:
+            profile.finish (p.returncode == 0, usage)
         return p.returncode == 0
         
-    def __init__(self, config):
+    def __init__(self, config, slot=0, slots=1, events=None):
         '''
-        Create a new Worker
+        Create a new Worker, in the given slot of slots on this host. Slot 0
+        lives in the Storage directory itself, any others in slots/<N>
+        beneath it, each with their own image and mount tree. Progress is
+        published to the events EventStream
         '''
         self.config = config
-        self.mount_point = os.path.join (self.config["Builder"]["Storage"], "mountpoint")
-        self.fs_image = os.path.join (self.config["Builder"]["Storage"], "storage.image")
+        self.slot = slot
+        self.slots = slots
+        self.events = events if events is not None else EventStream ()
+        # Caches are shared by every slot
+        self.shared_dir = self.config["Builder"]["Storage"]
+        if slot == 0:
+            self.storage_dir = self.shared_dir
+        else:
+            self.storage_dir = os.path.join (self.shared_dir, "slots", str (slot))
+        self.mount_point = os.path.join (self.storage_dir, "mountpoint")
+        self.fs_image = os.path.join (self.storage_dir, "storage.image")
         self.repo_dir = os.path.join (self.mount_point, "repositories")
+        self.snapshots = SnapshotManager (self.mount_point, self.storage_dir)
+
+        # Anything that changes every build invalidates the whole cache
+        with open (os.path.join (self.DATA_DIR, "pisi-template"), "r") as template:
+            salt = "%s\0%s" % (self.config["Builder"]["Architecture"], template.read ())
+        build_budget = int (self.config["Settings"].get ("BuildCacheSize", self.BUILD_CACHE_SIZE)) * 1024 * 1024
+        self.build_cache = BuildCache.open (os.path.join (self.shared_dir, "cache", "builds"), salt=salt, budget=build_budget)
+        self.history = BuildHistory.open (os.path.join (self.shared_dir, "history", "builds"))
+        self.job_planner = JobPlanner (self.history, cap=self._max_jobs ())
+        archive_budget = int (self.config["Settings"].get ("ArchiveCacheSize", self.ARCHIVE_CACHE_SIZE)) * 1024 * 1024
+        self.archives = ArchiveCache.open (os.path.join (self.shared_dir, "cache", "archives"), archive_budget)
+        # Running from the start, as the systems of every slot point at it
+        repo_budget = int (self.config["Settings"].get ("RepoCacheSize", self.REPO_CACHE_SIZE)) * 1024 * 1024
+        repo_port = int (self.config["Settings"].get ("RepoProxyPort", self.REPO_PROXY_PORT))
+        self.repo_proxy = RepoProxy.open (os.path.join (self.shared_dir, "cache", "packages"), repo_budget, port=repo_port)
+        self.sync_stats = { 'files': 0, 'bytes': 0, 'bytes_sent': 0 }
+        # Package name -> log file of the builds currently running
+        self.active_logs = dict ()
+        # Root -> ProcessGroup of the entered system and every build root
+        self.session_name = "worker-%s" % hashlib.sha1 (os.path.abspath (self.mount_point)).hexdigest ()[:8]
+        self.process_groups = dict ()
+        # Only ever changed under state_lock, see _begin
+        self.state_lock = threading.Lock ()
+        self.state_changed = threading.Condition (self.state_lock)
+        self.state = WorkerState.OFF
+        # Thread the worker is held for, see _reserve
+        self.reserved_by = None
+        # Set while the controller replaces our media, see _begin_media_update
+        self.media_offline = False
+        self.cancelled = False
+        self.scheduler = None
         self.auto_clean = True if str(self.config["Settings"]["Autoclean"]).lower() == "true" else False
+        self.skip_dependents = str (self.config["Settings"].get ("SkipDependents", "True")).lower () == "true"
+        self.fatal_patterns = self._fatal_patterns ()
         self.errors = None
+
+        # The entered system is shared between calls, see _acquire_system
+        self.idle_timeout = float (self.config["Settings"].get ("EnvironmentIdleTimeout", self.IDLE_TIMEOUT))
+        self.env_lock = threading.RLock ()
+        self.env_users = 0
+        self.env_entered = False
+        self.env_timer = None
+        self.env_generation = 0
         
+    def _max_parallel_builds (self):
+        '''
+        How many queue items may be built at once, from ParallelBuilds in
+        the Settings section. "auto" (the default) scales with this slot's
+        share of the host
+        '''
+        setting = str (self.config["Settings"].get ("ParallelBuilds", "auto")).lower ()
+        if setting == "auto":
+            return max (1, multiprocessing.cpu_count () / (4 * self.slots))
+        return max (1, int (setting))
+
+    def _max_jobs (self):
+        '''
+        Make jobs shared by every build on this host, from MaxJobs in the
+        Settings section. "auto" (the default) is one more than the cores
+        '''
+        setting = str (self.config["Settings"].get ("MaxJobs", "auto")).lower ()
+        if setting == "auto":
+            return multiprocessing.cpu_count () + 1
+        return max (1, int (setting))
+
+    def _fatal_patterns (self):
+        '''
+        Regular expression for the lines that doom a build, from
+        FatalPatterns in the Settings section (a list is any of them, see
+        slave.conf on quoting). None, the default, never aborts a build
+        '''
+        setting = self.config["Settings"].get ("FatalPatterns", "")
+        if isinstance (setting, (list, tuple)):
+            setting = "|".join ("(?:%s)" % pattern for pattern in setting if pattern)
+        if not setting:
+            return None
+        try:
+            return re.compile (setting, re.MULTILINE)
+        except re.error, e:
+            print "Ignoring FatalPatterns: %s" % e
+            return None
+
+    def _write_pisi_conf (self, root, jobs):
+        ''' Generate etc/pisi/pisi.conf in root from our template '''
+        pisi_local = os.path.join (self.DATA_DIR, "pisi-template")
+        pisi_target = os.path.join (root, "etc/pisi/pisi.conf")
+        with open (pisi_local, "r") as local_pisi_template:
+            lines = local_pisi_template.readlines ()
+            with open (pisi_target, "w") as target_pisi_file:
+                for line in lines:
+                    line = line.replace ("\r","").replace("\n","")
+                    line = line.replace ("[[[JOBCOUNT]]]", "-j%s" % str(jobs))
+                    target_pisi_file.write ("%s\n" % line)
+                target_pisi_file.flush ()
+
+    def _built_packages (self, work_dir, names):
+        '''
+        Chroot paths of the .pisi files built so far for the given packages
+        '''
+        packages = list ()
+        for name in names:
+            package_work_external = os.path.join (self.mount_point, work_dir, name)
+            if not os.path.exists (package_work_external):
+                continue
+            for potential in sorted (os.listdir (package_work_external)):
+                if potential.endswith (".pisi"):
+                    packages.append ("/%s/%s/%s" % (work_dir, name, potential))
+        return packages
+
+    def _build_item (self, item, spec, depends, sandboxed, callback):
+        '''
+        Build a single queue item in its own BuildRoot, after installing the
+        packages already built for its in-queue dependencies
+        '''
+        work_dir = "work_dir"
+        package_work_external = os.path.join (self.mount_point, work_dir, item.name)
+        log_file = os.path.join (self.mount_point, "log_dir", "%s-%s.txt" % (item.name, item.version))
+
+        # Make our temporary working dirs, without stale packages from a previous build
+        if not os.path.exists (package_work_external):
+            os.makedirs (package_work_external)
+        for stale in self._built_packages (work_dir, [item.name]):
+            os.unlink (os.path.join (self.mount_point, stale.lstrip ("/")))
+
+        self.active_logs[item.name] = log_file
+        try:
+            return self._build_item_in_root (item, spec, depends, sandboxed, callback, log_file)
+        finally:
+            del self.active_logs[item.name]
+
+    def _build_item_in_root (self, item, spec, depends, sandboxed, callback, log_file):
+        ''' The actual build of _build_item, from root creation to teardown '''
+        work_dir = "work_dir"
+        package_work = "/%s/%s" % (work_dir, item.name)
+        package_work_external = os.path.join (self.mount_point, work_dir, item.name)
+
+        # Source archives live on the host, so they outlive the root
+        pspec = os.path.join (self.mount_point, spec)
+        staging_name = "%d-%s" % (self.slot, item.name)
+        archives = self.archives.stage (staging_name, pspec)
+
+        root = self.snapshots.get_root (item.name)
+        if not root.create (binds=[work_dir], host_binds=[(archives, self.ARCHIVES_DIR)]):
+            root.release ()
+            self.archives.collect (staging_name, pspec)
+            self.errors = "Could not create build root for %s" % item.name
+            return False
+        group = ProcessGroup ("%s-%s" % (self.session_name, item.name), root.path)
+        self.process_groups[root.path] = group
+        try:
+            dep_packages = self._built_packages (work_dir, depends)
+            if len (dep_packages) > 0:
+                if not self._run_chroot_command_in_system ("pisi install %s" % " ".join (dep_packages), root=root.path):
+                    print "Failed to install dependencies: %s" % " ".join (dep_packages)
+                    self.errors = "Failed to install build dependencies"
+                    return False
+
+            # Whatever pisi build would install from the repositories, so the
+            # cache key sees the versions the build would really use
+            missing = missing_dependencies (pspec, root.path)
+            if len (missing) > 0:
+                if not self._run_chroot_command_in_system ("pisi install -y %s" % " ".join (missing), root=root.path):
+                    print "Failed to install dependencies: %s" % " ".join (missing)
+                    self.errors = "Failed to install build dependencies"
+                    return False
+
+            cache_key = self.build_cache.key_for (pspec, root.path)
+            if self.build_cache.restore (cache_key, package_work_external, log_file, BuildLogger.index_file (log_file)):
+                print "Using cached build of %s" % item.name
+                return True
+
+            ## TODO: Add --ignore-sandbox if specified by controller
+            if sandboxed:
+                cmd = "pisi build -y \"%s\" -O \"%s\"" % (spec, package_work)
+            else:
+                cmd = "pisi build --ignore-sandbox -y \"%s\" -O \"%s\"" % (spec, package_work)
+
+            jobs = self.job_planner.acquire (item.name)
+            try:
+                self._write_pisi_conf (root.path, jobs)
+                profile = BuildProfile (item.name, item.version)
+                built = self._run_logged_chroot_command_in_system (cmd, log_file, callback, root=root.path, profile=profile, fatal=self.fatal_patterns)
+            finally:
+                self.job_planner.release (jobs)
+            record = profile.record ()
+            record['slot'] = self.slot
+            record['jobs'] = jobs
+            self.history.add (record)
+            if not built:
+                self.errors = "Failed to build package"
+                return False
+
+            potential_packages = " ".join (self._built_packages (work_dir, [item.name]))
+            if not self._run_chroot_command_in_system ("pisi install %s" % potential_packages, root=root.path):
+                print "Failed to install packages: %s " % potential_packages
+                self.errors = "Failed to install package"
+                return False
+            # Installed and working.
+            self.build_cache.store (cache_key, package_work_external, log_file, BuildLogger.index_file (log_file))
+            return True
+        finally:
+            group.destroy ()
+            del self.process_groups[root.path]
+            # Keep the root around for inspection when not cleaning up
+            root.release (keep=not self.auto_clean)
+            self.archives.collect (staging_name, pspec)
+
     def _can_continue (self):
-        return (self.state == WorkerState.IDLE or self.state != WorkerState.BUSY)
-        
+        with self.state_lock:
+            return self.state in self.READY_STATES
+
+    def _begin (self, state):
+        '''
+        Move from a ready state to state, as one step so that only one
+        operation can ever win. Returns whether it did, never while the
+        worker is reserved for another thread
+        '''
+        with self.state_lock:
+            if self.state not in self.READY_STATES:
+                return False
+            if self.reserved_by not in (None, threading.current_thread ()):
+                return False
+            self.state = state
+            self.cancelled = False
+        self.events.publish ("state", slot=self.slot, state=WorkerState.reverse_mapping[state])
+        return True
+
+    def _begin_media_update (self):
+        '''
+        Hand the worker over to the controller for replacing its media:
+        BUSY, with the system torn down and nothing (not even log reads)
+        touching the image until _end_media_update
+        '''
+        if not self._begin (WorkerState.BUSY):
+            return False
+        with self.env_lock:
+            if not self.release_environment ():
+                self._finish ()
+                return False
+            self.media_offline = True
+        return True
+
+    def _end_media_update (self):
+        with self.env_lock:
+            self.media_offline = False
+        self._finish ()
+
+    def _reserve (self, timeout):
+        '''
+        Wait up to timeout seconds for no operation to be running, then hold
+        the worker for the calling thread: until _unreserve, only operations
+        it starts can begin. Returns whether it did
+        '''
+        with self.state_lock:
+            if self.state not in self.READY_STATES or self.reserved_by is not None:
+                self.state_changed.wait (timeout)
+            if self.state not in self.READY_STATES or self.reserved_by is not None:
+                return False
+            self.reserved_by = threading.current_thread ()
+            return True
+
+    def _unreserve (self):
+        with self.state_lock:
+            self.reserved_by = None
+            self.state_changed.notify_all ()
+
+    def _finish (self):
+        with self.state_lock:
+            self.state = WorkerState.IDLE
+            self.state_changed.notify_all ()
+        self.events.publish ("state", slot=self.slot, state="IDLE", errors=str (self.errors) if self.errors is not None else None)
+
+    def cancel (self):
+        '''
+        Cancel the running build: nothing new is started and the builds
+        in progress are killed. Any other operation can't be cancelled
+        '''
+        with self.state_lock:
+            if self.state != WorkerState.BUILDING:
+                return False
+            self.cancelled = True
+            scheduler = self.scheduler
+        if scheduler is not None:
+            scheduler.cancel ()
+        for root, group in self.process_groups.items ():
+            if root != self.mount_point:
+                group.kill ()
+        return True
+
+    def reset_build_roots (self):
+        '''
+        Throw away every build root, including any kept for inspection
+        '''
+        if not self._begin (WorkerState.BUSY):
+            return False
+        try:
+            self.snapshots.reset ()
+        finally:
+            self._finish ()
+        return True
+
+    def get_cache_stats (self):
+        '''
+        Hit and miss counts of the build result cache
+        '''
+        return self.build_cache.get_stats ()
+
+    def get_build_history (self, package="", count=0):
+        '''
+        Resource usage of past builds: wall time per phase, CPU time, peak
+        RSS and bytes read and written. For every version of package, or
+        of every package if none is given, the most expensive first
+        '''
+        records = self.history.query (package or None, count)
+        for record in records:
+            # XML-RPC integers are only 32 bit
+            for field in ('max_rss', 'read_bytes', 'write_bytes'):
+                record[field] = float (record[field])
+        return records
+
+    def get_repo_proxy_stats (self):
+        '''
+        Hits, misses and index revalidations of the binary repository proxy
+        '''
+        return self.repo_proxy.get_stats ()
+
+    def get_archive_cache_stats (self):
+        '''
+        Hits and misses of the source archive cache, and the bytes it has
+        saved downloading
+        '''
+        return self.archives.get_stats ()
+
+    def _find_log (self, package):
+        '''
+        Log file for package, given either as a name or as name-version
+        '''
+        if "/" in package or package.startswith ("."):
+            return None
+        if package in self.active_logs:
+            return self.active_logs[package]
+        log_dir = os.path.join (self.mount_point, "log_dir")
+        if not os.path.exists (log_dir):
+            return None
+        for log in os.listdir (log_dir):
+            if not log.endswith (".txt"):
+                continue
+            base = log[:-4]
+            if base == package or base.rsplit ("-", 1)[0] == package:
+                return os.path.join (log_dir, log)
+        return None
+
+    def _log_chunk_size (self, max_size):
+        ''' max_size within 0 and MAX_LOG_CHUNK, as read () takes a negative one as everything '''
+        return max (0, min (max_size, self.MAX_LOG_CHUNK))
+
+    def _read_log_chunk (self, package, offset, max_size):
+        log_file = self._find_log (package)
+        if log_file is None:
+            return None
+        with open (log_file, "rb") as log:
+            log.seek (0, os.SEEK_END)
+            size = log.tell ()
+            offset = min (max (0, offset), size)
+            log.seek (offset)
+            data = log.read (self._log_chunk_size (max_size))
+        return {
+            'data': xmlrpclib.Binary (data),
+            'offset': offset + len (data),
+            'size': size,
+            # active_logs is by bare name, package may be name-version
+            'complete': log_file not in self.active_logs.values (),
+        }
+
+    def tail_log (self, package, offset=0, max_size=MAX_LOG_CHUNK):
+        '''
+        Return up to max_size bytes of the build log for package (a name, or
+        name-version) starting at offset, along with the offset to ask for next
+        '''
+        chunk = None
+        with log_environment (self) as readable:
+            if readable:
+                chunk = self._read_log_chunk (package, offset, max_size)
+        if chunk is None:
+            return False
+        return chunk
+
+    def _read_log_index (self, package):
+        ''' (log file, index) of a finished build log, or (None, None) '''
+        log_file = self._find_log (package)
+        if log_file is None or log_file in self.active_logs.values ():
+            return (None, None)
+        index = BuildLogger.load_index (log_file)
+        if index is None:
+            return (None, None)
+        return (log_file, index)
+
+    def get_log_index (self, package):
+        '''
+        Index of the finished build log for package: the byte range of each
+        phase, the patches applied and the first lines that look like errors
+        '''
+        index = None
+        with log_environment (self) as readable:
+            if readable:
+                log_file, index = self._read_log_index (package)
+        if index is None:
+            return False
+        return index
+
+    def _read_log_window (self, package, phase, max_size):
+        log_file, index = self._read_log_index (package)
+        if index is None:
+            return None
+        phases = [entry for entry in index['phases'] if not phase or entry['phase'] == phase]
+        if phase and not phases:
+            return None
+        start, end = (phases[-1]['offset'], phases[-1]['end']) if phases else (0, index['size'])
+        offset = max (start, end - self._log_chunk_size (max_size))
+        with open (log_file, "rb") as log:
+            log.seek (offset)
+            data = log.read (end - offset)
+        return {
+            'phase': phases[-1]['phase'] if phases else "",
+            'start': start,
+            'end': end,
+            'offset': offset,
+            'data': xmlrpclib.Binary (data),
+            'returncode': index['returncode'],
+            'aborted': index.get ('aborted', ""),
+            'errors': [error for error in index['errors'] if start <= error['offset'] < end],
+        }
+
+    def get_log_window (self, package, phase="", max_size=MAX_LOG_CHUNK):
+        '''
+        Only the part of the finished build log for package written during
+        phase (a BuildState name), by default the last phase, which is the
+        one a failed build failed in. A window bigger than max_size is cut
+        down to its end, where the failure is
+        '''
+        window = None
+        with log_environment (self) as readable:
+            if readable:
+                window = self._read_log_window (package, phase, max_size)
+        if window is None:
+            return False
+        return window
+
+    def get_process_counts (self):
+        '''
+        Number of processes running in the entered system and in each
+        build root, by package name
+        '''
+        counts = { 'system': 0, 'builds': {} }
+        for root, group in self.process_groups.items ():
+            if root == self.mount_point:
+                counts['system'] = group.count ()
+            else:
+                counts['builds'][os.path.basename (os.path.dirname (root))] = group.count ()
+        return counts
+
+    def get_slot_info (self):
+        '''
+        This worker's slot, state and the packages it is building right now
+        '''
+        return {
+            'slot': self.slot,
+            'state': WorkerState.reverse_mapping[self.state],
+            'busy': self.worker_busy (),
+            'building': sorted (self.active_logs.keys ()),
+            'errors': str (self.errors) if self.errors is not None else "",
+        }
 
     def worker_busy (self):
         '''
@@ -133,32 +702,31 @@ class Worker:
         '''
         return not self._can_continue ()
         
-    def add_source_repo (self, uri, vcs, username=None, password=None):
+    def add_source_repo (self, uri, vcs, username=None, password=None, revision=None):
         '''
-        Clone the repository into our system
+        Check out revision (or the head) of the repository into our system,
+        through a local mirror that is updated incrementally
         '''
-        if not self._can_continue ():
+        if vcs not in VCS_TYPES:
+            self.errors = "Unsupported VCS: %s" % vcs
+            return False
+        if not self._begin (WorkerState.BUSY):
             return False
         self.errors = None
-        with work_environment (self):
-            self.state = WorkerState.BUSY
-            if os.path.exists (self.repo_dir):
-                shutil.rmtree (self.repo_dir)
-            os.makedirs (self.repo_dir)
+        try:
+            with work_environment (self):
+                if not os.path.exists (self.repo_dir):
+                    os.makedirs (self.repo_dir)
             
-            parts = uri.split ("//")
-            repo = uri
-            if username is not None and password is not None:
-                repo = "%s//%s:%s@%s" % (parts[0], username, password, parts[1])
-            if vcs == "mercurial":
-                clone = "hg clone %s" % repo
-                if self._run_command_in_system (clone, workDir=self.repo_dir):
-                    self.repo_subdir = os.listdir (self.repo_dir)[0]
-                    subdir = os.path.join (self.repo_dir, self.repo_subdir)
-                    self._run_command_in_system ("hg update", workDir=subdir)
-                else:
+                mirror = RepoMirror (os.path.join (self.shared_dir, "cache", "repos"), uri, vcs, username, password)
+                if not mirror.update ():
                     self.errors = "Failed to clone"
-            self.state = WorkerState.IDLE
+                elif not mirror.checkout (os.path.join (self.repo_dir, mirror.name), revision):
+                    self.errors = "Failed to check out %s" % (revision or "head")
+                else:
+                    self.repo_subdir = mirror.name
+        finally:
+            self._finish ()
             
         return self.errors is None
     
@@ -166,254 +734,427 @@ class Worker:
         '''
         Sync our logs with the selected server
         '''
-        if not self._can_continue ():
+        if not self._begin (WorkerState.SYNCING):
             return False
         self.errors = None
         
-        with work_environment (self):
-            self.state = WorkerState.SYNCING
-            
-            env = os.environ.copy ()
-            env["RSYNC_PASSWORD"] = password
+        try:
+            with work_environment (self):
             
-            work_dir = os.path.join (self.mount_point, "work_dir")
-            upload_dir = os.path.join (self.mount_point, "upload_dir")
-            if os.path.exists (upload_dir):
-                shutil.rmtree (upload_dir)
-            os.mkdir (upload_dir)
+                env = os.environ.copy ()
+                env["RSYNC_PASSWORD"] = password
             
-            for root,dirs,files in os.walk (work_dir):
-                for file in files:
-                    if file.endswith (".pisi"):
-                        fpath = os.path.join (root, file)
-                        shutil.copy2 (fpath, upload_dir)
-                        
-            mapping = {
-                'UploadDir': upload_dir,
-                'User' : username,
-                'Host' : host_address,
-                'Target': target,
-            }
-            cmd = "rsync -avz %(UploadDir)s/  %(User)s@%(Host)s::%(Target)s" % mapping
-            p = subprocess.Popen (cmd, shell=True, stdin=subprocess.PIPE, env=env)
-            p.wait ()
-            
-            if not p.returncode == 0:
-                self.errors = "Failed to sync"
-            self.state = WorkerState.IDLE
+                work_dir = os.path.join (self.mount_point, "work_dir")
+                upload_dir = os.path.join (self.mount_point, "upload_dir")
+                if os.path.exists (upload_dir):
+                    shutil.rmtree (upload_dir)
+                os.mkdir (upload_dir)
+
+                # Only stage what the target hasn't already got
+                manifest = UploadManifest (os.path.join (self.shared_dir, "uploads"), host_address, target)
+                staged = list ()
+                staged_bytes = 0
+                for root,dirs,files in os.walk (work_dir):
+                    for file in files:
+                        if file.endswith (".pisi"):
+                            fpath = os.path.join (root, file)
+                            checksum = manifest.checksum_for (fpath)
+                            if manifest.is_uploaded (checksum):
+                                continue
+                            staged_path = os.path.join (upload_dir, file)
+                            try:
+                                # Same filesystem, no need to copy the data
+                                os.link (fpath, staged_path)
+                            except OSError:
+                                shutil.copy2 (fpath, staged_path)
+                            staged.append ((checksum, fpath))
+                            staged_bytes += os.path.getsize (fpath)
+
+                self.sync_stats = { 'files': len (staged), 'bytes': staged_bytes, 'bytes_sent': 0 }
+                self.events.publish ("sync", slot=self.slot, target=target, files=len (staged), bytes=float (staged_bytes), done=False)
+                if len (staged) > 0:
+                    mapping = {
+                        'UploadDir': upload_dir,
+                        'User' : username,
+                        'Host' : host_address,
+                        'Target': target,
+                    }
+                    # .pisi files are already compressed, so no -z
+                    cmd = "rsync -a --stats --info=progress2 %(UploadDir)s/  %(User)s@%(Host)s::%(Target)s" % mapping
+                    returncode, output = self._run_rsync (cmd, env, target=target)
+
+                    if not returncode == 0:
+                        self.errors = "Failed to sync"
+                    else:
+                        manifest.record (staged)
+                        for line in output.split ("\n"):
+                            if line.startswith ("Total bytes sent:"):
+                                self.sync_stats['bytes_sent'] = int (line.split (":")[1].strip ().replace (",", ""))
+                print "Uploaded %(files)d packages (%(bytes)d bytes, %(bytes_sent)d sent)" % self.sync_stats
+                self.events.publish ("sync", slot=self.slot, target=target, files=len (staged), bytes=float (staged_bytes),
+                                     bytes_sent=float (self.sync_stats['bytes_sent']), done=True, ok=self.errors is None)
+        finally:
+            self._finish ()
         return self.errors is not None
+
+    RSYNC_PROGRESS = re.compile (r'^\s*([\d,]+)\s+(\d+)%')
+
+    def _run_rsync (self, cmd, env, **fields):
+        '''
+        Run an rsync command with --info=progress2, publishing its overall
+        progress as sync events (with fields) at most once per percent.
+        Returns (return code, output)
+        '''
+        p = subprocess.Popen (cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        p.stdin.close ()
+        output = list ()
+        last = -1
+        while True:
+            data = os.read (p.stdout.fileno (), 65536)
+            if not data:
+                break
+            output.append (data)
+            # Progress lines are rewritten in place with \r
+            for line in data.replace ("\r", "\n").split ("\n"):
+                match = self.RSYNC_PROGRESS.match (line)
+                if match is None:
+                    continue
+                percent = int (match.group (2))
+                if percent != last:
+                    last = percent
+                    self.events.publish ("sync", slot=self.slot, done=False, progress=percent,
+                                         bytes_sent=float (match.group (1).replace (",", "")), **fields)
+        p.stdout.close ()
+        p.wait ()
+        return (p.returncode, "".join (output))
+
+    def get_sync_stats (self):
+        '''
+        Files and bytes transferred by the last sync_packages
+        '''
+        stats = dict (self.sync_stats)
+        # XML-RPC integers are only 32 bit
+        stats['bytes'] = float (stats['bytes'])
+        stats['bytes_sent'] = float (stats['bytes_sent'])
+        return stats
                                     
     def sync_logs (self, host_address, target, username, password):
         '''
         Sync our logs with the selected server
         '''
-        if not self._can_continue ():
+        if not self._begin (WorkerState.SYNCING):
             return False
         self.errors = None
         
-        with work_environment (self):
-            self.state = WorkerState.SYNCING
+        try:
+            with work_environment (self):
             
-            env = os.environ.copy ()
-            env["RSYNC_PASSWORD"] = password
+                env = os.environ.copy ()
+                env["RSYNC_PASSWORD"] = password
             
-            log_dir = os.path.join (self.mount_point, "log_dir")
+                log_dir = os.path.join (self.mount_point, "log_dir")
             
-            mapping = {
-                'LogDir': log_dir,
-                'User' : username,
-                'Host' : host_address,
-                'Target': target,
-            }
-            cmd = "rsync -avz %(LogDir)s/ %(User)s@%(Host)s::%(Target)s" % mapping
-            p = subprocess.Popen (cmd, shell=True, stdin=subprocess.PIPE, env=env)
-            p.wait ()
-            if not p.returncode == 0:
-                self.errors = "Failed to sync"
-            self.state = WorkerState.IDLE
+                mapping = {
+                    'LogDir': log_dir,
+                    'User' : username,
+                    'Host' : host_address,
+                    'Target': target,
+                }
+                cmd = "rsync -az --info=progress2 %(LogDir)s/ %(User)s@%(Host)s::%(Target)s" % mapping
+                self.events.publish ("sync", slot=self.slot, target=target, logs=True, done=False)
+                returncode, output = self._run_rsync (cmd, env, target=target, logs=True)
+                if not returncode == 0:
+                    self.errors = "Failed to sync"
+                self.events.publish ("sync", slot=self.slot, target=target, logs=True, done=True, ok=self.errors is None)
+        finally:
+            self._finish ()
         return self.errors is not None
         
     def begin_build (self, queue_id, sandboxed):
         '''
         Build everything in the queue
         '''
-        if not self._can_continue ():
+        if not self._begin (WorkerState.BUILDING):
             return False
         # Reset errors
         self.errors = None
         
-        max_jobs = multiprocessing.cpu_count () + 1
+        max_jobs = multiprocessing.cpu_count () / self.slots + 1
         
-        with work_environment (self):
-            self.state = WorkerState.BUSY
+        try:
+            with work_environment (self):
             
-            # Prechecks: Get a work dir ready
-            work_dir = "work_dir/"
-            work_dir_external = os.path.join (self.mount_point, work_dir)
+                # Prechecks: Get a work dir ready
+                work_dir = "work_dir/"
+                work_dir_external = os.path.join (self.mount_point, work_dir)
             
-            # Log dirs
-            log_dir = "log_dir/"
-            log_dir_external = os.path.join (self.mount_point, log_dir)
+                # Log dirs
+                log_dir = "log_dir/"
+                log_dir_external = os.path.join (self.mount_point, log_dir)
             
-            pisi_local = os.path.join (self.DATA_DIR, "pisi-template")
-            pisi_target = os.path.join (self.mount_point, "etc/pisi/pisi.conf")
-            with open (pisi_local, "r") as local_pisi_template:
-                lines = local_pisi_template.readlines ()
-                with open (pisi_target, "w") as target_pisi_file:
-                    for line in lines:
-                        line = line.replace ("\r","").replace("\n","")
-                        line = line.replace ("[[[JOBCOUNT]]]", "-j%s" % str(max_jobs))
-                        target_pisi_file.write ("%s\n" % line)
-                    target_pisi_file.flush ()
-                    
-            ## Add our building and queue processing here
-            try:
-                web_user = self.config["Frontend"]["Username"]
-                web_pass = self.config["Frontend"]["Password"]
-                auth = BasicAuthorizer (web_user, web_pass)
-                remote = QueueAPI (remote_uri="http://%s/api" % self.config["Frontend"]["URL"], auth=auth)
-                
-                queue = remote.build_queue (queue_id)
-                
-                def log_callback (state, extra=None):
-                    request = None
-                    if state == BuildState.CONFIGURING:
-                        request = QueueRequest (name=item.name, build_status='config')
-                    elif state == BuildState.FETCHING:
-                        request = QueueRequest (name=item.name, build_status='download')
-                    elif state == BuildState.BUILDING:
-                        request = QueueRequest (name=item.name, build_status='build')
-                    
-                    '''      
-                    Not Yet Implemented in UI
-                    -------------------                      
-                    elif state == BuildState.UNPACKING:
-                        request = QueueRequest (name=item.name, build_status='unpack')                                                
-                    elif state == BuildState.STARTED:
-                        request = QueueRequest (name=item.name, build_status='start')
-                    elif state == BuildState.PATCHING:
-                        request = QueueRequest (name=item.name, build_status='patch')
-                    elif state == BuildState.TESTING:
-                        request = QueueRequest (name=item.name, build_status='test')    
-                    '''     
-                    if request is not None:
-                        remote.update_status (queue_id, request=request)
-                    
-                purge = True
-                # Check last queue
-                if self._get_last_queue_hashsum () is not None:
-                    if self._get_last_queue_hashsum () == self._hashsum_for_queue (queue):
-                        print "Encountered repeat queue"
-                        purge = False
-                
-                if purge:
-                    # Clean up for new jobs
-                    if os.path.exists (work_dir_external):
-                        shutil.rmtree (work_dir_external)
-                    if os.path.exists (log_dir_external):
-                        shutil.rmtree (log_dir_external)
-                    os.makedirs (work_dir_external)
-                    os.makedirs (log_dir_external)
-                    
-                # HACK!!!
-                if not os.path.exists (log_dir_external):
-                    os.makedirs (log_dir_external)
-                    
-                # Always store current queue hashsum
-                self._store_queue_hashsum (queue)
-                            
-                current = 0
-                total = len(queue)
-                for item in queue:
-                    current += 1
-                    print "%s - %s" % (item.name, item.version)
+                # Each build gets its own job count, see _build_item_in_root
+                self._write_pisi_conf (self.mount_point, max_jobs)
                     
-                    # Update queue immediately, otherwise the wrong package name is displayed
-                    q = QueueStatusRequest (current=current, package_name=item.name, length=total)
-                    remote.update_queue (queue_id, request=q)
-                    
-                    # full path
-                    fpath_internal = "repositories/%s/%s" % (self.repo_subdir, item.spec_uri)
-                    fpath_external = os.path.join (self.mount_point, fpath_internal)
-                    
-                    if not os.path.exists (fpath_external):
-                        self.errors = "%s not found!" % fpath_internal
-                        # Note: This would happen if the user doesn't reindex.. :)
-                        print self.errors
-                        break
-                    if item.build_status == 'built' and not purge:
-                        print "Skipping already built package"
-                        continue
-                    # Now we're ready to prepare a build :)
-                    package_work = "%s/%s" % (work_dir, item.name)
-                    package_work_external = os.path.join (self.mount_point, package_work)
-                    package_work = "/%s" % package_work
-                    
-                    # Make our temporary working dirs
-                    if not os.path.exists (package_work_external):
-                        os.makedirs (package_work_external)
-                    
-                    ## TODO: Add --ignore-sandbox if specified by controller
-                    if sandboxed:
-                        cmd = "pisi build -y \"%s\" -O \"%s\"" % (fpath_internal, package_work)
-                    else:
-                        cmd = "pisi build --ignore-sandbox -y \"%s\" -O \"%s\"" % (fpath_internal, package_work)                        
-                    log_file = os.path.join (log_dir_external, "%s-%s.txt" % (item.name, item.version))
-                    
-                    # Eventually need callbacks 
-                    if self._run_logged_chroot_command_in_system (cmd, log_file, log_callback):
-                        potential_packages_list = list()
-                        for potential in os.listdir (package_work_external):
-                            potential_packages_list.append ("%s/%s" % (package_work, potential))
-                            
-                        potential_packages = " " .join (potential_packages_list)
-                        if not self._run_chroot_command_in_system ("pisi install %s" % potential_packages):
-                            request = QueueRequest (name=item.name, build_status='fail')
-                            print "Failed to install packages: %s " % potential_packages
-                            self.errors = "Failed to install package"
-                        else:
-                            # Installed and working.
-                            request = QueueRequest (name=item.name, build_status='built')
-                    else:
-                        request = QueueRequest (name=item.name, build_status='fail')
-                        self.errors = "Failed to build package"
-                    remote.update_status (queue_id, request=request)
-                    
-                    # Clean up if requested
-                    if self.auto_clean:
-                        self._run_chroot_command_in_system ("pisi delete-cache")
-                    
-            except Exception, e:
-                self.errors = e
-                print self.errors
-            self.state = WorkerState.IDLE
+                ## Add our building and queue processing here
+                reporter = None
+                try:
+                    web_user = self.config["Frontend"]["Username"]
+                    web_pass = self.config["Frontend"]["Password"]
+                    auth = BasicAuthorizer (web_user, web_pass)
+                    remote = QueueAPI (remote_uri="http://%s/api" % self.config["Frontend"]["URL"], auth=auth)
+
+                    queue = remote.build_queue (queue_id)
+
+                    # From here on the reporter thread owns the API client
+                    reporter = StatusReporter (remote, queue_id)
+                    update_status = reporter.update_status
+                    update_queue = reporter.update_queue
+
+                    def log_callback_for (item):
+                        def log_callback (state, extra=None):
+                            self.events.publish ("build_state", slot=self.slot, package=item.name,
+                                                 state=BuildState.reverse_mapping[state], extra=extra)
+                            request = None
+                            if state == BuildState.CONFIGURING:
+                                request = QueueRequest (name=item.name, build_status='config')
+                            elif state == BuildState.FETCHING:
+                                request = QueueRequest (name=item.name, build_status='download')
+                            elif state == BuildState.BUILDING:
+                                request = QueueRequest (name=item.name, build_status='build')
+
+                            '''
+                            Not Yet Implemented in UI
+                            -------------------
+                            elif state == BuildState.UNPACKING:
+                                request = QueueRequest (name=item.name, build_status='unpack')
+                            elif state == BuildState.STARTED:
+                                request = QueueRequest (name=item.name, build_status='start')
+                            elif state == BuildState.PATCHING:
+                                request = QueueRequest (name=item.name, build_status='patch')
+                            elif state == BuildState.TESTING:
+                                request = QueueRequest (name=item.name, build_status='test')
+                            '''
+                            if request is not None:
+                                update_status (request)
+                        return log_callback
+
+                    purge = True
+                    # Check last queue
+                    if self._get_last_queue_hashsum () is not None:
+                        if self._get_last_queue_hashsum () == self._hashsum_for_queue (queue):
+                            print "Encountered repeat queue"
+                            purge = False
+
+                    if purge:
+                        # Clean up for new jobs
+                        if os.path.exists (work_dir_external):
+                            shutil.rmtree (work_dir_external)
+                        if os.path.exists (log_dir_external):
+                            shutil.rmtree (log_dir_external)
+                        os.makedirs (work_dir_external)
+                        os.makedirs (log_dir_external)
+
+                    # HACK!!!
+                    if not os.path.exists (log_dir_external):
+                        os.makedirs (log_dir_external)
+
+                    # Always store current queue hashsum
+                    self._store_queue_hashsum (queue)
+
+                    def spec_for (item):
+                        return "repositories/%s/%s" % (self.repo_subdir, item.spec_uri)
+
+                    # Don't start hours of building if we can't finish the queue
+                    for item in queue:
+                        fpath_internal = spec_for (item)
+                        if not os.path.exists (os.path.join (self.mount_point, fpath_internal)):
+                            # Note: This would happen if the user doesn't reindex.. :)
+                            raise Exception ("%s not found!" % fpath_internal)
+
+                    graph = BuildGraph (queue, lambda item: os.path.join (self.mount_point, spec_for (item)))
+                    scheduler = QueueScheduler (graph, max_parallel=self._max_parallel_builds (), skip_dependents=self.skip_dependents)
+                    total = len (queue)
+                    already_built = set ()
+
+                    def depends_on (index):
+                        ''' Every in-queue package this item (indirectly) depends on '''
+                        seen = set ()
+                        stack = list (graph.requires[index])
+                        while stack:
+                            dep = stack.pop ()
+                            if dep not in seen:
+                                seen.add (dep)
+                                stack.extend (graph.requires[dep])
+                        return [queue[dep].name for dep in sorted (seen)]
+
+                    def build (index, position):
+                        item = queue[index]
+                        print "%s - %s" % (item.name, item.version)
+
+                        # Update queue immediately, otherwise the wrong package name is displayed
+                        update_queue (QueueStatusRequest (current=position, package_name=item.name, length=total))
+                        self.events.publish ("queue", slot=self.slot, queue=queue_id, current=position, length=total, package=item.name)
+
+                        if item.build_status == 'built' and not purge:
+                            print "Skipping already built package"
+                            already_built.add (index)
+                            return True
+                        return self._build_item (item, spec_for (item), depends_on (index), sandboxed, log_callback_for (item))
+
+                    def report (index, result):
+                        if index in already_built:
+                            return
+                        item = queue[index]
+                        reason = scheduler.skipped.get (index)
+                        if reason is not None:
+                            print "Skipping %s: %s" % (item.name, reason)
+                            # Its log is where anyone looking for why it failed will look
+                            skipped_log = os.path.join (log_dir_external, "%s-%s.txt" % (item.name, item.version))
+                            with open (skipped_log, "w") as log:
+                                log.write ("Not built: %s\n" % reason)
+                            if os.path.exists (BuildLogger.index_file (skipped_log)):
+                                os.unlink (BuildLogger.index_file (skipped_log))
+                        status = 'built' if result else 'fail'
+                        update_status (QueueRequest (name=item.name, build_status=status))
+                        self.events.publish ("build_result", slot=self.slot, package=item.name,
+                                             status='skipped' if reason is not None else status, reason=reason)
+
+                    # Builds only ever see their own snapshot of the system
+                    self.snapshots.reset ()
+                    self.snapshots.seal ()
+                    with self.state_lock:
+                        self.scheduler = scheduler
+                        if self.cancelled:
+                            scheduler.cancel ()
+                    try:
+                        scheduler.run (build, report)
+                    finally:
+                        with self.state_lock:
+                            self.scheduler = None
+                        self.snapshots.unseal ()
+
+                except Exception, e:
+                    self.errors = e
+                    print self.errors
+                if reporter is not None:
+                    reporter.close ()
+                    print "Status updates: %s" % reporter.get_stats ()
+        finally:
+            self._finish ()
         return self.errors is None
         
     def add_binary_repo (self, name, uri):
         '''
         Add a binary (pisi-index.xml) repository to the build system
         '''
-        if not self._can_continue():
+        if not self._begin (WorkerState.BUSY):
             return False
         self.errors = None
-        with work_environment (self):
-            self.state = WorkerState.BUSY
+        try:
+            with work_environment (self):
             
-            ret = self._run_chroot_command_in_system ("pisi add-repo \"%s\" \"%s\"" % (name, uri))
-            # We will need to pay attention to whether add-repo works soon. Repos must be removed
-            # in imaging
-            if not self._run_chroot_command_in_system ("pisi update-repo"):
-                self.errors = "Failed to update repo"
-            self._run_chroot_command_in_system ("pisi upgrade -y")    
-            self.state = WorkerState.IDLE
+                # Everything is installed through our caching proxy
+                local_uri = self.repo_proxy.add_repo (name, uri)
+                self._run_chroot_command_in_system ("pisi remove-repo \"%s\"" % name)
+                ret = self._run_chroot_command_in_system ("pisi add-repo \"%s\" \"%s\"" % (name, local_uri))
+                # We will need to pay attention to whether add-repo works soon. Repos must be removed
+                # in imaging
+                if not self._run_chroot_command_in_system ("pisi update-repo"):
+                    self.errors = "Failed to update repo"
+                self._run_chroot_command_in_system ("pisi upgrade -y")    
+        finally:
+            self._finish ()
             
         return self.errors is None
         
+    def _system_healthy (self):
+        '''
+        Check an entered system is still usable: still mounted, with its
+        virtual filesystems and a running D-BUS
+        '''
+        if not SystemManager.is_mounted (self.mount_point):
+            return False
+        if not os.path.exists (os.path.join (self.proc_dir, "self")):
+            return False
+        try:
+            with open (self.dbus_pid, "r") as pid_file:
+                os.kill (int (pid_file.read().strip()), 0)
+        except (IOError, OSError, ValueError):
+            return False
+        return True
+
+    def _acquire_system (self):
+        '''
+        Enter the system, or reuse it if it's already entered and healthy
+        '''
+        with self.env_lock:
+            if self.env_timer is not None:
+                self.env_timer.cancel ()
+                self.env_timer = None
+            if self.env_entered and not self._system_healthy ():
+                print "Entered system is unhealthy, entering again"
+                self._exit_system ()
+                self.env_entered = False
+            if not self.env_entered:
+                if not self._enter_system ():
+                    return False
+                self.env_entered = True
+            self.env_users += 1
+            return True
+
+    def _release_system (self):
+        '''
+        Drop a reference to the system, which is left entered for the next
+        call until it has been unused for idle_timeout seconds
+        '''
+        with self.env_lock:
+            self.env_users -= 1
+            if self.env_users > 0:
+                return
+            self.env_generation += 1
+            if self.idle_timeout <= 0:
+                self._idle_expired (self.env_generation)
+                return
+            self.env_timer = threading.Timer (self.idle_timeout, self._idle_expired, args=(self.env_generation,))
+            self.env_timer.daemon = True
+            self.env_timer.start ()
+
+    def _idle_expired (self, generation):
+        with self.env_lock:
+            if generation != self.env_generation:
+                # Superseded by a later release
+                return
+            self.env_timer = None
+            if self.env_users == 0 and self.env_entered:
+                self._exit_system ()
+                self.env_entered = False
+
+    def release_environment (self):
+        '''
+        Tear down the entered system now rather than after the idle timeout.
+        Fails if it is still in use
+        '''
+        with self.env_lock:
+            if self.env_users > 0:
+                return False
+            if self.env_timer is not None:
+                self.env_timer.cancel ()
+                self.env_timer = None
+            if self.env_entered:
+                self._exit_system ()
+                self.env_entered = False
+            return True
+
     def _enter_system (self, enableServices=False):
         '''
-        Setup and enter our new system (i.e. mountpoints and such)
+        Setup and enter our new system (i.e. mountpoints and such). Returns
+        whether it did, regardless of errors left over from earlier calls
         '''
-        SystemManager.mount (self.fs_image, self.mount_point, options="loop")
+        if not SystemManager.mount (self.fs_image, self.mount_point, options="loop"):
+            self.errors = "Could not mount %s" % self.fs_image
+            return False
+        self.processes = ProcessGroup (self.session_name, self.mount_point)
+        self.process_groups[self.mount_point] = self.processes
         
         self.dbus_pid = os.path.join (self.mount_point, "var/run/dbus/pid")
         if os.path.exists (self.dbus_pid):
@@ -421,50 +1162,46 @@ class Worker:
             
         self.dbus_service = "/etc/rc.d/init.d/dbus"
         if not self._run_chroot_command_in_system ("%s start" % self.dbus_service):
+            self.processes.destroy ()
+            del self.process_groups[self.mount_point]
             SystemManager.umount (self.mount_point)
             self.errors = "Could not start D-BUS"
-        else:
-            # Let's get some stuff mounted shall we?
-            self.dev_shm_path = os.path.join (self.mount_point, "dev/shm")
-            self.proc_dir = os.path.join (self.mount_point, "proc")
-            SystemManager.mount ("tmpfs", self.dev_shm_path, filesystem="tmpfs")
-            SystemManager.mount ("proc", self.proc_dir, filesystem="proc")
+            return False
+
+        # Let's get some stuff mounted shall we?
+        self.dev_shm_path = os.path.join (self.mount_point, "dev/shm")
+        self.proc_dir = os.path.join (self.mount_point, "proc")
+        if not SystemManager.mount ("tmpfs", self.dev_shm_path, filesystem="tmpfs"):
+            self._exit_system ()
+            self.errors = "Could not mount %s" % self.dev_shm_path
+            return False
+        if not SystemManager.mount ("proc", self.proc_dir, filesystem="proc"):
+            self._exit_system ()
+            self.errors = "Could not mount %s" % self.proc_dir
+            return False
                 
-        return self.errors is None
+        return True
 
-    def murder_death_kill (self, be_gentle=False):
+    def murder_death_kill (self, be_gentle=False, root=None):
         ''' Completely and utterly murder all processes in the chroot :) '''
-        for root in glob.glob ("/proc/*/root"):
-            try:
-                link = os.path.realpath (root)
-                if os.path.abspath (link) == os.path.abspath (self.mount_point):
-                    pid = root.split ("/")[2]
-                    if be_gentle:
-                        os.system ("kill %s" % pid)
-                    else:
-                        os.system ("kill -9 %s" % pid)
-            except:
-                pass
+        if root is None:
+            root = self.mount_point
+        group = self.process_groups.get (root)
+        if group is None:
+            group = ProcessGroup (self.session_name, root, cgroup=False)
+        group.kill (grace=3 if be_gentle else 0)
                         
     def _exit_system (self):
         '''
         Tear down the environment and kill anything running
         '''
-        if hasattr(self, "dev_shm_path"):
-            SystemManager.umount (self.dev_shm_path)
-        if hasattr (self, "proc_dir"):
-            SystemManager.umount (self.proc_dir)
-        
         self._run_chroot_command_in_system ("%s stop" % self.dbus_service)
-            
-        with open (self.dbus_pid, "r") as pid_file:
-            pid = pid_file.read().strip()
-            try:
-                os.system ("kill -9 %s" % pid)  
-            except:
-                pass
-        
-        self.murder_death_kill (be_gentle=True)
-        self.murder_death_kill ()
-                      
-        SystemManager.umount (self.mount_point)
+
+        # D-BUS included, everything started in here is in our process group
+        if not self.processes.destroy ():
+            print "Processes still running in %s" % self.mount_point
+        del self.process_groups[self.mount_point]
+
+        # Takes /proc, /dev/shm and anything left behind with it
+        if not SystemManager.umount (self.mount_point, recursive=True):
+            SystemManager.umount (self.mount_point, lazy=True, recursive=True)
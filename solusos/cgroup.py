@@ -0,0 +1,142 @@
+import os
+import os.path
+import signal
+import time
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_PARENT = "solusos"
+
+def _write (path, value):
+	with open (path, "w") as control:
+		control.write (value)
+
+def _read (path):
+	with open (path, "r") as control:
+		return control.read ()
+
+def _processes_in_root (root):
+	''' Fallback: pids of every process chrooted into root '''
+	root = os.path.abspath (root)
+	pids = list ()
+	for pid in os.listdir ("/proc"):
+		if not pid.isdigit ():
+			continue
+		try:
+			if os.readlink ("/proc/%s/root" % pid) == root:
+				pids.append (int (pid))
+		except OSError:
+			# Gone already, or not ours to look at
+			pass
+	return pids
+
+class ProcessGroup:
+	'''
+	Tracks every process started for a chroot session in its own cgroup, so
+	that forked children can't escape and teardown is a single freeze and
+	kill. Commands must be started through wrap() to be tracked.
+
+	Without a usable cgroup hierarchy (v2, or the v1 freezer) this falls back
+	to scanning /proc for processes chrooted into root. With sweep set, that
+	scan also runs after the cgroup kill, for processes started elsewhere.
+	'''
+
+	def __init__(self, name, root, sweep=False, cgroup=True):
+		self.name = name
+		self.root = root
+		self.sweep = sweep
+		self.path = None
+		self.version = None
+
+		if not cgroup:
+			return
+		if os.path.exists (os.path.join (CGROUP_ROOT, "cgroup.controllers")):
+			path = os.path.join (CGROUP_ROOT, CGROUP_PARENT, name)
+			version = 2
+		elif os.path.exists (os.path.join (CGROUP_ROOT, "freezer")):
+			path = os.path.join (CGROUP_ROOT, "freezer", CGROUP_PARENT, name)
+			version = 1
+		else:
+			return
+		try:
+			if not os.path.exists (path):
+				os.makedirs (path)
+		except OSError, e:
+			print "Unable to create cgroup %s: %s" % (path, e)
+			return
+		self.path = path
+		self.version = version
+
+	def wrap (self, command):
+		''' Shell command that runs command inside our cgroup '''
+		if self.path is None:
+			return command
+		procs = os.path.join (self.path, "cgroup.procs")
+		return "echo $$ > \"%s\" && {\n%s\n}" % (procs, command)
+
+	def pids (self):
+		''' The pids of every process in the session '''
+		if self.path is None:
+			return _processes_in_root (self.root)
+		try:
+			return [int (pid) for pid in _read (os.path.join (self.path, "cgroup.procs")).split ()]
+		except (IOError, ValueError):
+			return list ()
+
+	def count (self):
+		return len (self.pids ())
+
+	def _signal (self, pids, sig):
+		for pid in pids:
+			try:
+				os.kill (pid, sig)
+			except OSError:
+				pass
+
+	def _wait_empty (self, timeout):
+		deadline = time.time () + timeout
+		while time.time () < deadline:
+			if not self.pids ():
+				return True
+			time.sleep (0.05)
+		return not self.pids ()
+
+	def _freeze (self, frozen):
+		if self.version == 2:
+			_write (os.path.join (self.path, "cgroup.freeze"), "1" if frozen else "0")
+		else:
+			_write (os.path.join (self.path, "freezer.state"), "FROZEN" if frozen else "THAWED")
+
+	def kill (self, grace=0, timeout=10):
+		'''
+		Kill everything in the session. With a grace period, processes are
+		first asked to stop with SIGTERM. Returns whether the session
+		emptied within timeout.
+		'''
+		if grace > 0:
+			self._signal (self.pids (), signal.SIGTERM)
+			self._wait_empty (grace)
+
+		if self.path is not None:
+			cgroup_kill = os.path.join (self.path, "cgroup.kill")
+			if os.path.exists (cgroup_kill):
+				_write (cgroup_kill, "1")
+			else:
+				# Freezing first means nothing can fork behind our back
+				self._freeze (True)
+				self._signal (self.pids (), signal.SIGKILL)
+				self._freeze (False)
+			if self.sweep:
+				self._signal (_processes_in_root (self.root), signal.SIGKILL)
+		else:
+			self._signal (self.pids (), signal.SIGKILL)
+		return self._wait_empty (timeout)
+
+	def destroy (self):
+		''' Kill everything and remove the cgroup '''
+		emptied = self.kill ()
+		if self.path is not None and emptied:
+			try:
+				os.rmdir (self.path)
+			except OSError, e:
+				print "Unable to remove cgroup %s: %s" % (self.path, e)
+		return emptied
@@ -0,0 +1,219 @@
+import os
+import os.path
+import hashlib
+import shutil
+import httplib
+import threading
+import urllib2
+
+from solusos.console import *
+
+# Hex digest length -> algorithm, for published checksums
+CHECKSUM_TYPES = {
+	32: "md5",
+	40: "sha1",
+	64: "sha256",
+}
+
+def file_checksum (path, algorithm="sha1"):
+	''' Hex digest of the file at path, read in 1MB blocks '''
+	digest = hashlib.new (algorithm)
+	with open (path, "rb") as source:
+		for block in iter (lambda: source.read (1024 * 1024), ""):
+			digest.update (block)
+	return digest.hexdigest ()
+
+class HeadRequest (urllib2.Request):
+	def get_method (self):
+		return "HEAD"
+
+class Downloader:
+	'''
+	Fetch a file over several parallel HTTP Range requests, resuming from a
+	partial download and verifying a checksum before the file is used.
+
+	Verified files are kept in cache_dir under their checksum, so the same
+	file is never downloaded twice. Without a checksum, one is looked for
+	alongside the file (url + ".sha256").
+	'''
+
+	CHUNK_SIZE = 8 * 1024 * 1024
+	BLOCK_SIZE = 256 * 1024
+
+	def __init__(self, cache_dir=None, connections=4, callback=None):
+		self.cache_dir = cache_dir
+		self.connections = max (1, connections)
+		self.callback = callback
+		self.lock = threading.Lock ()
+		if self.cache_dir is not None and not os.path.exists (self.cache_dir):
+			os.makedirs (self.cache_dir)
+
+	def published_checksum (self, url):
+		''' The checksum published next to url, or None '''
+		try:
+			response = urllib2.urlopen ("%s.sha256" % url)
+			try:
+				published = response.read ().split ()
+			finally:
+				response.close ()
+		except (urllib2.URLError, IOError, httplib.HTTPException):
+			return None
+		if not published or len (published[0]) not in CHECKSUM_TYPES:
+			return None
+		return published[0].lower ()
+
+	def _progress (self, amount):
+		with self.lock:
+			self.done += amount
+			done = self.done
+		if self.callback is not None:
+			self.callback (done, self.total)
+
+	def _fetch_chunk (self, url, part, start, end):
+		request = urllib2.Request (url, headers={ "Range": "bytes=%d-%d" % (start, end) })
+		response = urllib2.urlopen (request)
+		try:
+			if response.getcode () != 206:
+				raise IOError ("Server ignored our range request")
+			received = 0
+			with open (part, "r+b") as output:
+				output.seek (start)
+				while True:
+					buffer = response.read (self.BLOCK_SIZE)
+					if not buffer:
+						break
+					output.write (buffer)
+					received += len (buffer)
+					self._progress (len (buffer))
+			# httplib ends a response cut short quietly, as if complete
+			if received != end - start + 1:
+				raise IOError ("Chunk at %d cut short after %d bytes" % (start, received))
+		finally:
+			response.close ()
+
+	def _fetch_ranges (self, url, part, size):
+		''' Fetch every chunk not yet recorded in the part's state file '''
+		state_file = "%s.state" % part
+		completed = set ()
+		if os.path.exists (part) and os.path.exists (state_file):
+			with open (state_file, "r") as state:
+				completed = set (int (line) for line in state if line.strip ())
+		else:
+			with open (part, "wb") as output:
+				output.truncate (size)
+			open (state_file, "w").close ()
+
+		chunks = list ()
+		for index, start in enumerate (range (0, size, self.CHUNK_SIZE)):
+			end = min (start + self.CHUNK_SIZE, size) - 1
+			if index in completed:
+				self._progress (end - start + 1)
+			else:
+				chunks.append ((index, start, end))
+		chunks.reverse ()
+
+		errors = list ()
+		def worker ():
+			while True:
+				with self.lock:
+					if not chunks or errors:
+						return
+					index, start, end = chunks.pop ()
+				try:
+					self._fetch_chunk (url, part, start, end)
+				except (urllib2.URLError, IOError, httplib.HTTPException), e:
+					with self.lock:
+						errors.append (e)
+					return
+				with self.lock:
+					with open (state_file, "a") as state:
+						state.write ("%d\n" % index)
+
+		threads = [threading.Thread (target=worker) for i in range (self.connections)]
+		for thread in threads:
+			thread.daemon = True
+			thread.start ()
+		for thread in threads:
+			thread.join ()
+		if errors:
+			raise errors[0]
+		os.unlink (state_file)
+
+	def _fetch_stream (self, url, part):
+		''' A plain single stream, for servers without range support '''
+		response = urllib2.urlopen (url)
+		try:
+			with open (part, "wb") as output:
+				while True:
+					buffer = response.read (self.BLOCK_SIZE)
+					if not buffer:
+						break
+					output.write (buffer)
+					self._progress (len (buffer))
+		finally:
+			response.close ()
+
+	def _place (self, source, target):
+		''' Hardlink (or copy) a cached file into place '''
+		if os.path.exists (target):
+			os.unlink (target)
+		try:
+			os.link (source, target)
+		except OSError:
+			shutil.copy2 (source, target)
+
+	def fetch (self, url, target, checksum=None):
+		'''
+		Download url to target, returns whether target now holds a verified
+		copy. Interrupted downloads resume on the next call.
+		'''
+		if checksum is None:
+			checksum = self.published_checksum (url)
+		if checksum is None:
+			print_error ("No checksum available for %s" % url)
+			return False
+		checksum = checksum.lower ()
+		algorithm = CHECKSUM_TYPES.get (len (checksum))
+		if algorithm is None:
+			print_error ("Unknown checksum type: %s" % checksum)
+			return False
+
+		if self.cache_dir is not None:
+			cached = os.path.join (self.cache_dir, checksum)
+			if os.path.exists (cached):
+				self._place (cached, target)
+				return True
+			part = "%s.part" % cached
+		else:
+			cached = None
+			part = "%s.part" % target
+
+		try:
+			head = urllib2.urlopen (HeadRequest (url))
+			try:
+				size = int (head.info ().getheader ("Content-Length", "0"))
+				ranges = head.info ().getheader ("Accept-Ranges", "") == "bytes"
+			finally:
+				head.close ()
+
+			self.done = 0
+			self.total = size
+			if ranges and size > 0:
+				self._fetch_ranges (url, part, size)
+			else:
+				self._fetch_stream (url, part)
+		except (urllib2.URLError, IOError, httplib.HTTPException), e:
+			print_error ("Download of %s failed: %s" % (url, e))
+			return False
+
+		if file_checksum (part, algorithm) != checksum:
+			print_error ("Checksum mismatch for %s" % url)
+			os.unlink (part)
+			return False
+
+		if cached is not None:
+			os.rename (part, cached)
+			self._place (cached, target)
+		else:
+			os.rename (part, target)
+		return True
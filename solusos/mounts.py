@@ -0,0 +1,287 @@
+import os
+import os.path
+import errno
+import fcntl
+import struct
+import ctypes
+import ctypes.util
+import threading
+import subprocess
+
+# <sys/mount.h>
+MS_RDONLY = 1
+MS_NOSUID = 2
+MS_NODEV = 4
+MS_NOEXEC = 8
+MS_REMOUNT = 32
+MS_NOATIME = 1024
+MS_BIND = 4096
+MS_REC = 16384
+
+MNT_FORCE = 1
+MNT_DETACH = 2
+
+# <linux/loop.h>
+LOOP_SET_FD = 0x4C00
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_READ_ONLY = 1
+LO_FLAGS_AUTOCLEAR = 4
+LOOP_INFO64 = "=QQQQQIIII64s64s32sQQ"
+
+FLAG_OPTIONS = {
+	"ro": MS_RDONLY,
+	"rw": 0,
+	"defaults": 0,
+	"nosuid": MS_NOSUID,
+	"nodev": MS_NODEV,
+	"noexec": MS_NOEXEC,
+	"noatime": MS_NOATIME,
+	"remount": MS_REMOUNT,
+	"bind": MS_BIND,
+	"rbind": MS_BIND | MS_REC,
+}
+
+_libc = ctypes.CDLL (ctypes.util.find_library ("c"), use_errno=True)
+_libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+_libc.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+
+def _unescape (field):
+	''' mountinfo escapes spaces, tabs, newlines and backslashes as octal '''
+	if "\\" not in field:
+		return field
+	return field.decode ("string_escape")
+
+def _probe_filesystem (image):
+	''' Guess the filesystem in an image, for mounting it without mount(8) '''
+	try:
+		with open (image, "rb") as img:
+			head = img.read (4)
+			img.seek (1080)
+			ext_magic = img.read (2)
+			img.seek (0x10040)
+			btrfs_magic = img.read (8)
+	except IOError:
+		return None
+	if head == "hsqs":
+		return "squashfs"
+	if head == "XFSB":
+		return "xfs"
+	if ext_magic == "\x53\xef":
+		# The kernel's ext4 driver handles ext2 and ext3 too
+		return "ext4"
+	if btrfs_magic == "_BHRfS_M":
+		return "btrfs"
+	return None
+
+class MountEntry:
+	''' A single line of /proc/self/mountinfo '''
+
+	def __init__(self, line):
+		fields = line.split ()
+		separator = fields.index ("-")
+		self.mount_id = int (fields[0])
+		self.parent_id = int (fields[1])
+		self.root = _unescape (fields[3])
+		self.target = _unescape (fields[4])
+		self.options = fields[5].split (",")
+		self.filesystem = fields[separator + 1]
+		self.source = _unescape (fields[separator + 2])
+
+	def backing_file (self):
+		''' The image behind a loop mount, or None '''
+		device = os.path.basename (self.source)
+		if not device.startswith ("loop"):
+			return None
+		try:
+			with open ("/sys/block/%s/loop/backing_file" % device, "r") as backing:
+				return backing.read ().strip ()
+		except IOError:
+			return None
+
+class MountManager:
+	'''
+	mount/umount through the syscalls rather than mount(8), with knowledge of
+	what is already mounted (from /proc/self/mountinfo) so that repeated
+	mounts are no-ops and unmounts can be recursive.
+	'''
+
+	lock = threading.RLock ()
+
+	@staticmethod
+	def mount_table ():
+		''' Every current mount, in mount order '''
+		with open ("/proc/self/mountinfo", "r") as info:
+			return [MountEntry (line) for line in info if line.strip ()]
+
+	@staticmethod
+	def find (target):
+		''' The topmost mount at target, or None '''
+		target = os.path.abspath (target)
+		found = None
+		for entry in MountManager.mount_table ():
+			if entry.target == target:
+				found = entry
+		return found
+
+	@staticmethod
+	def is_mounted (target):
+		return MountManager.find (target) is not None
+
+	@staticmethod
+	def mounts_below (target, include_self=True):
+		''' Mount points at or below target, deepest first '''
+		target = os.path.abspath (target)
+		prefix = target.rstrip ("/") + "/"
+		found = list ()
+		for entry in MountManager.mount_table ():
+			if entry.target.startswith (prefix) or (include_self and entry.target == target):
+				if entry.target not in found:
+					found.append (entry.target)
+		return sorted (found, key=lambda t: t.count ("/"), reverse=True)
+
+	@staticmethod
+	def _parse_options (options):
+		flags = 0
+		data = list ()
+		loop = False
+		if options is not None:
+			for option in options.split (","):
+				option = option.strip ()
+				if option == "loop":
+					loop = True
+				elif option in FLAG_OPTIONS:
+					flags |= FLAG_OPTIONS[option]
+				elif option:
+					data.append (option)
+		return (flags, ",".join (data), loop)
+
+	@staticmethod
+	def _attach_loop (image, read_only):
+		''' Attach image to a free loop device, released again on unmount '''
+		image_fd = os.open (image, os.O_RDONLY if read_only else os.O_RDWR)
+		try:
+			control = os.open ("/dev/loop-control", os.O_RDWR)
+			try:
+				for attempt in range (10):
+					number = fcntl.ioctl (control, LOOP_CTL_GET_FREE)
+					device = "/dev/loop%d" % number
+					loop_fd = os.open (device, os.O_RDONLY if read_only else os.O_RDWR)
+					try:
+						fcntl.ioctl (loop_fd, LOOP_SET_FD, image_fd)
+					except IOError, e:
+						os.close (loop_fd)
+						if e.errno == errno.EBUSY:
+							# Someone else grabbed it first
+							continue
+						raise
+					flags = LO_FLAGS_AUTOCLEAR | (LO_FLAGS_READ_ONLY if read_only else 0)
+					info = struct.pack (LOOP_INFO64, 0, 0, 0, 0, 0, number, 0, 0, flags,
+						os.path.abspath (image)[:63], "", "", 0, 0)
+					fcntl.ioctl (loop_fd, LOOP_SET_STATUS64, info)
+					return (device, loop_fd)
+			finally:
+				os.close (control)
+		finally:
+			os.close (image_fd)
+		raise IOError (errno.EBUSY, "No free loop device")
+
+	@staticmethod
+	def _already_mounted (device, target, filesystem, loop):
+		entry = MountManager.find (target)
+		if entry is None:
+			return False
+		if loop:
+			return entry.backing_file () == os.path.abspath (device)
+		return entry.source == device and (filesystem is None or entry.filesystem == filesystem)
+
+	@staticmethod
+	def _mount_command (device, target, filesystem, options):
+		''' Fall back to mount(8), for things we can't do ourselves '''
+		cmd = ["mount"]
+		if filesystem is not None:
+			cmd += ["-t", filesystem]
+		if options is not None:
+			cmd += ["-o", options]
+		cmd += [device, target]
+		return subprocess.call (cmd) == 0
+
+	@staticmethod
+	def mount (device, target, filesystem=None, options=None):
+		'''
+		Mount device on target, doing nothing if it's already mounted there.
+		Returns whether device is now mounted on target.
+		'''
+		flags, data, loop = MountManager._parse_options (options)
+		with MountManager.lock:
+			if not flags & (MS_REMOUNT | MS_BIND):
+				if MountManager._already_mounted (device, target, filesystem, loop):
+					return True
+
+			loop_fd = None
+			source = device
+			if loop:
+				if filesystem is None:
+					filesystem = _probe_filesystem (device)
+				if filesystem is None:
+					return MountManager._mount_command (device, target, None, options)
+				try:
+					source, loop_fd = MountManager._attach_loop (device, (flags & MS_RDONLY) != 0)
+				except (IOError, OSError), e:
+					print "Unable to set up loop device for %s: %s" % (device, e)
+					return False
+			elif filesystem is None and not flags & (MS_REMOUNT | MS_BIND):
+				# Needs mount(8) to figure out what we're mounting
+				return MountManager._mount_command (device, target, None, options)
+
+			try:
+				ret = _libc.mount (source, target, filesystem, flags, data or None)
+				if ret != 0:
+					err = ctypes.get_errno ()
+					print "Unable to mount %s on %s: %s" % (device, target, os.strerror (err))
+					return False
+				return True
+			finally:
+				# Autoclear releases the loop device once this is unmounted
+				if loop_fd is not None:
+					os.close (loop_fd)
+
+	@staticmethod
+	def _umount_one (target, lazy):
+		if _libc.umount2 (target, 0) == 0:
+			return True
+		err = ctypes.get_errno ()
+		if err == errno.EINVAL and not MountManager.is_mounted (target):
+			return True
+		if err == errno.EBUSY and lazy:
+			return _libc.umount2 (target, MNT_DETACH) == 0
+		print "Unable to unmount %s: %s" % (target, os.strerror (err))
+		return False
+
+	@staticmethod
+	def umount (device_or_mount, lazy=False, recursive=False):
+		'''
+		Unmount a mount point (or everywhere a device is mounted). Recursive
+		unmounts everything below it first, lazy detaches it when busy.
+		Returns whether nothing is left mounted there.
+		'''
+		with MountManager.lock:
+			path = os.path.abspath (device_or_mount)
+			targets = list ()
+			for entry in MountManager.mount_table ():
+				if entry.target == path or entry.source == device_or_mount:
+					if entry.target not in targets:
+						targets.append (entry.target)
+			if not targets:
+				return True
+			ok = True
+			for target in targets:
+				if recursive:
+					for below in MountManager.mounts_below (target, include_self=False):
+						ok = MountManager._umount_one (below, lazy) and ok
+				# Anything stacked on the same point goes too
+				while MountManager.is_mounted (target):
+					if not MountManager._umount_one (target, lazy):
+						ok = False
+						break
+			return ok
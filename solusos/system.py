@@ -2,8 +2,17 @@ import os
 import os.path
 
 from solusos.console import *
-import urllib2
+from solusos.mounts import MountManager
+from solusos.download import Downloader
 import subprocess
+import ctypes
+import ctypes.util
+
+_libc = ctypes.CDLL (ctypes.util.find_library ("c"), use_errno=True)
+_libc.fallocate64.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+
+# Chunk size for preallocation, so progress can be reported
+ALLOCATE_CHUNK = 256 * 1024 * 1024
 
 def sizeof_fmt(num):
         for x in ['bytes','KB','MB','GB']:
@@ -16,39 +25,88 @@ def execute_hide (command):
 	''' Execute a command with no stdout '''
 	p = subprocess.Popen (command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 	p.wait ()
+	return p.returncode == 0
 	        
 class UnderlayManager:
 	
 	@staticmethod
-	def DownloadUnderlay (url, target):
+	def DownloadUnderlay (url, target, checksum=None, cache_dir=None):
 		print "\nDownloading underlay..\n"
 		xterm_title ("Downloading underlay...")
 		progress (10, 120)
 
-		u = urllib2.urlopen(url)
-		f = open(target, 'wb')
-		meta = u.info()
-		file_size = int(meta.getheaders("Content-Length")[0])
+		downloader = Downloader (cache_dir=cache_dir, callback=progress)
+		ret = downloader.fetch (url, target, checksum=checksum)
+		print "\n"
+		xterm_title_reset ()
+		return ret
 
-		file_size_dl = 0
-		block_sz = 8192
-		while True:
-				buffer = u.read(block_sz)
-				if not buffer:
+	@staticmethod
+	def AllocateImage (filepath, size, sparse=False, callback=None):
+		'''
+		Make filepath exactly size bytes long without writing any data.
+		Sparse images cost nothing up front, otherwise the space is reserved
+		with fallocate (falling back to sparse if unsupported). Progress is
+		reported as callback (done, total).
+		'''
+		fd = os.open (filepath, os.O_RDWR | os.O_CREAT, 0644)
+		try:
+			current = os.fstat (fd).st_size
+			if size < current:
+				os.ftruncate (fd, size)
+			elif not sparse:
+				offset = current
+				while offset < size:
+					length = min (ALLOCATE_CHUNK, size - offset)
+					if _libc.fallocate64 (fd, 0, offset, length) != 0:
+						err = ctypes.get_errno ()
+						print_error ("fallocate failed (%s), using a sparse image" % os.strerror (err))
 						break
+					offset += length
+					if callback is not None:
+						callback (offset - current, size - current)
+			# Covers growing sparse images, and any fallocate failure
+			if os.fstat (fd).st_size < size:
+				os.ftruncate (fd, size)
+		finally:
+			os.close (fd)
+		if callback is not None:
+			callback (1, 1)
 
-				file_size_dl += len(buffer)
-				f.write(buffer)
-				progress (file_size_dl, file_size)
-		print "\n"
-		xterm_title_reset ()
+	@staticmethod
+	def ResizeImage (filepath, size, format, sparse=False, callback=None):
+		'''
+		Grow or shrink an (unmounted) image and its filesystem in place to
+		size bytes, keeping its contents. Only ext filesystems are supported
+		'''
+		if not "ext" in format:
+			print_error ("Can't resize %s filesystems" % format)
+			return False
+		# resize2fs insists on a freshly checked filesystem
+		p = subprocess.Popen (["e2fsck", "-f", "-y", filepath], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		p.communicate ()
+		# 1 means errors were corrected, which is fine by us
+		if p.returncode not in (0, 1):
+			print_error ("Filesystem check failed for %s" % filepath)
+			return False
+		current = os.path.getsize (filepath)
+		if size > current:
+			UnderlayManager.AllocateImage (filepath, size, sparse=sparse, callback=callback)
+			return execute_hide ("resize2fs \"%s\"" % filepath)
+		if not execute_hide ("resize2fs \"%s\" %dK" % (filepath, size / 1024)):
+			print_error ("Unable to shrink %s, is it too full?" % filepath)
+			return False
+		UnderlayManager.AllocateImage (filepath, size, sparse=sparse, callback=callback)
+		return True
 
 	@staticmethod
-	def CreateLoopbackFile (filepath, size, format):
+	def CreateLoopbackFile (filepath, size, format, sparse=False):
 		xterm_title ("Generating loopback filesystem...")
 		print_info ("Generating loopback filesystem...")
-		cmd = "dd if=/dev/zero of=\"%s\" bs=1M count=%d" % (filepath, size)
-		execute_hide (cmd)
+		if os.path.exists (filepath):
+			os.unlink (filepath)
+		UnderlayManager.AllocateImage (filepath, size * 1024 * 1024, sparse=sparse, callback=progress)
+		print
 		xterm_title ("Formatting loopback filesystem...")
 		print_info ("Formatting loopback filesystem...")
 		if not "ext" in format:
@@ -59,22 +117,20 @@ class UnderlayManager:
 		xterm_title_reset ()
 		
 class SystemManager:
+	''' Thin wrapper over MountManager, kept for existing callers '''
 	
 	@staticmethod
 	def mount (device, mountpoint, filesystem=None, options=None):
-		if filesystem is not None:
-			cmd = "mount -t %s %s %s" % (filesystem, device, mountpoint)
-		else:
-			cmd = "mount %s %s" % (device, mountpoint)
-		if options is not None:
-			cmd += " -o %s" % options
-		os.system (cmd)
+		return MountManager.mount (device, mountpoint, filesystem=filesystem, options=options)
+		
+	@staticmethod
+	def umount (device_or_mount, lazy=False, recursive=False):
+		return MountManager.umount (device_or_mount, lazy=lazy, recursive=recursive)
 		
 	@staticmethod
-	def umount (device_or_mount):
-		cmd = "umount \"%s\"" % device_or_mount
-		os.system (cmd)
+	def is_mounted (mountpoint):
+		return MountManager.is_mounted (mountpoint)
 		
 	@staticmethod
 	def mount_home (point):
-		os.system ("mount --bind /home/ \"%s\"" % point)
+		return MountManager.mount ("/home/", point, options="bind")
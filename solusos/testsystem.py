@@ -8,10 +8,10 @@ import os.path
 from solusos.console import *
 
 from solusos.system import UnderlayManager, SystemManager, execute_hide
+from solusos.cgroup import ProcessGroup
 import commands
 import shutil
-import time
-import glob
+import signal
 
 # Global configuration file for SolusOS 2
 CONFIG_FILE = "/etc/solusos/2.conf"
@@ -33,7 +33,9 @@ class TestSystem:
 				dire = "/".join (self.underlay.split ("/")[:-1])
 				if not os.path.exists (dire):
 					os.makedirs (dire)
-				UnderlayManager.DownloadUnderlay (TEST_SYSTEM_URI, self.underlay)
+				if not UnderlayManager.DownloadUnderlay (TEST_SYSTEM_URI, self.underlay):
+					print_error ("Aborting due to failed underlay download")
+					sys.exit (1)
 			else:
 				print
 				print_error ("Aborting due to missing underlay system")
@@ -110,10 +112,14 @@ class TestSystem:
 			print_info ("Copying dbus startup files")
 			shutil.copytree (source_dbus, dest_dbus)
 		
+		# Everything we start in the system goes in one process group. Users
+		# may chroot in by other means, so sweep for those when killing
+		self.processes = ProcessGroup ("testsystem", self.union_dir, sweep=True)
+
 		# Startup dbus
 		self.dbus_service = "/etc/rc.d/init.d/dbus"
 		print_info ("Starting the D-Bus systemwide message bus")
-		execute_hide ("chroot \"%s\" \"%s\" start" % (self.union_dir, self.dbus_service))
+		execute_hide (self.processes.wrap ("chroot \"%s\" \"%s\" start" % (self.union_dir, self.dbus_service)))
 		
 		# Set up devices + stuff
 		self.dev_shm_path = os.path.join (self.union_dir, "dev/shm")
@@ -133,17 +139,7 @@ class TestSystem:
 
 	def murder_death_kill (self, be_gentle=False):
 		''' Completely and utterly murder all processes in the chroot :) '''
-		for root in glob.glob ("/proc/*/root"):
-			try:
-				link = os.path.realpath (root)
-				if os.path.abspath (link) == os.path.abspath (self.union_dir):
-					pid = root.split ("/")[2]
-					if be_gentle:
-						os.system ("kill %s" % pid)
-					else:
-						os.system ("kill -9 %s" % pid)
-			except:
-				pass
+		self.processes.kill (grace=3 if be_gentle else 0)
 			
 	def exit_system (self):
 		''' Exit the system '''
@@ -158,21 +154,18 @@ class TestSystem:
 		
 		with open (dbus_pid, "r") as pid_file:
 			pid = pid_file.read().strip()
-			os.system ("kill -9 %s" % pid)
-		# Safety, gives dbus enough time to die
-		time.sleep (3)
+			try:
+				os.kill (int (pid), signal.SIGKILL)
+			except (OSError, ValueError):
+				pass
 		
 		# Murder the remaining processes
-		print_info ("Asking all remaining processes to stop...")
-		self.murder_death_kill (be_gentle=True)
-		print_info ("Force-kill any remaining processes...")
-		self.murder_death_kill ()
-		
-		print_info ("Unmounting virtual filesystems...")				
-		SystemManager.umount (self.dev_shm_path)
-		SystemManager.umount (self.proc_dir)
-
+		print_info ("Stopping all remaining processes...")
+		if not self.processes.destroy ():
+			print_error ("Some processes are still running in the system")
+		
 		print_info ("Unmounting SolusOS 2 system...")
-		SystemManager.umount (self.union_dir)
+		# Virtual filesystems go along with it
+		SystemManager.umount (self.union_dir, lazy=True, recursive=True)
 		SystemManager.umount (self.cache_dir)
 		SystemManager.umount (self.underlay_dir)